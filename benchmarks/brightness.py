@@ -0,0 +1,61 @@
+"""
+Time the channel means BrightnessFilter is based on, ImageStatistics.channel_means_of, against
+PIL.ImageStat.Stat(image.convert("RGB")) it replaced, for RGB and palette images of an analysis and a full size.
+Run from the repository root: python -m benchmarks.brightness
+"""
+import argparse as _argparse
+import timeit as _timeit
+
+import PIL.Image as _Pillow
+import PIL.ImageFilter as _PillowImageFilter
+import PIL.ImageStat as _PillowImageStat
+import numpy as _numpy
+
+from fktasks import ImageStatistics as _ImageStatistics
+
+
+def _reference_means(image: _Pillow.Image) -> tuple[float, ...]:
+    with image.convert("RGB") as converted_image:
+        return tuple(_PillowImageStat.Stat(converted_image).mean)
+
+
+def _test_image(size: tuple[int, int]) -> _Pillow.Image:
+    rng = _numpy.random.default_rng(0)
+    pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=_numpy.uint8)
+
+    # smoothed noise quantizes to a palette the way photos do, unlike raw noise
+    return _Pillow.fromarray(pixels, "RGB").filter(_PillowImageFilter.GaussianBlur(2))
+
+
+def _milliseconds(fn, image: _Pillow.Image, repeat: int) -> float:
+    return min(_timeit.repeat(lambda: fn(image), number=1, repeat=repeat)) * 1000
+
+
+def main():
+    arg_parser = _argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--repeat", default=20, type=int, help="timing runs, the fastest counts (default: 20)")
+    arg_parser.add_argument("--stride", default=4, type=int, help="stride of the sampled variant (default: 4)")
+    args = arg_parser.parse_args()
+
+    variants = [
+        ("ImageStat of RGB conversion", _reference_means),
+        ("channel_means_of", _ImageStatistics.channel_means_of),
+        (f"channel_means_of, stride {args.stride}", lambda image: _ImageStatistics.channel_means_of(image, args.stride))
+    ]
+
+    for size in [(384, 256), (4000, 3000)]:
+        rgb_image = _test_image(size)
+
+        for mode, image in [("RGB", rgb_image), ("P", rgb_image.quantize(200))]:
+            print(f"{mode} {size[0]}x{size[1]}")
+            print("-" * 42)
+
+            for name, fn in variants:
+                means = ", ".join(str(round(mean, 3)) for mean in fn(image))
+                print(f"{name} (ms): {round(_milliseconds(fn, image, args.repeat), 3)} [{means}]")
+
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Time CaptionNormalizer.normalize against the regex table it replaced, on a long tag caption and on the golden
+captions of the tests. Run from the repository root: python -m benchmarks.caption_normalizer
+"""
+import argparse as _argparse
+import json as _json
+import os as _os
+import re as _re
+import timeit as _timeit
+
+from fktasks.impl.basic import CaptionNormalizer as _CaptionNormalizer
+
+_GOLDEN_PATH = _os.path.join(_os.path.dirname(__file__), "..", "tests", "data", "caption_normalizer_golden.jsonl")
+
+# the original implementation: every pattern applied in turn, tags deduplicated through a list
+_REFERENCE_REPLACEMENTS = [
+    (_re.compile(r"\:(\s+)?\d+(\.\d+)?"), " "),
+    (_re.compile(r"\\\((\s+)?"), "_---"),
+    (_re.compile(r"(\s+)?\\\)"), "---_"),
+    (_re.compile(r"\\\[(\s+)?"), "___-"),
+    (_re.compile(r"(\s+)?\\\]"), "-___"),
+    (_re.compile(r"[\(\)\[\]]"), " "),
+    (_re.compile("<.+?>"), " "),
+    (_re.compile(r"\\"), ""),
+    (_re.compile(r"\:"), ", "),
+    (_re.compile(r"\|"), ", "),
+    (_re.compile(r"\*"), " "),
+    (_re.compile(r"\.(?!\w)"), ", "),
+    (_re.compile("[;'\"+]"), ", "),
+    (_re.compile("[{}]"), " "),
+    (_re.compile(r"\s+"), " "),
+    (_re.compile("_---"), "\\\\("),
+    (_re.compile("---_"), "\\\\)"),
+    (_re.compile("___-"), "\\\\["),
+    (_re.compile("-___"), "\\\\]")
+]
+
+
+def _reference_normalize(caption_text: str) -> str:
+    caption_text = caption_text.lower()
+    for pattern, replacement in _REFERENCE_REPLACEMENTS:
+        caption_text = pattern.sub(replacement, caption_text)
+
+    tags = []
+    for tag in caption_text.split(","):
+        tag = tag.strip()
+        if tag not in tags:
+            tags.append(tag)
+
+    return ", ".join(tags).strip()
+
+
+def _long_caption(tag_count: int) -> str:
+    tags = [f"tag {i % 150}" for i in range(tag_count)]
+    weighted_tags = (f"({tag}:1.2)" if i % 5 == 0 else tag for i, tag in enumerate(tags))
+
+    return ", ".join(weighted_tags) + ", <lora:detail:0.7>, \\(artist\\)"
+
+
+def _time_per_call(normalize, captions: list[str], repeat: int) -> float:
+    seconds = min(_timeit.repeat(lambda: [normalize(caption) for caption in captions], number=1, repeat=repeat))
+    return seconds / len(captions)
+
+
+def main():
+    arg_parser = _argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--tags", default=400, type=int, help="tags in the long caption (default: 400)")
+    arg_parser.add_argument("--repeat", default=200, type=int, help="timing runs, the fastest counts (default: 200)")
+    args = arg_parser.parse_args()
+
+    with open(_GOLDEN_PATH, "r", encoding="utf-8") as golden_file:
+        golden_captions = [_json.loads(line)["caption"] for line in golden_file]
+
+    caption_sets = [
+        (f"{args.tags} tag caption", [_long_caption(args.tags)]),
+        ("golden captions", golden_captions)
+    ]
+
+    for name, captions in caption_sets:
+        for caption in captions:
+            if _CaptionNormalizer.normalize(caption) != _reference_normalize(caption):
+                raise AssertionError(f"output differs from the reference for {caption!r}")
+
+        reference_seconds = _time_per_call(_reference_normalize, captions, args.repeat)
+        seconds = _time_per_call(_CaptionNormalizer.normalize, captions, args.repeat)
+
+        print(name)
+        print("-" * 42)
+        print(f"Reference (us / caption): {round(reference_seconds * 1e6, 2)}")
+        print(f"CaptionNormalizer (us / caption): {round(seconds * 1e6, 2)}")
+        print(f"Speedup: {round(reference_seconds / seconds, 2)}x")
+        print()
+
+
+if __name__ == "__main__":
+    main()
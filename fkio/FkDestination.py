@@ -1,5 +1,8 @@
 import abc as _abc
 
+from typing import Optional as _Optional
+
+from fkio.FkSource import FkSource as _FkSource
 from fktasks.FkTask import FkImage as _FkImage
 from shared import FkWebUI as _FkWebUI
 
@@ -9,6 +12,41 @@ class FkDestination(_FkWebUI, _abc.ABC):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
+    def encode(self, image: _FkImage, image_ext: str) -> _Optional[bytes]:
+        """
+        Encode an image ahead of save(), on the thread that finished processing it, so that the I/O threads
+        running save() only write.
+        :return: contents handed to save(), None where nothing has to be encoded
+        """
+        return image.encode(image_ext) if image.needs_encoding(image_ext) else None
+
     @_abc.abstractmethod
-    def save(self, image: _FkImage, image_ext: str, caption_text_ext: str):
+    def save(self, image: _FkImage, image_ext: str, caption_text_ext: str, image_data: bytes = None) -> bool:
+        """
+        Write an image and its caption to the destination.
+        :param image_data: contents from encode(), if any
+        :return: whether anything was written; False for images the destination skips, e.g. duplicates
+        """
+        pass
+
+    def discard(self, filepath: str, image_ext: str, caption_text_ext: str) -> bool:
+        """
+        Remove an image saved earlier, identified by the path of its source image.
+        :return: whether the image was removed; False where saved images cannot be removed
+        """
+        return False
+
+    def report(self) -> list[tuple[str, any]]:
+        return []
+
+    def finish_source(self, source: _FkSource, completed: bool):
+        """
+        Finish the source of the pipeline writing to this destination once its images are in the destination.
+        :param source:
+        :param completed: whether that pipeline saved or discarded every image it read
+        """
+        source.finish(completed)
+
+    def close(self):
+        """Called once the pipeline writing to this destination has saved its last image."""
         pass
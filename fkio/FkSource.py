@@ -15,3 +15,15 @@ class FkSource(_FkWebUI, _abc.ABC):
     @_abc.abstractmethod
     def yield_next(self) -> _FkImage:
         pass
+
+    def finish(self, completed: bool):
+        """
+        Called once every image read from this source has left the pipelines, or they were shut down early.
+        :param completed: whether every image was saved or discarded
+        """
+        pass
+
+    @property
+    def scanned_directory_count(self) -> int:
+        """Number of directories listed so far, for sources that read from directories."""
+        return 0
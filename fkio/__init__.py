@@ -3,6 +3,7 @@
 from fkio.impl.disk import FkDirectoryDestination, FkDirectorySource
 from fkio.impl.memory import FkBuffer, FkPathBuffer
 from fkio.impl.midjourney import MidJourneySource
+from fkio.impl.webdataset import FkWebDatasetDestination, FkWebDatasetSource
 
 from .FkDestination import FkDestination
 from .FkSource import FkSource
@@ -13,6 +14,8 @@ __all__ = [
     "FkPathBuffer",
     "FkBuffer",
     "MidJourneySource",
+    "FkWebDatasetSource",
+    "FkWebDatasetDestination",
     "FkSource",
     "FkDestination",
 ]
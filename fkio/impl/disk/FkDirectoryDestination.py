@@ -1,4 +1,6 @@
+import hashlib as _hashlib
 import os as _os
+import threading as _threading
 
 import nicegui.elements.mixins.value_element
 from nicegui import ui
@@ -8,13 +10,133 @@ from fktasks.FkTask import FkImage as _FkImage
 
 
 class FkDirectoryDestination(_FkDestination):
+    _CONTENT_HASHES_FILENAME = ".fk-content-hashes"
+    _CONTENT_HASH_SIZE = 16
 
-    def __init__(self, dst_path: str):
+    def __init__(self, dst_path: str, copy_strategy: str = "copy", deduplicate: bool = False):
+        """
+        :param dst_path: directory to save images to
+        :param copy_strategy: how unchanged images are copied, one of utils.COPY_STRATEGIES; falls back to
+            the next strategy where unsupported
+        :param deduplicate: skip images whose file contents were saved to this directory before, in this
+            or any earlier run
+        """
         self._dst_path = _os.path.realpath(dst_path)
+        self._copy_strategy = copy_strategy
         _os.makedirs(self._dst_path, exist_ok=True)
 
-    def save(self, image: _FkImage, image_ext: str, caption_text_ext: str):
-        image.save(self._dst_path, image_ext, caption_text_ext)
+        self._deduplicate = deduplicate
+        self._content_hashes: set[bytes] = set()
+        self._content_hashes_file = None
+        self._lock = _threading.Lock()
+
+        self.duplicate_count = 0
+        self.duplicate_bytes = 0
+
+        if deduplicate:
+            content_hashes_filepath = _os.path.join(self._dst_path, self._CONTENT_HASHES_FILENAME)
+
+            if _os.path.exists(content_hashes_filepath):
+                with open(content_hashes_filepath, "rb") as content_hashes_file:
+                    content_hashes = content_hashes_file.read()
+
+                # a hash is appended when its image is saved and again when it is discarded, so the hashes of
+                # the images in the directory are the ones listed an odd number of times
+                hash_size = self._CONTENT_HASH_SIZE
+                for offset in range(0, len(content_hashes) - hash_size + 1, hash_size):
+                    self._content_hashes.symmetric_difference_update((content_hashes[offset:offset + hash_size],))
+
+            self._content_hashes_file = open(content_hashes_filepath, "ab")
+
+    def save(self, image: _FkImage, image_ext: str, caption_text_ext: str, image_data: bytes = None) -> bool:
+        if not self._deduplicate:
+            image.save(self._dst_path, image_ext, caption_text_ext, self._copy_strategy, image_data)
+            return True
+
+        # noinspection PyProtectedMember
+        if image.extension == image_ext and not image._modified_image and not image._in_memory:
+            # copied through: the saved file is the source file, whose hash is usually known already
+            image_data = None
+            content_hash = bytes.fromhex(image.content_hash)
+            image_size = _os.path.getsize(image.filepath)
+        else:
+            if image_data is None:
+                image_data = image.encode(image_ext)
+
+            content_hash = _hashlib.blake2b(image_data, digest_size=self._CONTENT_HASH_SIZE).digest()
+            image_size = len(image_data)
+
+        with self._lock:
+            if content_hash in self._content_hashes:
+                self.duplicate_count += 1
+                self.duplicate_bytes += image_size
+                return False
+
+            self._content_hashes.add(content_hash)  # claim it before writing, in case a duplicate is in flight
+
+        try:
+            image.save(self._dst_path, image_ext, caption_text_ext, self._copy_strategy, image_data)
+
+        except BaseException:
+            with self._lock:
+                self._content_hashes.discard(content_hash)
+
+            raise
+
+        with self._lock:
+            self._content_hashes_file.write(content_hash)
+            self._content_hashes_file.flush()
+
+        return True
+
+    def discard(self, filepath: str, image_ext: str, caption_text_ext: str) -> bool:
+        filename_hash = _hashlib.sha256(filepath.encode("utf-8")).hexdigest()
+
+        if self._deduplicate:
+            # the same contents may be saved again, in this run or a later one
+            image_filepath = _os.path.join(self._dst_path, filename_hash + image_ext)
+
+            file_hash = _hashlib.blake2b(digest_size=self._CONTENT_HASH_SIZE)
+            try:
+                with open(image_filepath, "rb") as image_file:
+                    while chunk := image_file.read(1 << 20):
+                        file_hash.update(chunk)
+
+                content_hash = file_hash.digest()
+            except FileNotFoundError:
+                content_hash = None
+
+            if content_hash is not None:
+                with self._lock:
+                    if content_hash in self._content_hashes:
+                        self._content_hashes.discard(content_hash)
+
+                        if self._content_hashes_file is not None:
+                            self._content_hashes_file.write(content_hash)
+                            self._content_hashes_file.flush()
+
+        for extension in (image_ext, caption_text_ext):
+            try:
+                _os.remove(_os.path.join(self._dst_path, filename_hash + extension))
+            except FileNotFoundError:
+                pass
+
+        return True
+
+    def report(self) -> list[tuple[str, any]]:
+        if not self._deduplicate:
+            return []
+
+        return [
+            ("Duplicate images skipped", self.duplicate_count),
+            ("Duplicate megabytes not written", round(self.duplicate_bytes / (1024 * 1024), 3))
+        ]
+
+    def close(self):
+        if self._content_hashes_file is not None:
+            with self._lock:
+                self._content_hashes_file.close()
+                self._content_hashes_file = None
 
     @classmethod
     def webui_config(cls):
@@ -1,30 +1,177 @@
 import os as _os
+from typing import Optional as _Optional, Union as _Union
 
 import nicegui.elements.mixins.value_element
 from nicegui import ui
 
 from fkio.FkSource import FkSource as _FkSource
+from fkio.impl.disk.FkDirectoryWalker import FkDirectoryWalker as _FkDirectoryWalker
+from fkio.impl.disk.FkScanIndex import FkScanIndex as _FkScanIndex
 from fktasks.FkTask import FkImage as _FkImage
 from utils import KNOWN_IMAGE_EXTENSIONS as _KNOWN_IMAGE_EXTENSIONS
 
 
 class FkDirectorySource(_FkSource):
-    def __init__(self, src_path: str, recursive: bool = True):
+    def __init__(
+            self,
+            src_path: _Union[str, list[str]],
+            recursive: bool = True,
+            index_path: _Optional[str] = None,
+            scan_workers: int = 8
+    ):
+        """
+        :param src_path: directory, or list of directories, to read images from
+        :param recursive: include images in subdirectories
+        :param index_path: scan index file; when given, only images that are new or changed since the
+            previous scan with the same index are yielded, and unchanged directories are not listed
+        :param scan_workers: number of threads listing directories; 1 lists them in order on the calling thread
+        """
+        src_paths = [src_path] if isinstance(src_path, str) else list(src_path)
+
         self.recursive = recursive
-        super().__init__(src_path)
+        self.index_path = index_path
+        self.scan_workers = scan_workers
+        super().__init__(src_paths[0])
+
+        self.src_paths = [_os.path.realpath(path) for path in src_paths]
+        self._scanned_directory_count = 0
+
+        # index of a finished scan, committed once the images it yielded have left the pipelines
+        self._scan_index: _Optional[_FkScanIndex] = None
+
+    @property
+    def scanned_directory_count(self) -> int:
+        return self._scanned_directory_count
+
+    def _list_indexed(self, scan_index: _FkScanIndex, dirpath: str) -> tuple[list[str], list[str]]:
+        """
+        List a directory against the scan index.
+        :return: images that are new or changed since the last scan, and the subdirectories to descend into
+        """
+        try:
+            mtime_ns = _os.stat(dirpath).st_mtime_ns
+        except OSError:
+            scan_index.remove_directory(dirpath)
+            return [], []
+
+        # entries of a directory only change together with its mtime, its files were all seen before
+        if scan_index.directory_mtime(dirpath) == mtime_ns:
+            return [], scan_index.subdirectories(dirpath) if self.recursive else []
+
+        known_files = scan_index.files(dirpath)
+        known_subdirpaths = set(scan_index.subdirectories(dirpath))
+
+        files: dict[str, tuple[int, int, int]] = {}
+        filepaths: list[str] = []
+        subdirpaths: list[str] = []
+
+        with _os.scandir(dirpath) as file_entries:
+            for file_entry in file_entries:
+                if file_entry.is_dir():
+                    if self.recursive:
+                        subdirpaths.append(file_entry.path)
 
-    def yield_next(self) -> _FkImage:
-        def scan_dir(path: str):
-            for file_entry in _os.scandir(path):
-                if file_entry.is_dir() and self.recursive:
-                    yield from scan_dir(file_entry.path)
                     continue
 
                 file_ext = _os.path.splitext(file_entry.name)[1]
-                if file_ext in _KNOWN_IMAGE_EXTENSIONS:
-                    yield _FkImage(file_entry.path)
+                if file_ext not in _KNOWN_IMAGE_EXTENSIONS:
+                    continue
+
+                file_stat = file_entry.stat()
+                record = (file_stat.st_size, file_stat.st_mtime_ns, file_entry.inode())
+                files[file_entry.name] = record
+
+                if known_files.get(file_entry.name) != record:
+                    filepaths.append(file_entry.path)
+
+        for removed_subdirpath in known_subdirpaths.difference(subdirpaths):
+            scan_index.remove_directory(removed_subdirpath)
+
+        # subdirectories are recorded under their parent, roots have none
+        parent = None if dirpath in self.src_paths else _os.path.dirname(dirpath)
+        scan_index.update_directory(dirpath, parent, mtime_ns, files)
+
+        return filepaths, subdirpaths
+
+    def _scan_indexed(self, scan_index: _FkScanIndex, dirpath: str):
+        self._scanned_directory_count += 1
+
+        filepaths, subdirpaths = self._list_indexed(scan_index, dirpath)
+        for filepath in filepaths:
+            yield _FkImage(filepath)
+
+        for subdirpath in subdirpaths:
+            yield from self._scan_indexed(scan_index, subdirpath)
+
+    def yield_next(self) -> _FkImage:
+        if self.index_path:
+            scan_index = _FkScanIndex(self.index_path)
+            try:
+                if self.scan_workers > 1:
+                    def list_directory(dirpath: str) -> tuple[list[str], list[str]]:
+                        return self._list_indexed(scan_index, dirpath)
+
+                    walker = _FkDirectoryWalker(
+                        self.src_paths, workers=self.scan_workers, list_directory=list_directory
+                    )
+                    try:
+                        for filepath in walker.walk():
+                            self._scanned_directory_count = walker.scanned_directory_count
+                            yield _FkImage(filepath)
+                    finally:
+                        self._scanned_directory_count = walker.scanned_directory_count
+
+                else:
+                    for src_path in self.src_paths:
+                        yield from self._scan_indexed(scan_index, src_path)
+            except BaseException:
+                scan_index.close()
+                raise
+
+            self._scan_index = scan_index
+            return
+
+        if self.scan_workers > 1:
+            def accept_file(file_entry: _os.DirEntry) -> bool:
+                return _os.path.splitext(file_entry.name)[1] in _KNOWN_IMAGE_EXTENSIONS
+
+            walker = _FkDirectoryWalker(self.src_paths, accept_file, self.recursive, self.scan_workers)
+            try:
+                for filepath in walker.walk():
+                    self._scanned_directory_count = walker.scanned_directory_count
+                    yield _FkImage(filepath)
+            finally:
+                self._scanned_directory_count = walker.scanned_directory_count
+
+            return
+
+        def scan_dir(path: str):
+            self._scanned_directory_count += 1
+
+            with _os.scandir(path) as file_entries:
+                for file_entry in file_entries:
+                    if file_entry.is_dir() and self.recursive:
+                        yield from scan_dir(file_entry.path)
+                        continue
+
+                    file_ext = _os.path.splitext(file_entry.name)[1]
+                    if file_ext in _KNOWN_IMAGE_EXTENSIONS:
+                        yield _FkImage(file_entry.path)
+
+        for src_path in self.src_paths:
+            yield from scan_dir(src_path)
+
+    def finish(self, completed: bool):
+        scan_index, self._scan_index = self._scan_index, None
+        if scan_index is None:
+            return
 
-        yield from scan_dir(self.src_path)
+        try:
+            # only a run that got every image through is recorded, an interrupted one is repeated in full
+            if completed:
+                scan_index.commit()
+        finally:
+            scan_index.close()
 
     @classmethod
     def webui_config(cls):
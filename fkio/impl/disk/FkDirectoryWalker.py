@@ -0,0 +1,153 @@
+import collections as _collections
+import os as _os
+import queue as _queue
+import threading as _threading
+import traceback as _traceback
+from typing import Callable as _Callable, Iterator as _Iterator, Optional as _Optional
+
+_WALK_DONE = object()
+
+
+class FkDirectoryWalker:
+    """
+    Lists directory trees on a pool of threads. Every worker keeps its own stack of directories and
+    pushes the subdirectories it finds onto it; a worker that runs out steals the oldest directory of
+    another worker, which tends to be the root of a large unvisited subtree. Accepted file paths are
+    handed to the consumer through a bounded queue, so listing never runs too far ahead of processing.
+    """
+
+    def __init__(
+            self,
+            root_dirpaths: list[str],
+            accept_file: _Optional[_Callable[[_os.DirEntry], bool]] = None,
+            recursive: bool = True,
+            workers: int = 8,
+            max_pending_files: int = 4096,
+            list_directory: _Optional[_Callable[[str], tuple[list[str], list[str]]]] = None
+    ):
+        """
+        :param root_dirpaths:
+        :param accept_file: whether a file is yielded; every file is without it
+        :param recursive: descend into subdirectories
+        :param workers: number of listing threads
+        :param max_pending_files: files listed ahead of the consumer at most
+        :param list_directory: lists a directory in place of scandir: returns the file paths to yield and the
+            subdirectories to descend into; accept_file and recursive are not used with it
+        """
+        self._root_dirpaths = root_dirpaths
+        self._accept_file = accept_file
+        self._recursive = recursive
+        self._list_directory = list_directory or self._scan_directory
+        self._worker_count = max(1, workers)
+
+        self._stacks: list[_collections.deque[str]] = [_collections.deque() for _ in range(self._worker_count)]
+        self._condition = _threading.Condition()
+        self._pending_dirpaths = 0  # queued or being listed
+        self._stopped = False
+
+        self._files: _queue.Queue = _queue.Queue(maxsize=max(1, max_pending_files))
+
+        self.scanned_directory_count = 0
+
+    def walk(self) -> _Iterator[str]:
+        with self._condition:
+            for i, root_dirpath in enumerate(self._root_dirpaths):
+                self._stacks[i % self._worker_count].append(root_dirpath)
+                self._pending_dirpaths += 1
+
+        if not self._pending_dirpaths:
+            return
+
+        workers = [
+            _threading.Thread(target=self._worker_fn, args=(i,), daemon=True)
+            for i in range(self._worker_count)
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            while True:
+                filepath = self._files.get()
+                if filepath is _WALK_DONE:
+                    return
+
+                yield filepath
+
+        finally:
+            with self._condition:
+                self._stopped = True
+                self._condition.notify_all()
+
+    def _take(self, worker_index: int) -> _Optional[str]:
+        with self._condition:
+            while not self._stopped and self._pending_dirpaths > 0:
+                own_stack = self._stacks[worker_index]
+                if own_stack:
+                    return own_stack.pop()
+
+                for offset in range(1, self._worker_count):
+                    victim_stack = self._stacks[(worker_index + offset) % self._worker_count]
+                    if victim_stack:
+                        return victim_stack.popleft()
+
+                self._condition.wait()
+
+            return None
+
+    def _put_file(self, filepath: str) -> bool:
+        while not self._stopped:
+            try:
+                self._files.put(filepath, timeout=0.5)
+                return True
+            except _queue.Full:
+                continue
+
+        return False
+
+    def _scan_directory(self, dirpath: str) -> tuple[list[str], list[str]]:
+        filepaths: list[str] = []
+        subdirpaths: list[str] = []
+
+        with _os.scandir(dirpath) as file_entries:
+            for file_entry in file_entries:
+                if file_entry.is_dir():
+                    if self._recursive:
+                        subdirpaths.append(file_entry.path)
+
+                    continue
+
+                if self._accept_file is None or self._accept_file(file_entry):
+                    filepaths.append(file_entry.path)
+
+        return filepaths, subdirpaths
+
+    def _worker_fn(self, worker_index: int):
+        while True:
+            dirpath = self._take(worker_index)
+            if dirpath is None:
+                return
+
+            subdirpaths: list[str] = []
+
+            try:
+                filepaths, subdirpaths = self._list_directory(dirpath)
+
+                for filepath in filepaths:
+                    if not self._put_file(filepath):
+                        break
+
+            except OSError as e:
+                _traceback.print_exception(e)
+
+            finally:
+                with self._condition:
+                    self._stacks[worker_index].extend(subdirpaths)
+                    self._pending_dirpaths += len(subdirpaths) - 1
+                    self.scanned_directory_count += 1
+
+                    self._condition.notify_all()
+                    walk_done = self._pending_dirpaths == 0
+
+                if walk_done:
+                    self._put_file(_WALK_DONE)
@@ -0,0 +1,108 @@
+import os as _os
+import sqlite3 as _sqlite3
+import threading as _threading
+import time as _time
+from typing import Optional as _Optional
+
+# directories modified this close to the scan could still change within the same mtime tick
+_MTIME_SETTLE_NS = 2_000_000_000
+
+
+class FkScanIndex:
+    """
+    SQLite record of a directory tree as it was at the end of the last scan: the mtime and subdirectories
+    of every directory, and size, mtime and inode of every image file. A directory whose mtime is unchanged
+    has the same entries as before, so it does not need to be listed again.
+    """
+
+    def __init__(self, index_path: str):
+        index_dirpath = _os.path.dirname(_os.path.abspath(index_path))
+        _os.makedirs(index_dirpath, exist_ok=True)
+
+        # shared by the listing threads and committed by whichever pipeline thread finishes the source
+        self._lock = _threading.Lock()
+        self._connection = _sqlite3.connect(index_path, check_same_thread=False)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+
+            CREATE TABLE IF NOT EXISTS files (
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                PRIMARY KEY (directory, name)
+            );
+            """
+        )
+
+        self._scan_start_ns = _time.time_ns()
+
+    def directory_mtime(self, dirpath: str) -> _Optional[int]:
+        with self._lock:
+            row = self._connection.execute("SELECT mtime_ns FROM directories WHERE path = ?", (dirpath,)).fetchone()
+
+        return row[0] if row else None
+
+    def subdirectories(self, dirpath: str) -> list[str]:
+        with self._lock:
+            rows = self._connection.execute("SELECT path FROM directories WHERE parent = ?", (dirpath,)).fetchall()
+
+        return [row[0] for row in rows]
+
+    def files(self, dirpath: str) -> dict[str, tuple[int, int, int]]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT name, size, mtime_ns, inode FROM files WHERE directory = ?", (dirpath,)
+            ).fetchall()
+
+        return {name: (size, mtime_ns, inode) for name, size, mtime_ns, inode in rows}
+
+    def update_directory(
+            self,
+            dirpath: str,
+            parent: _Optional[str],
+            mtime_ns: int,
+            files: dict[str, tuple[int, int, int]]
+    ):
+        if mtime_ns >= self._scan_start_ns - _MTIME_SETTLE_NS:
+            mtime_ns = -1  # list it again next time
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO directories (path, parent, mtime_ns) VALUES (?, ?, ?)",
+                (dirpath, parent, mtime_ns)
+            )
+
+            self._connection.execute("DELETE FROM files WHERE directory = ?", (dirpath,))
+            self._connection.executemany(
+                "INSERT INTO files (directory, name, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?)",
+                ((dirpath, name, *record) for name, record in files.items())
+            )
+
+    def remove_directory(self, dirpath: str):
+        """Forget a directory that no longer exists, including everything below it."""
+        prefix = dirpath.rstrip(_os.sep) + _os.sep
+
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?", (dirpath, len(prefix), prefix)
+            )
+            self._connection.execute(
+                "DELETE FROM files WHERE directory = ? OR substr(directory, 1, ?) = ?",
+                (dirpath, len(prefix), prefix)
+            )
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
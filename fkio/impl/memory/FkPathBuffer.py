@@ -1,7 +1,10 @@
 import os as _os
+import queue as _queue
+from typing import Optional as _Optional
 
 import nicegui.element
 from nicegui import ui
+from PIL.Image import Image as _PillowImage
 
 from fkio.FkDestination import FkDestination as _FkDestination
 from fkio.FkSource import FkSource as _FkSource
@@ -10,19 +13,67 @@ from fktasks.FkTask import FkImage as _FkImage
 
 
 class FkPathBuffer(_FkDestination, _FkSource, _FkBuffer):
+    """
+    Hands images from one pipeline to the next while both are running. Saving blocks once `max_size`
+    images are waiting, so a fast producer cannot run ahead of its consumer; reading blocks until the
+    next image arrives and ends when the producing pipeline closes the buffer.
+    """
 
-    def __init__(self, *args, **kwargs):
-        self.image_paths: list[str] = []
-        super().__init__(*args, **kwargs)
-        super(_FkSource, self).__init__(src_path=None, *args, **kwargs)
+    def __init__(self, name: str = "buffer", max_size: int = 1024):
+        self.name = name
+        self.src_path = None
 
-    def save(self, image: _FkImage, image_ext: str, caption_text_ext: str):
+        self._queue: _queue.Queue[
+            _Optional[tuple[str, _Optional[str], _Optional[_PillowImage], _Optional[bytes]]]
+        ] = _queue.Queue(maxsize=max(1, max_size))
+
+        # sources of the pipelines writing here, finished together with the pipeline reading from here
+        self._upstream_sources: list[tuple[_FkSource, bool]] = []
+
+    def encode(self, image: _FkImage, image_ext: str) -> _Optional[bytes]:
+        # images are handed on as they are, the reading pipeline encodes them
+        return None
+
+    def save(self, image: _FkImage, image_ext: str, caption_text_ext: str, image_data: bytes = None) -> bool:
         image_path = _os.path.realpath(image.filepath)
-        self.image_paths.append(image_path)
+
+        # the producing pipeline releases its image data once saved, keep a private copy of modified pixels
+        # noinspection PyProtectedMember
+        modified_image = image.image.copy() if image._modified_image else None
+
+        # images without a file of their own, e.g. from a tar shard, keep their contents for the next stage
+        # noinspection PyProtectedMember
+        data = image._data_future.result() if image._in_memory else None
+
+        self._queue.put((image_path, image.caption_text, modified_image, data))
+        return True
+
+    def finish_source(self, source: _FkSource, completed: bool):
+        # images handed on have not reached the output before the pipeline reading them completes
+        self._upstream_sources.append((source, completed))
+
+    def close(self):
+        self._queue.put(None)
+
+    def finish(self, completed: bool):
+        for source, source_completed in self._upstream_sources:
+            source.finish(source_completed and completed)
+
+        self._upstream_sources.clear()
 
     def yield_next(self) -> _FkImage:
-        for image_path in self.image_paths:
-            yield _FkImage(image_path)
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+
+            image_path, caption_text, modified_image, data = entry
+
+            image = _FkImage(image_path, image=modified_image, caption_text=caption_text, data=data)
+            # noinspection PyProtectedMember
+            image._modified_image = modified_image is not None
+
+            yield image
 
     @classmethod
     def webui_config(cls, buffers: list[_FkBuffer] = None, *args, **kwargs) -> tuple[
@@ -0,0 +1,132 @@
+import hashlib as _hashlib
+import io as _io
+import os as _os
+import tarfile as _tarfile
+import threading as _threading
+import time as _time
+from typing import BinaryIO as _BinaryIO, Optional as _Optional
+
+import nicegui.elements.mixins.value_element
+from nicegui import ui
+
+from fkio.FkDestination import FkDestination as _FkDestination
+from fktasks.FkTask import FkImage as _FkImage
+
+_TAR_BLOCK_SIZE = 512
+
+
+def _tar_member_size(data_size: int) -> int:
+    padded_size = (data_size + _TAR_BLOCK_SIZE - 1) // _TAR_BLOCK_SIZE * _TAR_BLOCK_SIZE
+    return _TAR_BLOCK_SIZE + padded_size  # header + data
+
+
+class FkWebDatasetDestination(_FkDestination):
+    """
+    Writes accepted images and captions into WebDataset tar shards of at most `shard_max_bytes` each,
+    named shard-000000.tar, shard-000001.tar, ... Shards are written front to back through a large
+    buffer; a sample is never split across two shards.
+    """
+
+    def __init__(
+            self,
+            dst_path: str,
+            shard_max_bytes: int = 1 << 30,
+            shard_prefix: str = "shard-",
+            buffer_size: int = 8 << 20
+    ):
+        self._dst_path = _os.path.realpath(dst_path)
+        _os.makedirs(self._dst_path, exist_ok=True)
+
+        self._shard_max_bytes = shard_max_bytes
+        self._shard_prefix = shard_prefix
+        self._buffer_size = buffer_size
+
+        self._lock = _threading.Lock()
+        self._shard_index = -1
+        self._shard_file: _Optional[_BinaryIO] = None
+        self._shard: _Optional[_tarfile.TarFile] = None
+        self._shard_bytes = 0
+
+        self.shard_count = 0
+
+    def _open_next_shard(self):
+        self._close_shard()
+
+        self._shard_index += 1
+        shard_filepath = _os.path.join(self._dst_path, f"{self._shard_prefix}{self._shard_index:06d}.tar")
+
+        self._shard_file = open(shard_filepath, "wb", buffering=self._buffer_size)
+        self._shard = _tarfile.open(fileobj=self._shard_file, mode="w|", format=_tarfile.USTAR_FORMAT)
+        self._shard_bytes = 0
+        self.shard_count += 1
+
+    def _close_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._shard_file.close()
+
+            self._shard = None
+            self._shard_file = None
+
+    def _add_member(self, name: str, data: bytes, mtime: float):
+        member = _tarfile.TarInfo(name)
+        member.size = len(data)
+        member.mtime = mtime
+        member.mode = 0o644
+
+        self._shard.addfile(member, _io.BytesIO(data))
+
+    def save(self, image: _FkImage, image_ext: str, caption_text_ext: str, image_data: bytes = None) -> bool:
+        # same naming as a directory output, so a sample can be traced back to its source
+        key = _hashlib.sha256(image.filepath.encode("utf-8")).hexdigest()
+
+        members = [(key + image_ext, image_data if image_data is not None else image.encode(image_ext))]
+
+        caption_text = image.caption_text
+        if caption_text:
+            members.append((key + caption_text_ext, caption_text.encode("utf-8")))
+
+        sample_bytes = sum(_tar_member_size(len(data)) for _, data in members)
+        mtime = _time.time()
+
+        with self._lock:
+            if self._shard is None or (self._shard_bytes and self._shard_bytes + sample_bytes > self._shard_max_bytes):
+                self._open_next_shard()
+
+            for name, data in members:
+                self._add_member(name, data, mtime)
+
+            self._shard_bytes += sample_bytes
+
+        return True
+
+    def close(self):
+        with self._lock:
+            self._close_shard()
+
+    @classmethod
+    def webui_config(cls):
+        with ui.grid() as element:
+            output_dirpath = ui.input("Output directory", placeholder="/path/to/shards").classes("w-full")
+
+        return element, [output_dirpath]
+
+    @classmethod
+    def webui_validate(
+            cls,
+            output_dirpath: nicegui.elements.mixins.value_element.ValueElement
+    ) -> list[bool]:
+        return [True if output_dirpath.value.strip() else "Invalid path"]
+
+    @classmethod
+    def webui_info(cls, dst_path: str):
+        with ui.element("div") as element:
+            with ui.grid(columns=2).style("gap:0 0.2rem; grid-template-columns:min-content min-content;"):
+                ui.label("Shards:").classes("text-bold")
+                ui.label(dst_path).style("font-family:monospace")
+
+        return element
+
+    @classmethod
+    def webui_name(cls) -> str:
+        return "WebDataset Shard Output"
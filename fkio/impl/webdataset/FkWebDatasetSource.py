@@ -0,0 +1,170 @@
+import glob as _glob
+import os as _os
+import queue as _queue
+import tarfile as _tarfile
+import threading as _threading
+import traceback as _traceback
+from typing import Optional as _Optional, Union as _Union
+
+import nicegui.elements.mixins.value_element
+from nicegui import ui
+
+from fkio.FkSource import FkSource as _FkSource
+from fktasks.FkTask import FkImage as _FkImage
+from utils import KNOWN_CAPTION_TEXT_EXTENSIONS as _KNOWN_CAPTION_TEXT_EXTENSIONS, \
+    KNOWN_IMAGE_EXTENSIONS as _KNOWN_IMAGE_EXTENSIONS
+
+_SHARD_DONE = object()
+
+
+def _split_sample_name(member_name: str) -> tuple[str, str]:
+    """Split a member name into sample key and extension; WebDataset extensions start at the first dot."""
+    dirname, basename = _os.path.split(member_name)
+    stem, dot, extension = basename.partition(".")
+    return _os.path.join(dirname, stem), dot + extension
+
+
+class FkWebDatasetSource(_FkSource):
+    """
+    Reads images and captions straight out of WebDataset tar shards, without extracting them. Members that
+    share a key form one sample; every image member of a sample becomes an image, and a caption member of
+    the same sample becomes its caption. Shards are streamed sequentially, one reader thread per shard.
+    """
+
+    def __init__(self, src_path: _Union[str, list[str]], readers: int = 4, max_pending_images: int = 256):
+        """
+        :param src_path: shard file, directory of shards, or a list of either
+        :param readers: number of shards read at the same time
+        :param max_pending_images: number of images read ahead of the pipeline
+        """
+        src_paths = [src_path] if isinstance(src_path, str) else list(src_path)
+        super().__init__(src_paths[0])
+
+        self.src_paths = [_os.path.realpath(path) for path in src_paths]
+        self.readers = max(1, readers)
+        self._max_pending_images = max(1, max_pending_images)
+
+    @property
+    def shard_paths(self) -> list[str]:
+        shard_paths: list[str] = []
+        for src_path in self.src_paths:
+            if _os.path.isdir(src_path):
+                shard_paths.extend(sorted(_glob.glob(_os.path.join(src_path, "*.tar"))))
+            else:
+                shard_paths.append(src_path)
+
+        return shard_paths
+
+    @staticmethod
+    def _read_samples(shard_path: str):
+        """Yield (key, {extension: contents}) for every sample in the shard."""
+        sample_key: _Optional[str] = None
+        sample: dict[str, bytes] = {}
+
+        with _tarfile.open(shard_path, "r|*") as shard:
+            for member in shard:
+                if not member.isfile():
+                    continue
+
+                key, extension = _split_sample_name(member.name)
+                if key != sample_key:
+                    if sample:
+                        yield sample_key, sample
+
+                    sample_key, sample = key, {}
+
+                sample[extension.lower()] = shard.extractfile(member).read()
+
+        if sample:
+            yield sample_key, sample
+
+    def _shard_images(self, shard_path: str):
+        for key, sample in self._read_samples(shard_path):
+            caption_text = None
+            for caption_text_ext in _KNOWN_CAPTION_TEXT_EXTENSIONS:
+                if caption_text_ext in sample:
+                    caption_text = sample[caption_text_ext].decode("utf-8", errors="ignore").strip()
+
+            for extension, data in sample.items():
+                if extension in _KNOWN_IMAGE_EXTENSIONS:
+                    image_path = _os.path.join(shard_path, key + extension)
+                    yield _FkImage(image_path, caption_text=caption_text, data=data)
+
+    def yield_next(self) -> _FkImage:
+        shard_paths: _queue.Queue[str] = _queue.Queue()
+        for shard_path in self.shard_paths:
+            shard_paths.put(shard_path)
+
+        images: _queue.Queue = _queue.Queue(maxsize=self._max_pending_images)
+        stopped = _threading.Event()
+
+        def put_image(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    images.put(item, timeout=0.5)
+                    return True
+                except _queue.Full:
+                    continue
+
+            return False
+
+        def reader_fn():
+            try:
+                while not stopped.is_set():
+                    try:
+                        shard_path = shard_paths.get_nowait()
+                    except _queue.Empty:
+                        return
+
+                    try:
+                        for image in self._shard_images(shard_path):
+                            if not put_image(image):
+                                return
+                    except (OSError, _tarfile.TarError) as e:
+                        _traceback.print_exception(e)
+            finally:
+                put_image(_SHARD_DONE)
+
+        readers = [_threading.Thread(target=reader_fn, daemon=True) for _ in range(self.readers)]
+        for reader in readers:
+            reader.start()
+
+        try:
+            active_readers = len(readers)
+            while active_readers:
+                image = images.get()
+                if image is _SHARD_DONE:
+                    active_readers -= 1
+                    continue
+
+                yield image
+
+        finally:
+            stopped.set()
+
+    @classmethod
+    def webui_config(cls):
+        with ui.grid() as element:
+            input_path = ui.input("Input shards", placeholder="/path/to/shards").classes("w-full")
+
+        return element, [input_path]
+
+    @classmethod
+    def webui_validate(
+            cls,
+            input_path: nicegui.elements.mixins.value_element.ValueElement
+    ) -> list[bool]:
+        return [True if input_path.value.strip() else "Invalid path"]
+
+    @classmethod
+    def webui_info(cls, src_path: str):
+        with ui.element("div") as element:
+            with ui.grid(columns=2).style("gap:0 0.2rem; grid-template-columns:min-content min-content;"):
+                ui.label("Shards:").classes("text-bold")
+                ui.label(src_path).style("font-family:monospace")
+
+        return element
+
+    @classmethod
+    def webui_name(cls) -> str:
+        return "WebDataset Shard Input"
@@ -0,0 +1,4 @@
+from .FkWebDatasetSource import FkWebDatasetSource
+from .FkWebDatasetDestination import FkWebDatasetDestination
+
+__all__ = ["FkWebDatasetSource", "FkWebDatasetDestination"]
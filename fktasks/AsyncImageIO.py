@@ -0,0 +1,102 @@
+import threading as _threading
+from concurrent.futures import Future as _Future, ThreadPoolExecutor as _ThreadPoolExecutor
+from typing import Callable as _Callable, Optional as _Optional
+
+import utils
+
+
+def _read_bytes(filepath: str) -> bytes:
+    with open(filepath, "rb") as file:
+        return file.read()
+
+
+class AsyncImageIO:
+    """
+    Thread pool that keeps up to `concurrency` blocking file operations outstanding at once; callers get a
+    regular future back. High-latency storage (network shares) needs many reads in flight to reach its
+    throughput, which decoding threads alone cannot provide. Prefetched file contents are bounded by bytes.
+    """
+
+    # assumed size of a prefetched file until the first one was read
+    _INITIAL_PREFETCH_ESTIMATE = 1 << 20
+
+    def __init__(self, concurrency: int = 64, prefetch_bytes: int = 256 << 20):
+        """
+        :param concurrency: number of operations in flight at once
+        :param prefetch_bytes: file contents held by prefetched images at most; images beyond it are read
+            when a task first needs them
+        """
+        self._executor = _ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="FkIO")
+        self._shutdown = False
+
+        self._prefetch_bytes = prefetch_bytes
+        self._prefetch_lock = _threading.Lock()
+        self._prefetched_bytes = 0
+        self._prefetched_files = 0
+        self._prefetched_total_bytes = 0
+
+    def submit(self, fn: _Callable, *args) -> _Future:
+        """Run a blocking call once a thread is free."""
+        return self._executor.submit(fn, *args)
+
+    def read(self, filepath: str) -> _Future:
+        return self.submit(_read_bytes, filepath)
+
+    def prefetch(self, filepath: str) -> _Optional[_Future]:
+        """
+        Read a file ahead of its first use, as long as the contents of earlier prefetches stay within the
+        budget; every returned future must be handed back to release_prefetch() once its contents are dropped.
+        :param filepath:
+        :return: None once the budget is used up
+        """
+        with self._prefetch_lock:
+            if self._prefetched_bytes >= self._prefetch_bytes:
+                return None
+
+            # reads in flight count with the average size read so far, corrected once they complete
+            if self._prefetched_files:
+                estimate = self._prefetched_total_bytes // self._prefetched_files
+            else:
+                estimate = self._INITIAL_PREFETCH_ESTIMATE
+
+            self._prefetched_bytes += estimate
+
+        def read_counted() -> bytes:
+            try:
+                data = _read_bytes(filepath)
+            except BaseException:
+                with self._prefetch_lock:
+                    self._prefetched_bytes -= estimate
+
+                raise
+
+            with self._prefetch_lock:
+                self._prefetched_bytes += len(data) - estimate
+                self._prefetched_files += 1
+                self._prefetched_total_bytes += len(data)
+
+            return data
+
+        return self.submit(read_counted)
+
+    def release_prefetch(self, future: _Future):
+        """Return the bytes of a prefetch to the budget, once its read completed."""
+        def release(done_future: _Future):
+            if done_future.cancelled() or done_future.exception() is not None:
+                return
+
+            with self._prefetch_lock:
+                self._prefetched_bytes -= len(done_future.result())
+
+        future.add_done_callback(release)
+
+    def read_caption(self, image_filepath: str) -> _Future:
+        return self.submit(utils.read_caption_text, image_filepath)
+
+    def shutdown(self):
+        """Finish every submitted operation, then stop the threads."""
+        if self._shutdown:
+            return
+
+        self._shutdown = True
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,106 @@
+import hashlib as _hashlib
+import json as _json
+import os as _os
+import sqlite3 as _sqlite3
+import threading as _threading
+from typing import Optional as _Optional
+
+
+class DecisionLedger:
+    """
+    SQLite record of the outcome of every task for every image: accepted or rejected, plus the score the
+    decision was based on. Decisions are looked up by image path, content hash and a fingerprint of the task
+    configuration, so a later run with the same configuration can reuse a decision instead of running the
+    task again. The lookup is an index on disk, a ledger of any size is never loaded into memory; hashes and
+    fingerprints are stored as raw digests. Each decision is committed as it is recorded, a crashed run keeps
+    what it decided.
+    """
+
+    def __init__(self, ledger_path: str):
+        ledger_dirpath = _os.path.dirname(_os.path.abspath(ledger_path))
+        _os.makedirs(ledger_dirpath, exist_ok=True)
+
+        self._lock = _threading.Lock()
+
+        # shared by every worker thread, always behind the lock
+        self._connection = _sqlite3.connect(ledger_path, check_same_thread=False)
+        self._connection.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+
+            CREATE TABLE IF NOT EXISTS decisions (
+                path TEXT NOT NULL,
+                hash BLOB,
+                task TEXT NOT NULL,
+                fingerprint BLOB,
+                accepted INTEGER NOT NULL,
+                score REAL
+            );
+            CREATE INDEX IF NOT EXISTS decisions_key ON decisions (fingerprint, hash, path);
+            """
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT fingerprint, hash, path FROM decisions "
+                "WHERE fingerprint IS NOT NULL)"
+            ).fetchone()[0]
+
+    @staticmethod
+    def fingerprint(task_name: str, parameters: dict, preceding: list[tuple[str, dict]]) -> str:
+        """
+        Fingerprint of a task configuration, including the tasks that modified the image before it.
+        :param task_name:
+        :param parameters: parameters of the task itself
+        :param preceding: names and parameters of the tasks that may have changed the image first
+        :return:
+        """
+        description = _json.dumps([task_name, parameters, preceding], sort_keys=True, default=str)
+        return _hashlib.blake2b(description.encode("utf-8"), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _digest(hex_digest: _Optional[str]) -> _Optional[bytes]:
+        return None if hex_digest is None else bytes.fromhex(hex_digest)
+
+    def lookup(self, image_path: str, content_hash: str, fingerprint: str) -> _Optional[bool]:
+        if content_hash is None:
+            return None
+
+        with self._lock:
+            # the latest decision wins, a task may have been rerun after a crash
+            row = self._connection.execute(
+                "SELECT accepted FROM decisions WHERE fingerprint = ? AND hash = ? AND path = ? "
+                "ORDER BY rowid DESC LIMIT 1",
+                (self._digest(fingerprint), self._digest(content_hash), image_path)
+            ).fetchone()
+
+        return None if row is None else bool(row[0])
+
+    def record(
+            self,
+            image_path: str,
+            content_hash: str,
+            task_name: str,
+            fingerprint: _Optional[str],
+            accepted: bool,
+            score: _Optional[float] = None
+    ):
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO decisions (path, hash, task, fingerprint, accepted, score) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    image_path,
+                    self._digest(content_hash),
+                    task_name,
+                    self._digest(fingerprint),
+                    int(accepted),
+                    None if score is None else float(score)
+                )
+            )
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,111 @@
+import os as _os
+import re as _re
+import threading as _threading
+from typing import Optional as _Optional
+
+import numpy as _numpy
+
+
+class EmbeddingStore:
+    """
+    Append-only on-disk store of fixed-size embeddings, keyed by content digest. Vectors live in a
+    float16 matrix that is memory-mapped for reading; the index is a flat file of fixed-size digests
+    whose position equals the row of the vector. One store is kept per model, so embeddings of
+    different models never mix.
+    """
+
+    def __init__(self, dirpath: str, model_name: str, dimensions: int, digest_size: int = 16):
+        self._dimensions = dimensions
+        self._digest_size = digest_size
+        self._row_bytes = dimensions * _numpy.dtype(_numpy.float16).itemsize
+
+        _os.makedirs(dirpath, exist_ok=True)
+
+        model_slug = _re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self._vectors_filepath = _os.path.join(dirpath, f"{model_slug}.{dimensions}.f16")
+        self._index_filepath = _os.path.join(dirpath, f"{model_slug}.{dimensions}.index")
+
+        self._lock = _threading.Lock()
+        self._rows: dict[bytes, int] = {}
+        self._row_count = 0
+        self._vectors: _Optional[_numpy.memmap] = None
+
+        self._load()
+
+        self._vectors_file = open(self._vectors_filepath, "ab")
+        self._index_file = open(self._index_filepath, "ab")
+
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        vectors_bytes = _os.path.getsize(self._vectors_filepath) if _os.path.exists(self._vectors_filepath) else 0
+        index_bytes = _os.path.getsize(self._index_filepath) if _os.path.exists(self._index_filepath) else 0
+
+        # an interrupted run can leave one file a partial row ahead of the other
+        row_count = min(vectors_bytes // self._row_bytes, index_bytes // self._digest_size)
+
+        if vectors_bytes != row_count * self._row_bytes:
+            with open(self._vectors_filepath, "r+b") as vectors_file:
+                vectors_file.truncate(row_count * self._row_bytes)
+
+        if index_bytes != row_count * self._digest_size:
+            with open(self._index_filepath, "r+b") as index_file:
+                index_file.truncate(row_count * self._digest_size)
+
+        if row_count:
+            with open(self._index_filepath, "rb") as index_file:
+                index_data = index_file.read()
+
+            for row in range(row_count):
+                self._rows[index_data[row * self._digest_size:(row + 1) * self._digest_size]] = row
+
+        self._row_count = row_count
+
+    def __len__(self) -> int:
+        return self._row_count
+
+    def get(self, digest: bytes) -> _Optional[_numpy.ndarray]:
+        with self._lock:
+            row = self._rows.get(digest)
+            if row is None:
+                self.misses += 1
+                return None
+
+            if self._vectors is None or row >= self._vectors.shape[0]:
+                self._vectors_file.flush()
+                self._vectors = _numpy.memmap(
+                    self._vectors_filepath,
+                    dtype=_numpy.float16,
+                    mode="r",
+                    shape=(self._row_count, self._dimensions)
+                )
+
+            self.hits += 1
+            return _numpy.array(self._vectors[row])
+
+    def put(self, digest: bytes, embedding: _numpy.ndarray):
+        vector = _numpy.ascontiguousarray(embedding, dtype=_numpy.float16).reshape(-1)
+        if vector.shape[0] != self._dimensions:
+            raise ValueError(f"expected {self._dimensions} dimensions, got {vector.shape[0]}")
+
+        with self._lock:
+            if digest in self._rows:
+                return
+
+            self._vectors_file.write(vector.tobytes())
+            self._index_file.write(digest)
+
+            self._rows[digest] = self._row_count
+            self._row_count += 1
+
+    def flush(self):
+        with self._lock:
+            self._vectors_file.flush()
+            self._index_file.flush()
+
+    def close(self):
+        with self._lock:
+            self._vectors = None
+            self._vectors_file.close()
+            self._index_file.close()
@@ -0,0 +1,135 @@
+import struct as _struct
+from dataclasses import dataclass
+from typing import BinaryIO, Optional, Union
+
+import PIL.Image as _Pillow
+from PIL.Image import Image as _PillowImage
+
+_EXIF_ORIENTATION_TAG = 0x0112
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+_JPEG_DQT = 0xDB
+_JPEG_SOS = 0xDA
+_JPEG_EOI = 0xD9
+_JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}  # TEM, RST0-7: no length field
+
+# natural (row major) position of every coefficient in the zigzag order quantization tables are stored in
+_JPEG_ZIGZAG = [
+    0, 1, 8, 16, 9, 2, 3, 10,
+    17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34,
+    27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36,
+    29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46,
+    53, 60, 61, 54, 47, 55, 62, 63
+]
+
+
+@dataclass(frozen=True)
+class FkImageMetadata:
+    width: int
+    height: int
+    mode: str
+    format: Optional[str] = None
+    orientation: Optional[int] = None
+    quantization: Optional[dict[int, list[int]]] = None
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.width, self.height
+
+    @classmethod
+    def probe(cls, source: Union[str, BinaryIO]) -> "FkImageMetadata":
+        """
+        Read image metadata from the file headers only; pixel data is never decoded.
+        :param source: file path or binary file object
+        :return:
+        """
+        with _Pillow.open(source) as temp_image:
+            width, height = temp_image.size
+
+            orientation = None
+            # PNG stores EXIF after the image data, reading it would force a full decode
+            if temp_image.format != "PNG" or "exif" in temp_image.info:
+                # noinspection PyBroadException
+                try:
+                    orientation = temp_image.getexif().get(_EXIF_ORIENTATION_TAG)
+                except Exception:
+                    orientation = None
+
+            quantization = getattr(temp_image, "quantization", None)
+
+            return cls(
+                width=width,
+                height=height,
+                mode=temp_image.mode,
+                format=temp_image.format,
+                orientation=orientation,
+                quantization=dict(quantization) if quantization else None
+            )
+
+    @staticmethod
+    def read_jpeg_quantization(source: BinaryIO) -> Optional[dict[int, list[int]]]:
+        """
+        Read the quantization tables of a JPEG file straight from its markers, stopping at the start of the
+        compressed data; nothing is decoded.
+        :param source: binary file object positioned at the start of the file
+        :return: tables by id, 64 values each in natural order; None if the file is not a JPEG file or has no
+            tables before its image data
+        """
+        if source.read(2) != JPEG_MAGIC[:2]:
+            return None
+
+        quantization: dict[int, list[int]] = {}
+
+        while True:
+            marker = source.read(2)
+            while len(marker) == 2 and marker[1] == 0xFF:  # fill bytes
+                marker = marker[1:] + source.read(1)
+
+            if len(marker) < 2 or marker[0] != 0xFF or marker[1] in (_JPEG_SOS, _JPEG_EOI):
+                break
+
+            if marker[1] in _JPEG_STANDALONE_MARKERS:
+                continue
+
+            length_bytes = source.read(2)
+            if len(length_bytes) < 2:
+                break
+
+            segment_length = _struct.unpack(">H", length_bytes)[0] - 2
+            if marker[1] != _JPEG_DQT:
+                source.seek(segment_length, 1)
+                continue
+
+            segment = source.read(segment_length)
+
+            offset = 0
+            while offset < len(segment):
+                precision, table_id = segment[offset] >> 4, segment[offset] & 0x0F
+                offset += 1
+
+                if offset + (128 if precision else 64) > len(segment):
+                    break  # truncated segment
+
+                if precision:
+                    values = _struct.unpack_from(">64H", segment, offset)
+                    offset += 128
+                else:
+                    values = segment[offset:offset + 64]
+                    offset += 64
+
+                table = [0] * 64
+                for zigzag_index, value in enumerate(values):
+                    table[_JPEG_ZIGZAG[zigzag_index]] = value
+
+                quantization[table_id] = table
+
+        return quantization or None
+
+    @classmethod
+    def from_image(cls, image: _PillowImage) -> "FkImageMetadata":
+        width, height = image.size
+        return cls(width=width, height=height, mode=image.mode, format=image.format)
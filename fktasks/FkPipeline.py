@@ -3,14 +3,16 @@ import math as _math
 import queue as _queue
 import time as _time
 import traceback as _traceback
-from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor, Future as _Future
-from threading import Thread as _Thread
+from threading import Event as _Event, Lock as _Lock, RLock as _RLock, Thread as _Thread
 from typing import Optional as _Optional
 
 from fkio.FkDestination import FkDestination as _FkDestination
 from fkio.FkSource import FkSource as _FkSource
+from fktasks.AsyncImageIO import AsyncImageIO as _AsyncImageIO
+from fktasks.DecisionLedger import DecisionLedger as _DecisionLedger
 from fktasks.FkTask import FkImage as _FkImage, FkTask as _FkTask, FkReportableTask as _FkExTask
 from fktasks.GlobalImageDataCache import GlobalImageDataCache as _GlobalImageDataCache
+from fktasks.ProcessTaskRunner import ProcessTaskRunner as _ProcessTaskRunner
 from utils import format_timestamp as _format_timestamp
 
 
@@ -18,6 +20,7 @@ class _FkTaskContext:
     def __init__(self, image: _FkImage):
         self._image = image
         self.attempts = 0
+        self.visited: set["_FkTaskExecutor"] = set()
 
     @property
     def image(self):
@@ -33,7 +36,8 @@ class _FkTaskExecutor:
             task: _FkTask,
             max_workers: int = 10,
             max_attempts: int = 5,
-            queue_depth: int = -1
+            queue_depth: int = -1,
+            use_processes: bool = False
     ):
         self._max_attempts = max_attempts
         self._max_workers = max_workers
@@ -41,14 +45,26 @@ class _FkTaskExecutor:
         self._pipeline = pipeline
         self._task = task
 
+        self._process_runner: _Optional[_ProcessTaskRunner] = None
+        if use_processes:
+            self._process_runner = _ProcessTaskRunner(task, max_workers)
+
         if queue_depth <= 0:
             queue_depth = max_workers * 3
 
         self._queue: _queue.Queue[_FkTaskContext] = _queue.Queue(queue_depth)
-        self._next_executor: _Optional[_FkTaskExecutor] = None
 
         self._processed_images = 0
         self._discarded_images = 0
+        self._replayed_images = 0
+
+        # set by the pipeline when a decision ledger is used; None if decisions cannot be reused
+        self.ledger_fingerprint: _Optional[str] = None
+
+        self._stats_lock = _Lock()
+        self._timed_images = 0
+        self._timed_discards = 0
+        self._process_seconds = 0.0
 
         workers: list[_Thread] = []
         for _ in range(self._max_workers):
@@ -61,60 +77,120 @@ class _FkTaskExecutor:
     def submit(self, task: _FkTaskContext):
         self._queue.put(task, block=True)
 
-    def _thread_fn(self):
+    @property
+    def average_latency(self) -> float:
+        """Average seconds spent in the task per image, or NaN before any image was measured."""
+        with self._stats_lock:
+            return self._process_seconds / self._timed_images if self._timed_images else _math.nan
+
+    @property
+    def rejection_rate(self) -> float:
+        with self._stats_lock:
+            return self._timed_discards / self._timed_images if self._timed_images else _math.nan
+
+    def _record_timing(self, seconds: float, discarded: bool):
+        with self._stats_lock:
+            self._timed_images += 1
+            self._process_seconds += seconds
+
+            if discarded:
+                self._timed_discards += 1
+
+    def _decide(self, task_image: _FkImage) -> bool:
         # noinspection PyProtectedMember
-        while not self._pipeline._shutdown:
-            try:
-                task_context = self._queue.get(block=True, timeout=5)
-                self._queue.task_done()
+        ledger = self._pipeline._ledger
+        if ledger is None:
+            return self._process(task_image)
+
+        content_hash = task_image.content_hash
+
+        if self.ledger_fingerprint and self._task.pure:
+            accepted = ledger.lookup(task_image.filepath, content_hash, self.ledger_fingerprint)
+            if accepted is not None:
+                self._replayed_images += 1
+                return accepted
+
+        accepted = self._process(task_image)
+        ledger.record(
+            task_image.filepath,
+            content_hash,
+            self._task.name,
+            self.ledger_fingerprint,
+            accepted,
+            task_image.scores.get(self._task.name)
+        )
+
+        return accepted
+
+    def _process(self, task_image: _FkImage) -> bool:
+        process_start = _time.perf_counter()
+
+        task_image.pin()
+        try:
+            if self._process_runner:
+                task_successful = self._process_runner.process(task_image)
+            else:
+                task_successful = self._task.process(task_image)
+        finally:
+            task_image.unpin()
 
-                if not task_context:
-                    continue
+        self._record_timing(_time.perf_counter() - process_start, not task_successful)
+        return bool(task_successful)
 
-                task_context.attempts += 1
+    def stop(self):
+        """Let every worker exit once it reaches the end of the queue."""
+        for _ in self._workers:
+            self._queue.put(None)
 
-                if task_context.attempts == 1:
-                    self._processed_images += 1
+    def _thread_fn(self):
+        while True:
+            task_context = self._queue.get(block=True)
 
-                task_image = task_context.image
+            if task_context is None:  # stop sentinel
+                return
 
-                # noinspection PyBroadException
-                try:
-                    task_successful = self._task.process(task_image)
+            # noinspection PyProtectedMember
+            if self._pipeline._shutdown:
+                # noinspection PyProtectedMember
+                self._pipeline._complete(task_context)
+                continue
 
-                    if task_successful:
-                        if self._next_executor:
-                            task_context.attempts = 0
-                            self._next_executor.submit(task_context)
+            task_context.attempts += 1
 
-                        else:  # no more executors; save image
-                            try:
-                                self._pipeline.save(task_context)
-                            except:
-                                pass
+            if task_context.attempts == 1:
+                self._processed_images += 1
 
-                    else:
-                        if task_context.attempts == 1:
-                            self._discarded_images += 1
+            task_image = task_context.image
 
-                        task_context.destroy()
+            # noinspection PyBroadException
+            try:
+                task_successful = self._decide(task_image)
 
-                        continue
+                task_context.visited.add(self)
 
-                except Exception as e:
-                    _traceback.print_exception(e)
+                if task_successful:
+                    # noinspection PyProtectedMember
+                    self._pipeline._forward(task_context)
 
-                    # noinspection PyUnboundLocalVariable
-                    attempts = task_context.attempts
-                    if attempts > self._max_attempts:
-                        task_context.destroy()
-                        continue
+                else:
+                    if task_context.attempts == 1:
+                        self._discarded_images += 1
 
-                    task_context.image.release()
-                    self.submit(task_context)
+                    # noinspection PyProtectedMember
+                    self._pipeline._complete(task_context)
 
-            except _queue.Empty:
-                continue
+            except Exception as e:
+                _traceback.print_exception(e)
+
+                # noinspection PyUnboundLocalVariable
+                attempts = task_context.attempts
+                if attempts > self._max_attempts:
+                    # noinspection PyProtectedMember
+                    self._pipeline._complete(task_context)
+                    continue
+
+                task_context.image.release()
+                self.submit(task_context)
 
             finally:
                 if self._processed_images > 0 and self._processed_images % 1000 == 0:
@@ -137,22 +213,31 @@ class _FkTaskContextFactory:
 
         self._queue.put(image)
 
+    def stop(self):
+        if self._started:
+            self._queue.put(None)
+
     def process_queue(self):
-        # noinspection PyProtectedMember
-        while not self._pipeline._shutdown and not self.shutdown:
-            try:
-                next_image = self._queue.get(block=True, timeout=5)
-                if next_image:
-                    task_context = _FkTaskContext(next_image)
+        while True:
+            next_image = self._queue.get(block=True)
 
-                    # noinspection PyProtectedMember
-                    self._pipeline._entry_executor.submit(task_context)
+            if next_image is None:  # stop sentinel
+                return
 
-                self._queue.task_done()
+            task_context = _FkTaskContext(next_image)
 
-            except _queue.Empty:
+            # noinspection PyProtectedMember
+            if self._pipeline._shutdown or self.shutdown:
+                # noinspection PyProtectedMember
+                self._pipeline._complete(task_context)
                 continue
 
+            # noinspection PyProtectedMember
+            self._pipeline._forward(task_context)
+
+            # noinspection PyProtectedMember
+            self._pipeline._observe_submission()
+
 
 class FkPipeline:
     def __init__(
@@ -161,7 +246,13 @@ class FkPipeline:
             output_dst: _FkDestination,
             image_ext: str = ".png",
             caption_text_ext: str = ".txt",
-            cache_capacity: int = 32
+            cache_bytes: int = 1 << 30,
+            adaptive_ordering: bool = False,
+            warmup_images: int = 500,
+            io_concurrency: int = 64,
+            prefetch_bytes: int = 256 << 20,
+            ledger: _Optional[_DecisionLedger] = None,
+            upstream: _Optional["FkPipeline"] = None
     ):
         self.input_source = input_src
         self.output_dst = output_dst
@@ -170,14 +261,25 @@ class FkPipeline:
         self.caption_text_ext = caption_text_ext
 
         self._executors: list[_FkTaskExecutor] = []
-        self._entry_executor: _Optional[_FkTaskExecutor] = None
+        self._executor_order: list[_FkTaskExecutor] = []
+
+        self._adaptive_ordering = adaptive_ordering
+        self._warmup_images = max(1, warmup_images)
+        self._ordering_settled = not adaptive_ordering
+        self._submitted_image_count = 0
 
-        self._save_futures: list[_Future] = []
-        self._save_executor = _ThreadPoolExecutor(max_workers=10)
+        self._io = _AsyncImageIO(io_concurrency, prefetch_bytes)
         self._context_factory = None
 
         self._started = False
         self._shutdown = False
+        self._shutdown_lock = _Lock()
+
+        # images handed to the pipeline that were neither saved nor discarded yet
+        self._in_flight_lock = _Lock()
+        self._in_flight_count = 0
+        self._source_exhausted = False
+        self._completed_event = _Event()
 
         self._dry_run = False
 
@@ -185,31 +287,80 @@ class FkPipeline:
         self._shutdown_time = -1
 
         self._processed_image_count = 0
-        self._scanned_directory_count = 0
         self._images_saved_count = 0
 
-        self._image_cache = _GlobalImageDataCache(cache_capacity)
+        # only tracked when a task may retract images it accepted earlier
+        self._tracks_saved_images = False
+        self._saved_lock = _RLock()
+        self._saved_filepaths: set[str] = set()
+        self._retracted_filepaths: set[str] = set()
+        self._images_retracted_count = 0
+
+        self._image_cache = _GlobalImageDataCache(cache_bytes)
+        self._ledger = ledger
 
-    def _cleanup_futures(self):
-        self._save_futures = [f for f in self._save_futures if not f.done()]
+        # pipeline whose saved images this one reads, e.g. the previous stage of a multi-pass run
+        self._upstream = upstream
 
     @property
     def active(self):
         if not self._started:
             raise RuntimeError("Pipeline is not started.")
 
-        self._cleanup_futures()
+        return not self._completed_event.is_set()
 
-        for save_future in self._save_futures:
-            if not save_future.done():
-                return True
+    def wait(self, timeout: _Optional[float] = None) -> bool:
+        """
+        Block until every image from the input source was either saved or discarded, or the pipeline was shut
+        down, e.g. from another thread after an interrupt.
+        :param timeout: seconds to wait at most, or None to wait indefinitely
+        :return: whether the pipeline completed
+        """
+        if not self._started:
+            raise RuntimeError("Pipeline is not started.")
 
-        for executor in self._executors:
-            # noinspection PyProtectedMember
-            if not executor._queue.empty():
+        deadline = None if timeout is None else _time.monotonic() + timeout
+
+        while not self._shutdown:
+            interval = 0.5 if deadline is None else min(0.5, deadline - _time.monotonic())
+            if interval <= 0:
+                break
+
+            if self._completed_event.wait(interval):
                 return True
 
-        return False
+        return self._completed_event.is_set()
+
+    def _admit(self):
+        with self._in_flight_lock:
+            self._in_flight_count += 1
+
+    def _complete(self, task_context: _FkTaskContext):
+        """Release an image that leaves the pipeline, whether it was saved, discarded or abandoned."""
+        task_context.destroy()
+
+        with self._in_flight_lock:
+            self._in_flight_count -= 1
+            if self._in_flight_count == 0 and self._source_exhausted:
+                self._completed_event.set()
+
+    def _source_done(self):
+        with self._in_flight_lock:
+            self._source_exhausted = True
+            if self._in_flight_count == 0:
+                self._completed_event.set()
+
+    def _forward(self, task_context: _FkTaskContext):
+        next_executor = self._route(task_context)
+        if next_executor:
+            task_context.attempts = 0
+            next_executor.submit(task_context)
+
+        else:  # no more executors; save image
+            try:
+                self.save(task_context)
+            except RuntimeError:
+                pass
 
     @property
     def tasks(self):
@@ -221,35 +372,184 @@ class FkPipeline:
             task: _FkTask,
             max_workers: int = 20,
             max_attempts: int = 5,
-            queue_depth: int = -1
+            queue_depth: int = -1,
+            use_processes: bool = False
     ):
         if self._started:
             raise RuntimeError("Pipeline already started.")
 
-        task_executor = _FkTaskExecutor(self, task, max_workers, max_attempts, queue_depth)
+        if use_processes and not task.process_safe:
+            print(f"{task.name} cannot run in worker processes, using threads...")
+            use_processes = False
+
+        if task.retracts_images:
+            task.bind_retract(self.retract)
+            self._tracks_saved_images = True
+
+        task_executor = _FkTaskExecutor(self, task, max_workers, max_attempts, queue_depth, use_processes)
         self._executors.append(task_executor)
 
+    def retract(self, filepath: str) -> bool:
+        """
+        Take back an image that passed every task. An image that is still on its way to the destination is not
+        saved; one that was saved already is discarded from the destination, where the destination supports it.
+        :param filepath:
+        :return: whether the image is not part of the output anymore
+        """
+        with self._saved_lock:
+            if filepath in self._retracted_filepaths:
+                return True
+
+            if filepath not in self._saved_filepaths:
+                self._retracted_filepaths.add(filepath)
+                return True
+
+            if not self._dry_run and not self.output_dst.discard(filepath, self.image_ext, self.caption_text_ext):
+                return False
+
+            self._saved_filepaths.discard(filepath)
+            self._retracted_filepaths.add(filepath)
+            self._images_saved_count -= 1
+            self._images_retracted_count += 1
+
+            return True
+
+    def _claim_save(self, filepath: str) -> bool:
+        """Whether an image should still be saved, i.e. it was not retracted on its way to the destination."""
+        if not self._tracks_saved_images:
+            return True
+
+        with self._saved_lock:
+            if filepath in self._retracted_filepaths:
+                self._images_retracted_count += 1
+                return False
+
+            return True
+
+    def _record_save(self, filepath: str):
+        with self._saved_lock:
+            self._images_saved_count += 1
+
+            if self._tracks_saved_images:
+                self._saved_filepaths.add(filepath)
+
+                if filepath in self._retracted_filepaths:  # retracted while it was being saved
+                    self._retracted_filepaths.discard(filepath)
+                    self.retract(filepath)
+
+    def _route(self, task_context: _FkTaskContext) -> _Optional[_FkTaskExecutor]:
+        """Next executor in the current order the image has not passed through yet; None once all are done."""
+        for executor in self._executor_order:
+            if executor not in task_context.visited:
+                return executor
+
+        return None
+
+    def _observe_submission(self):
+        self._submitted_image_count += 1
+
+        if not self._ordering_settled and self._submitted_image_count % self._warmup_images == 0:
+            self._reorder_executors()
+
+    def _reorder_executors(self):
+        """
+        Reorder the executor chain to minimise the expected cost per image.
+
+        Within each run of pure tasks, executors are ranked by average latency divided by
+        rejection rate, so cheap and selective filters see images first. Tasks that are not
+        pure modify the image or depend on the order images arrive in; they keep their position
+        and split the chain into segments that are ordered independently.
+        :return:
+        """
+        def rank(executor: _FkTaskExecutor) -> float:
+            # noinspection PyProtectedMember
+            if executor._timed_images < self._warmup_images // 10 + 1:
+                return _math.inf  # not enough samples; leave where it is, behind measured tasks
+
+            rejection_rate = executor.rejection_rate
+            if rejection_rate <= 0:
+                return _math.inf
+
+            return executor.average_latency / rejection_rate
+
+        executor_order: list[_FkTaskExecutor] = []
+        segment: list[_FkTaskExecutor] = []
+
+        for executor in self._executor_order:
+            # noinspection PyProtectedMember
+            if executor._task.pure:
+                segment.append(executor)
+                continue
+
+            executor_order.extend(sorted(segment, key=rank))
+            executor_order.append(executor)
+            segment = []
+
+        executor_order.extend(sorted(segment, key=rank))
+        self._executor_order = executor_order
+
+        # noinspection PyProtectedMember
+        if all(executor._timed_images >= self._warmup_images for executor in self._executors):
+            self._ordering_settled = True
+
+    def _fingerprint_executors(self) -> _Optional[list[tuple[str, dict]]]:
+        """
+        Fingerprint each task for the decision ledger. The image a task sees depends on every task before it
+        that may modify it, so their parameters are part of the fingerprint; adaptive ordering never moves a
+        task across those. That includes the tasks of upstream pipelines, which all share the same ledger.
+        Once a task with unknown parameters may have modified the image, nothing after it is fingerprinted.
+        :return: names and parameters of the tasks that may have modified an image leaving this pipeline, or
+            None if one of them has unknown parameters
+        """
+        preceding: _Optional[list[tuple[str, dict]]] = []
+        if self._upstream is not None:
+            # noinspection PyProtectedMember
+            preceding = self._upstream._fingerprint_executors()
+
+        for executor in self._executors:
+            # noinspection PyProtectedMember
+            task = executor._task
+            parameters = task.parameters
+
+            if preceding is None or parameters is None:
+                executor.ledger_fingerprint = None
+            else:
+                executor.ledger_fingerprint = _DecisionLedger.fingerprint(task.name, parameters, preceding)
+
+            if not task.pure:
+                preceding = None if preceding is None or parameters is None else preceding + [(task.name, parameters)]
+
+        return preceding
+
     def start(self, dry_run: bool = False):
         self._started = True
         self._dry_run = dry_run
 
-        tasks_len = len(self._executors)
-        for i in range(tasks_len - 1):
-            # noinspection PyProtectedMember
-            self._executors[i]._next_executor = self._executors[i + 1]
+        if self._shutdown:  # shut down from another thread before it got to run
+            return
 
-        # print("Tasks:", tasks_len)
-        self._entry_executor = self._executors[0]
+        self._executor_order = self._executors[:]
         self._context_factory = _FkTaskContextFactory(self)
 
+        if self._ledger is not None:
+            self._fingerprint_executors()
+
         self._start_time = _time.time()
 
         try:
             for input_image in self.input_source.yield_next():
-                input_image._global_cache = self._image_cache
+                if self._shutdown:  # shut down from another thread
+                    break
+
+                input_image.attach_cache(self._image_cache)
+                input_image.prefetch(self._io)
+
+                self._admit()
                 self._context_factory.submit(input_image)
                 self._processed_image_count += 1
 
+            self._source_done()
+
             if self._processed_image_count <= 0:
                 self.shutdown()
 
@@ -273,6 +573,16 @@ class FkPipeline:
             # noinspection PyProtectedMember
             print(f"Discarded Images: {executor._discarded_images}")
 
+            # noinspection PyProtectedMember
+            if executor._replayed_images:
+                # noinspection PyProtectedMember
+                print(f"Decisions Reused From Ledger: {executor._replayed_images}")
+
+            average_latency = executor.average_latency
+            if not _math.isnan(average_latency):
+                print(f"Average Latency (ms): {round(average_latency * 1000, 3)}")
+                print(f"Rejection Rate: {round(executor.rejection_rate, 3)}")
+
             if isinstance(executor_task, _FkExTask):
                 print()
 
@@ -301,7 +611,19 @@ class FkPipeline:
         print("Pipeline Results")
         print("-" * 42)
 
-        print(f"Directories scanned: {self._scanned_directory_count}")
+        if self._adaptive_ordering:
+            # noinspection PyProtectedMember
+            task_order = " > ".join(executor._task.name for executor in self._executor_order)
+            print(f"Task order: {task_order}")
+            print()
+
+        cache_statistics = self._image_cache.statistics
+        print(f"Image cache hits: {cache_statistics['hits']}")
+        print(f"Image cache misses: {cache_statistics['misses']}")
+        print(f"Image cache evictions: {cache_statistics['evictions']}")
+        print()
+
+        print(f"Directories scanned: {self.input_source.scanned_directory_count}")
         print(f"Image files processed: {self._processed_image_count}")
         print()
 
@@ -309,8 +631,19 @@ class FkPipeline:
 
         print(f"Images saved: {self._images_saved_count}")
         print(f"Discarded images: {discarded_image_count}")
+
+        if self._tracks_saved_images:
+            print(f"Images retracted: {self._images_retracted_count}")
+
         print()
 
+        destination_report = self.output_dst.report()
+        if destination_report:
+            for description, value in destination_report:
+                print(f"{description}: {value}")
+
+            print()
+
         images_per_second = round(self._processed_image_count / runtime_seconds, 3)
         print(f"Images processed / second: {images_per_second}")
         print()
@@ -319,34 +652,91 @@ class FkPipeline:
         print()
 
     def shutdown(self):
-        self._shutdown = True
-        self._context_factory.shutdown = True
+        # the thread running the pipeline and an interrupted main thread may both get here
+        with self._shutdown_lock:
+            if self._shutdown:
+                return
+
+            self._shutdown = True
+
         self._shutdown_time = _time.time()
+        if self._start_time < 0:  # shut down before it was started
+            self._start_time = self._shutdown_time
+
+        if self._context_factory is not None:
+            self._context_factory.shutdown = True
+            self._context_factory.stop()
+
+        for executor in self._executors:
+            executor.stop()
 
-        self._save_executor.shutdown(wait=True, cancel_futures=True)
+        self._io.shutdown()
+
+        # a dry run saves nothing, so the source must not record its images as done
+        completed = self._completed_event.is_set() and not self._dry_run
+        self.output_dst.finish_source(self.input_source, completed)
+        self.output_dst.close()
+
+        for executor in self._executors:
+            # noinspection PyProtectedMember
+            if executor._process_runner:
+                # noinspection PyProtectedMember
+                executor._process_runner.shutdown()
+
+            # noinspection PyProtectedMember
+            executor._task.shutdown()
+
+        self._image_cache.close()
 
     def save(self, task_context: _FkTaskContext):
         if self._shutdown:
+            self._complete(task_context)
             raise RuntimeError("Pipeline shutdown.")
 
+        task_image = task_context.image
+        filepath = task_image.filepath
+
         if self._dry_run:
-            self._images_saved_count += 1
-            task_context.destroy()
+            if self._claim_save(filepath):
+                self._record_save(filepath)
+
+            self._complete(task_context)
+            return
+
+        # encoding is CPU work; done on the worker that finished the image, the I/O threads only write. Cached
+        # pixels can be views into the arena, which must not be handed to another image while they are read
+        # noinspection PyBroadException
+        try:
+            task_image.pin()
+            try:
+                image_data = self.output_dst.encode(task_image, self.image_ext)
+            finally:
+                task_image.unpin()
+        except Exception as e:
+            _traceback.print_exception(e)
+            self._complete(task_context)
             return
 
         # noinspection PyBroadException
         def save_fn():
             try:
-                task_image = task_context.image
-                self.output_dst.save(task_image, self.image_ext, self.caption_text_ext)
+                if not self._claim_save(filepath):
+                    return
+
+                task_image.pin()
+                try:
+                    written = self.output_dst.save(task_image, self.image_ext, self.caption_text_ext, image_data)
+                finally:
+                    task_image.unpin()
 
-                self._images_saved_count += 1
-                task_context.destroy()
+                # images the destination skipped, e.g. exact duplicates, are not part of the output
+                if written:
+                    self._record_save(filepath)
 
             except Exception as e:
                 _traceback.print_exception(e)
-                pass
 
-        save_future = self._save_executor.submit(save_fn)
-        self._save_futures.append(save_future)
-        self._cleanup_futures()
+            finally:
+                self._complete(task_context)
+
+        self._io.submit(save_fn)
@@ -2,35 +2,72 @@ import abc as _abc
 import argparse as _argparse
 import enum as _enum
 import hashlib as _hashlib
+import io as _io
 import os as _os
-import shutil
-from typing import Optional as _Optional
+from concurrent.futures import Future as _Future
+from typing import BinaryIO as _BinaryIO, Callable as _Callable, Optional as _Optional
 
 import PIL.Image as _Pillow
 import cv2 as _cv2
 import numpy as _numpy
 from PIL.Image import Image as _PillowImage
 
+from fktasks.AsyncImageIO import AsyncImageIO as _AsyncImageIO
+from fktasks.FkImageMetadata import FkImageMetadata as _FkImageMetadata
 from fktasks.GlobalImageDataCache import GlobalImageDataCache as _GlobalImageDataCache
+from fktasks.ImageStatistics import ImageStatistics as _ImageStatistics
+from fktasks.PerceptualHasher import PerceptualHasher as _PerceptualHasher
+from fktasks.StreamingStatistics import StreamingStatistics as _StreamingStatistics
 
 from shared import FkWebUI
-from utils import KNOWN_CAPTION_TEXT_EXTENSIONS as _KNOWN_CAPTION_TEXT_EXTENSIONS
+from utils import copy_file as _copy_file, read_caption_text as _read_caption_text
+
+_PERCEPTUAL_HASHER = _PerceptualHasher()
 
 
 class FkImage:
+    # resolution perceptual hashes are computed at; their 32x32 thumbnails need no more than this
+    PERCEPTUAL_HASH_RESOLUTION = 256
+
     def __init__(self, filepath: str, image: _PillowImage = None, caption_text: str = None,
-                 global_cache: _GlobalImageDataCache = None):
+                 global_cache: _GlobalImageDataCache = None, data: bytes = None):
+        """
+        :param filepath: path of the image file; only an identifier when data is given
+        :param image: decoded image, if already available
+        :param caption_text: caption text, read from next to the image file when not given
+        :param global_cache: cache that holds the decoded image data
+        :param data: encoded file contents of an image without a file of its own, e.g. one inside an archive
+        """
         self.filepath = filepath
 
         self._image = image
         self._cv2_image = None
         self._cv2_grayscale_image = None
+        self._metadata: _Optional[_FkImageMetadata] = None
+        self._content_hash: _Optional[str] = None
+        self._jpeg_quantization: _Optional[dict[int, list[int]]] = None
+        self._jpeg_quantization_read = False
+        self._perceptual_hash: _Optional[int] = None
+        self._thumbnails: dict[tuple[tuple[int, int], _Optional[int]], _numpy.ndarray] = {}
+        self._analysis_images: dict[int, _PillowImage] = {}
+        self._statistics: dict[_Optional[int], _ImageStatistics] = {}
 
         self._modified_image = False
 
+        # scores tasks based their decisions on, by task name
+        self.scores: dict[str, float] = {}
+
         self._caption_text = caption_text
+        self._caption_future: _Optional[_Future] = None
+        self._data_future: _Optional[_Future] = None
+        self._prefetch_io: _Optional[_AsyncImageIO] = None
         self._destroyed = False
 
+        self._in_memory = data is not None
+        if self._in_memory:
+            self._data_future = _Future()
+            self._data_future.set_result(data)
+
         self._global_cache = global_cache
 
     @property
@@ -42,15 +79,18 @@ class FkImage:
             return self._global_cache.get_pillow_image(self.filepath)
 
         if not self._image:
-            temp_image = _Pillow.open(self.filepath)
-            self._image = temp_image.copy()
-            temp_image.close()
+            with self._open_source() as source, _Pillow.open(source) as temp_image:
+                self._image = temp_image.copy()
 
         return self._image
 
     @image.setter
     def image(self, image: _PillowImage):
         self._modified_image = True
+        self._perceptual_hash = None
+        self._thumbnails = {}
+        self._statistics = {}
+        self._close_analysis_images()
 
         if self._global_cache:
             self._global_cache.update_pillow_image(self.filepath, image)
@@ -58,6 +98,163 @@ class FkImage:
             self._image = image
             self._cv2_image = None
 
+    @property
+    def metadata(self) -> _Optional[_FkImageMetadata]:
+        """Image dimensions, mode and format read from the file headers, without decoding pixel data."""
+        if self._destroyed:
+            return None
+
+        if self._modified_image:
+            return _FkImageMetadata.from_image(self.image)
+
+        return self.source_metadata
+
+    @property
+    def source_metadata(self) -> _Optional[_FkImageMetadata]:
+        """Metadata of the source file, as it was before earlier tasks modified the image."""
+        if self._destroyed:
+            return None
+
+        if self._metadata is None:
+            with self._open_source() as source:
+                self._metadata = _FkImageMetadata.probe(source)
+
+        return self._metadata
+
+    @property
+    def content_hash(self) -> _Optional[str]:
+        """Digest of the source file contents; does not reflect modifications made by earlier tasks."""
+        if self._destroyed:
+            return None
+
+        if self._content_hash is None:
+            file_hash = _hashlib.blake2b(digest_size=16)
+            with self._open_source() as image_file:
+                while chunk := image_file.read(1 << 20):
+                    file_hash.update(chunk)
+
+            self._content_hash = file_hash.hexdigest()
+
+        return self._content_hash
+
+    @property
+    def jpeg_quantization(self) -> _Optional[dict[int, list[int]]]:
+        """
+        Quantization tables of the source file if it is a JPEG file, whatever its extension; read from the
+        file's markers without decoding it. None for other formats, and for images modified by earlier tasks,
+        whose pixels the tables no longer describe.
+        """
+        if self._destroyed or self._modified_image:
+            return None
+
+        if not self._jpeg_quantization_read:
+            with self._open_source() as source:
+                self._jpeg_quantization = _FkImageMetadata.read_jpeg_quantization(source)
+
+            self._jpeg_quantization_read = True
+
+        return self._jpeg_quantization
+
+    @property
+    def perceptual_hash(self) -> _Optional[int]:
+        """64 bit DCT perceptual hash of the current image, bits in imagehash order, as an integer."""
+        if self._destroyed:
+            return None
+
+        if self._perceptual_hash is None:
+            thumbnail = self.thumbnail(_PERCEPTUAL_HASHER.phash_thumbnail_size, FkImage.PERCEPTUAL_HASH_RESOLUTION)
+            self._perceptual_hash = int(_PERCEPTUAL_HASHER.phash(thumbnail[None])[0])
+
+        return self._perceptual_hash
+
+    @perceptual_hash.setter
+    def perceptual_hash(self, perceptual_hash: int):
+        self._perceptual_hash = perceptual_hash
+
+    def thumbnail(self, size: tuple[int, int], analysis_resolution: int = None) -> _Optional[_numpy.ndarray]:
+        """
+        Grayscale thumbnail of the current image as a uint8 array, kept so every task asking for the same
+        size shares it.
+        :param size: (width, height)
+        :param analysis_resolution: make the thumbnail from the analysis view of this resolution instead of
+            the full image
+        :return:
+        """
+        if self._destroyed:
+            return None
+
+        thumbnail = self._thumbnails.get((size, analysis_resolution))
+        if thumbnail is None:
+            thumbnail = _PerceptualHasher.thumbnail(self.analysis_image(analysis_resolution), size)
+            self._thumbnails[(size, analysis_resolution)] = thumbnail
+
+        return thumbnail
+
+    def analysis_image(self, max_size: _Optional[int]) -> _Optional[_PillowImage]:
+        """
+        Reduced resolution view of the current image, for tasks that only measure it. Its longer side is at
+        least max_size; JPEG files are decoded at that scale straight away, without the full frame.
+        The view must not be modified or closed.
+        :param max_size: minimum length of the longer side; None for the full image
+        :return:
+        """
+        if self._destroyed:
+            return None
+
+        if max_size is None:
+            return self.image
+
+        if self._global_cache:
+            return self._global_cache.get_analysis_image(self.filepath, max_size)
+
+        analysis_image = self._analysis_images.get(max_size)
+        if analysis_image is None:
+            if self._image is None:
+                with self._open_source() as source:
+                    if _GlobalImageDataCache.decodes_reduced(source):
+                        analysis_image = _GlobalImageDataCache.decode_for_analysis(source, max_size)
+
+            if analysis_image is None:
+                # the full frame has to be decoded anyway; keep it for the tasks that need it
+                analysis_image = _GlobalImageDataCache.reduce_for_analysis(self.image, max_size)
+
+            self._analysis_images[max_size] = analysis_image
+
+        return analysis_image
+
+    def statistics(self, analysis_resolution: int = None) -> _Optional[_ImageStatistics]:
+        """
+        Channel means, grayscale histogram and Laplacian variance of the current image, computed together in
+        one pass and kept so every task measuring the image shares them.
+        :param analysis_resolution: measure the analysis view of this resolution instead of the full image
+        :return:
+        """
+        if self._destroyed:
+            return None
+
+        statistics = self._statistics.get(analysis_resolution)
+        if statistics is None:
+            frame = None
+            if analysis_resolution is None and self._global_cache:
+                frame = self._global_cache.get_frame(self.filepath)
+
+            if frame is not None:
+                pixels, _ = frame
+                statistics = _ImageStatistics.from_pixels(pixels)
+            else:
+                statistics = _ImageStatistics.from_image(self.analysis_image(analysis_resolution))
+
+            self._statistics[analysis_resolution] = statistics
+
+        return statistics
+
+    def _close_analysis_images(self):
+        for analysis_image in self._analysis_images.values():
+            if analysis_image is not self._image:
+                analysis_image.close()
+
+        self._analysis_images = {}
+
     @property
     def cv2_image(self):
         if self._destroyed:
@@ -126,16 +323,15 @@ class FkImage:
         if self._destroyed:
             return None
 
-        if not self._caption_text:
-            image_filename = self.filename
-            parent_dirpath = self.dirname
-
-            for caption_text_ext in _KNOWN_CAPTION_TEXT_EXTENSIONS:
-                caption_text_filepath = _os.path.join(parent_dirpath, image_filename + caption_text_ext)
-                if _os.path.exists(caption_text_filepath):
-                    with open(caption_text_filepath, "r", encoding="utf-8", errors="ignore") as caption_file:
-                        caption_text = caption_file.read()
-                        self._caption_text = caption_text.strip()
+        if not self._caption_text and not self._in_memory:
+            if self._caption_future is not None:
+                caption_future, self._caption_future = self._caption_future, None
+                try:
+                    self._caption_text = caption_future.result()
+                except OSError:
+                    self._caption_text = _read_caption_text(self.filepath)
+            else:
+                self._caption_text = _read_caption_text(self.filepath)
 
         return self._caption_text
 
@@ -159,7 +355,14 @@ class FkImage:
     def filename(self) -> str:
         return _os.path.splitext(self.basename)[0]
 
-    def save(self, output_dirpath: str, image_ext: str, caption_text_ext: str):
+    def save(
+            self,
+            output_dirpath: str,
+            image_ext: str,
+            caption_text_ext: str,
+            copy_strategy: str = "copy",
+            image_data: bytes = None
+    ):
         filename_hash = _hashlib.sha256(self.filepath.encode("utf-8")).hexdigest()
 
         save_image_filepath = _os.path.join(
@@ -168,13 +371,13 @@ class FkImage:
         )
 
         i_ext = self.extension
-        if i_ext == image_ext and not self._modified_image:
-            shutil.copyfile(self.filepath, save_image_filepath)
+        if i_ext == image_ext and not self._modified_image and not self._in_memory:
+            # copied through unchanged, pixel data is never decoded
+            _copy_file(self.filepath, save_image_filepath, copy_strategy)
 
         else:
-            self.image.save(save_image_filepath, quality=95 if image_ext in [".jpg", ".jpeg"] else None)
-
-        self.image.close()
+            with open(save_image_filepath, "wb") as image_file:
+                image_file.write(image_data if image_data is not None else self.encode(image_ext))
 
         if self.caption_text:
             caption_text_filename = filename_hash + caption_text_ext
@@ -188,11 +391,83 @@ class FkImage:
             ) as caption_file:
                 caption_file.write(self.caption_text)
 
-    def release(self):
-        """Release loaded image data without marking the image as destroyed."""
+    def needs_encoding(self, image_ext: str) -> bool:
+        """Whether contents in the format of the given extension have to be encoded from pixels."""
+        return self.extension != image_ext or self._modified_image
+
+    def encode(self, image_ext: str) -> bytes:
+        """Image file contents in the format of the given extension; the original contents when unchanged."""
+        if not self.needs_encoding(image_ext):
+            with self._open_source() as source:
+                return source.read()
+
+        image_format = _Pillow.registered_extensions()[image_ext]
+
+        buffer = _io.BytesIO()
+        self.image.save(buffer, format=image_format, quality=95 if image_ext in [".jpg", ".jpeg"] else None)
+
+        return buffer.getvalue()
+
+    def prefetch(self, image_io: _AsyncImageIO):
+        """Start reading the file contents and caption text in the background, ahead of the first task."""
+        if self._in_memory:
+            return
+
+        if not self._modified_image:
+            # beyond the prefetch budget the file is read when a task first needs it
+            self._data_future = image_io.prefetch(self.filepath)
+
+            if self._data_future is not None:
+                self._prefetch_io = image_io
+
+                if self._global_cache:
+                    self._global_cache.set_source(self.filepath, self._data_future)
+
+        if self._caption_text is None:
+            self._caption_future = image_io.read_caption(self.filepath)
+
+    def _open_source(self) -> _BinaryIO:
+        if self._data_future is not None:
+            try:
+                return _io.BytesIO(self._data_future.result())
+            except OSError:
+                pass
+
+        return open(self.filepath, "rb")
+
+    def attach_cache(self, global_cache: _GlobalImageDataCache):
+        """Serve image data from the given cache, moving over pixels this image already holds."""
+        if self._image is not None:
+            global_cache.update_pillow_image(self.filepath, self._image)
+            self._image = None
+        elif self._in_memory:
+            global_cache.set_source(self.filepath, self._data_future)
+
+        self._global_cache = global_cache
+
+    def pin(self):
+        """Keep cached image data from being evicted until unpin() is called."""
+        if self._global_cache:
+            self._global_cache.pin(self.filepath)
+
+    def unpin(self):
+        if self._global_cache:
+            self._global_cache.unpin(self.filepath)
+
+    def release(self, keep_source: bool = True):
+        """
+        Release loaded image data without marking the image as destroyed.
+        :param keep_source: let the cache decode an image without a file of its own again from its contents;
+            False once the image leaves the pipeline, so no entry outlives it
+        """
         if self._global_cache:
             self._global_cache.release_image_data(self.filepath)
+
+            if keep_source and self._in_memory and not self._modified_image:
+                self._global_cache.set_source(self.filepath, self._data_future)
         else:
+            self._close_analysis_images()
+
             if self._image is not None:
                 self._image.close()
 
@@ -206,7 +481,10 @@ class FkImage:
 
         self._destroyed = True
 
-        self.release()
+        self.release(keep_source=False)
+
+        if self._prefetch_io is not None:
+            self._prefetch_io.release_prefetch(self._data_future)
 
         # self.filepath = None
         # self._caption_text = None
@@ -218,6 +496,16 @@ class FkImage:
         del self._cv2_image
         del self._cv2_grayscale_image
         del self._image
+        del self._metadata
+        del self._content_hash
+        del self._jpeg_quantization
+        del self._perceptual_hash
+        del self._thumbnails
+        del self._analysis_images
+        del self._statistics
+        del self._caption_future
+        del self._data_future
+        del self._prefetch_io
 
 
 class FkTaskIntensiveness(_enum.Enum):
@@ -238,6 +526,13 @@ class FkTask(FkWebUI, _abc.ABC):
         """
         pass
 
+    def shutdown(self):
+        """
+        Release anything acquired in initialize(), called once the pipeline running the task shuts down
+        :return:
+        """
+        pass
+
     def register_args(self, arg_parser: _argparse.ArgumentParser):
         pass
 
@@ -256,6 +551,78 @@ class FkTask(FkWebUI, _abc.ABC):
     def intensiveness(self) -> FkTaskIntensiveness:
         return FkTaskIntensiveness.MEDIUM
 
+    @property
+    def pure(self) -> bool:
+        """
+        Whether the task only inspects images and its decision depends on nothing but the image.
+        Pure tasks can be freely reordered by the pipeline; tasks that modify pixels or captions,
+        or keep state across images, must return False.
+        :return:
+        """
+        return True
+
+    @property
+    def parameters(self) -> _Optional[dict[str, any]]:
+        """
+        Configuration that decides the outcome of process(). Decisions recorded under the same parameters
+        can be reused by later runs; None means the outcome cannot be reproduced and is never reused.
+        :return:
+        """
+        return None
+
+    @property
+    def analysis_resolution(self) -> _Optional[int]:
+        """
+        Resolution, as the length of the longer side, the task needs to reach its decision; the task reads
+        image.analysis_image(analysis_resolution). None means full resolution, which tasks that modify or
+        keep pixels always need.
+        :return:
+        """
+        return None
+
+    @property
+    def batch_size(self) -> int:
+        """Number of images the task prefers to process together; the pipeline runs at least this many workers."""
+        return 1
+
+    @property
+    def process_safe(self) -> bool:
+        """Whether the task can run in a worker process; tasks holding GPU or shared state cannot."""
+        return True
+
+    @property
+    def retracts_images(self) -> bool:
+        """
+        Whether the task may take back images it accepted earlier, once a later image turns out to
+        replace them. The pipeline then keeps track of saved images so they can be retracted.
+        :return:
+        """
+        return False
+
+    def bind_retract(self, retract_fn: _Callable[[str], bool]):
+        """Called by the pipeline the task is added to, with the function that retracts an image by path."""
+        self._retract_fn = retract_fn
+
+    def retract(self, filepath: str) -> bool:
+        """
+        Take back an image this task accepted earlier: it is not saved, or removed from the output if it was.
+        :param filepath:
+        :return: whether the image is not part of the output anymore
+        """
+        retract_fn = getattr(self, "_retract_fn", None)
+        return retract_fn(filepath) if retract_fn is not None else False
+
+    def drain_observations(self) -> any:
+        """
+        Return and clear anything recorded for reporting since the last call. Used to carry
+        report data from worker processes back to the task instance in the pipeline process.
+        :return:
+        """
+        return None
+
+    def merge_observations(self, observations: any):
+        pass
+
     @property
     @_abc.abstractmethod
     def priority(self) -> int:
@@ -266,3 +633,17 @@ class FkReportableTask(FkTask, _abc.ABC):
     @_abc.abstractmethod
     def report(self) -> list[tuple[str, any]]:
         pass
+
+    @staticmethod
+    def score_report(score_name: str, scores: _StreamingStatistics) -> list[tuple[str, any]]:
+        """
+        Report items summarizing the scores a task recorded.
+        :param score_name: what the scores measure, e.g. "Blur"
+        :param scores:
+        :return:
+        """
+        return [
+            (f"Average {score_name}", scores.mean),
+            ("Standard Deviation", scores.standard_deviation),
+            ("90th Percentile", scores.percentile(90))
+        ]
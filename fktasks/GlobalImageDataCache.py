@@ -1,50 +1,504 @@
+import bisect
+import io
+import os
 import threading
-from dataclasses import dataclass
-from typing import Optional, Dict
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from typing import BinaryIO, Iterator, Optional, Union
 
 import PIL.Image as _Pillow
 from PIL.Image import Image as _PillowImage
 import cv2 as _cv2
 import numpy as _numpy
 
+from fktasks.FkImageMetadata import JPEG_MAGIC as _JPEG_MAGIC
+
+# modes that are stored as raw 8-bit planes in the arena; anything else stays a regular PIL image
+_ARENA_MODES = {
+    "L": 1,
+    "RGB": 3,
+    "RGBA": 4
+}
+
+# modes Pillow cannot reduce, or where averaging pixel values means nothing, and what to reduce them as
+_REDUCTION_MODES = {
+    "1": "L",
+    "P": "RGB",
+    "PA": "RGBA",
+    "I;16": "I",
+    "I;16L": "I",
+    "I;16B": "I",
+    "I;16N": "I"
+}
+
+
+@dataclass
+class _ArenaBlock:
+    offset: int
+    nbytes: int
+    array: _numpy.ndarray
+
+    @property
+    def in_arena(self) -> bool:
+        return self.offset >= 0
+
+
+class _SharedMemoryArena:
+    _ALIGNMENT = 64
+
+    def __init__(self, max_bytes: int, allocation_timeout: float = 5.0):
+        self._shared_memory = SharedMemory(create=True, size=max(max_bytes, self._ALIGNMENT))
+        self._size = self._shared_memory.size
+        self._allocation_timeout = allocation_timeout
+
+        self._free_blocks: list[list[int]] = [[0, self._size]]  # sorted [offset, size]
+        self._condition = threading.Condition()
+
+        self.used_bytes = 0
+        self.overflow_allocations = 0
+
+    @property
+    def name(self) -> str:
+        return self._shared_memory.name
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _aligned(shape: tuple[int, ...]) -> tuple[int, int]:
+        nbytes = int(_numpy.prod(shape))
+        return nbytes, -(-max(nbytes, 1) // _SharedMemoryArena._ALIGNMENT) * _SharedMemoryArena._ALIGNMENT
+
+    def _block(self, shape: tuple[int, ...], offset: int, nbytes: int) -> _ArenaBlock:
+        array = _numpy.ndarray(shape, dtype=_numpy.uint8, buffer=self._shared_memory.buf, offset=offset)
+        return _ArenaBlock(offset, nbytes, array)
+
+    def try_allocate(self, shape: tuple[int, ...]) -> Optional[_ArenaBlock]:
+        _, aligned_nbytes = self._aligned(shape)
+
+        with self._condition:
+            offset = self._reserve(aligned_nbytes)
+
+        return self._block(shape, offset, aligned_nbytes) if offset >= 0 else None
+
+    def allocate(self, shape: tuple[int, ...]) -> _ArenaBlock:
+        """
+        Allocate an uint8 array inside the arena, waiting for other entries to be released when it is full.
+        Falls back to a regular heap array for frames larger than the arena, or when waiting times out,
+        so a full arena slows the pipeline down rather than deadlocking it.
+        :param shape:
+        :return:
+        """
+        nbytes, aligned_nbytes = self._aligned(shape)
+
+        offset = -1
+        if aligned_nbytes <= self._size:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: any(size >= aligned_nbytes for _, size in self._free_blocks),
+                    timeout=self._allocation_timeout
+                )
+                offset = self._reserve(aligned_nbytes)
+
+        if offset < 0:
+            self.overflow_allocations += 1
+            return _ArenaBlock(-1, nbytes, _numpy.empty(shape, dtype=_numpy.uint8))
+
+        return self._block(shape, offset, aligned_nbytes)
+
+    def _reserve(self, nbytes: int) -> int:
+        # first fit; caller holds the condition lock
+        for i, (offset, size) in enumerate(self._free_blocks):
+            if size < nbytes:
+                continue
+
+            if size == nbytes:
+                del self._free_blocks[i]
+            else:
+                self._free_blocks[i] = [offset + nbytes, size - nbytes]
+
+            self.used_bytes += nbytes
+            return offset
+
+        return -1
+
+    def free(self, block: Optional[_ArenaBlock]):
+        if block is None or not block.in_arena:
+            return
+
+        with self._condition:
+            offset, nbytes = block.offset, block.nbytes
+            i = bisect.bisect_left(self._free_blocks, [offset, nbytes])
+            self._free_blocks.insert(i, [offset, nbytes])
+
+            # coalesce with the following and preceding free blocks
+            if i + 1 < len(self._free_blocks) and offset + nbytes == self._free_blocks[i + 1][0]:
+                self._free_blocks[i][1] += self._free_blocks[i + 1][1]
+                del self._free_blocks[i + 1]
+
+            if i > 0 and self._free_blocks[i - 1][0] + self._free_blocks[i - 1][1] == offset:
+                self._free_blocks[i - 1][1] += self._free_blocks[i][1]
+                del self._free_blocks[i]
+
+            self.used_bytes -= nbytes
+            self._condition.notify_all()
+
+    def close(self):
+        # noinspection PyBroadException
+        try:
+            self._shared_memory.close()
+        except BufferError:
+            pass  # views still exported; the mapping goes away with the process
+
+        # noinspection PyBroadException
+        try:
+            self._shared_memory.unlink()
+        except Exception:
+            pass
+
 
 @dataclass
 class _CacheEntry:
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    pins: int = 0
+    removed: bool = False
+    modified: bool = False
+
+    source: Optional[Future] = None  # encoded file contents read ahead of time
+    frame: Optional[_ArenaBlock] = None
+    frame_mode: Optional[str] = None
+    frame_info: Optional[dict] = None
     pillow_image: Optional[_PillowImage] = None
-    cv2_image: Optional[_numpy.ndarray] = None
-    cv2_gray_image: Optional[_numpy.ndarray] = None
-    has_slot: bool = False
+    cv2_image: Optional[_ArenaBlock] = None
+    cv2_gray_image: Optional[_ArenaBlock] = None
+    analysis_images: dict[int, _PillowImage] = field(default_factory=dict)  # by longer side, on the heap
+
+    @property
+    def loaded(self) -> bool:
+        return self.frame is not None or self.pillow_image is not None
+
+
+def _available_shared_memory(requested_bytes: int) -> int:
+    # on Linux shared memory lives in /dev/shm, which is often much smaller than RAM (e.g. in containers)
+    # noinspection PyBroadException
+    try:
+        stat = os.statvfs("/dev/shm")
+        return min(requested_bytes, stat.f_bavail * stat.f_frsize)
+    except Exception:
+        return requested_bytes
 
 
 class GlobalImageDataCache:
-    def __init__(self, max_capacity: int = 32):
-        self._semaphore = threading.Semaphore(max_capacity)
-        self._entries: Dict[str, _CacheEntry] = {}
-        self._entry_locks: Dict[str, threading.Lock] = {}
-
-    def _get_lock(self, filepath: str) -> threading.Lock:
-        lock = self._entry_locks.get(filepath)
-        if lock is None:
-            lock = threading.Lock()
-            self._entry_locks[filepath] = lock
-        return lock
+    """
+    Decoded image data shared by all tasks of a pipeline. Frames are decoded once into a fixed size,
+    preallocated shared memory arena; OpenCV and grayscale planes are derived lazily into the same arena.
+
+    When the arena runs out of space, derived planes and then whole frames of the least recently used
+    entries are evicted. Entries pinned by a running task, and frames holding modified pixels, are never
+    evicted. Entries are dropped entirely once their image is released.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30):
+        self._arena = _SharedMemoryArena(_available_shared_memory(max_bytes))
+        self._entries: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self._entries_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def arena_name(self) -> str:
+        return self._arena.name
+
+    @property
+    def statistics(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "arena_bytes": self._arena.size,
+            "arena_used_bytes": self._arena.used_bytes,
+            "overflow_allocations": self._arena.overflow_allocations
+        }
+
+    @contextmanager
+    def _locked_entry(self, filepath: str, create: bool = True) -> Iterator[Optional[_CacheEntry]]:
+        while True:
+            with self._entries_lock:
+                entry = self._entries.get(filepath)
+                if entry is None and create:
+                    entry = _CacheEntry()
+                    self._entries[filepath] = entry
+
+                if entry is not None:
+                    self._entries.move_to_end(filepath)
 
-    def get_pillow_image(self, filepath: str) -> _PillowImage:
-        lock = self._get_lock(filepath)
-        with lock:
-            entry = self._entries.get(filepath)
             if entry is None:
-                entry = _CacheEntry()
-                self._entries[filepath] = entry
+                yield None
+                return
+
+            entry.lock.acquire()
+            if not entry.removed:
+                break
+
+            entry.lock.release()  # released and dropped while waiting for the lock; start over
+
+        try:
+            yield entry
+        finally:
+            entry.lock.release()
+
+    def _allocate(self, shape: tuple[int, ...]) -> _ArenaBlock:
+        while True:
+            block = self._arena.try_allocate(shape)
+            if block is not None:
+                return block
+
+            if not self._evict_one():
+                return self._arena.allocate(shape)
+
+    def _evict_one(self) -> bool:
+        """
+        Free the least recently used evictable data: derived planes first, whole frames second.
+        Entries that are locked are in use by another thread and are skipped, which also keeps
+        the caller's own entry safe.
+        :return:
+        """
+        with self._entries_lock:
+            candidates = list(self._entries.values())
+
+        for evict_frames in (False, True):
+            for entry in candidates:
+                if entry.pins > 0 or not entry.lock.acquire(blocking=False):
+                    continue
+
+                try:
+                    if entry.pins > 0 or entry.removed:
+                        continue
+
+                    if evict_frames:
+                        if entry.modified or entry.frame is None or not entry.frame.in_arena:
+                            continue
+
+                        self._release_blocks(entry)
+
+                    else:
+                        if not self._release_derived(entry):
+                            continue
+
+                    self.evictions += 1
+                    return True
+
+                finally:
+                    entry.lock.release()
+
+        return False
+
+    def pin(self, filepath: str):
+        """Protect an image's data from eviction while a task is working with it."""
+        with self._locked_entry(filepath) as entry:
+            entry.pins += 1
+
+    def unpin(self, filepath: str):
+        with self._locked_entry(filepath, create=False) as entry:
+            if entry and entry.pins > 0:
+                entry.pins -= 1
+
+    def _store_frame(self, entry: _CacheEntry, image: _PillowImage):
+        channels = _ARENA_MODES.get(image.mode)
+        if channels is None:
+            entry.pillow_image = image
+            return
+
+        width, height = image.size
+        shape = (height, width) if channels == 1 else (height, width, channels)
+
+        frame = self._allocate(shape)
+        frame.array.reshape(-1)[:] = _numpy.frombuffer(image.tobytes(), dtype=_numpy.uint8)
+
+        entry.frame = frame
+        entry.frame_mode = image.mode
+        entry.frame_info = dict(image.info)
+
+    def _frame_to_pillow(self, entry: _CacheEntry) -> _PillowImage:
+        height, width = entry.frame.array.shape[:2]
+        mode = entry.frame_mode
+
+        # L and RGBA images wrap the arena frame; PIL keeps RGB as 4 bytes per pixel, so those are copied
+        image = _Pillow.frombuffer(mode, (width, height), entry.frame.array, "raw", mode, 0, 1)
+        image.info.update(entry.frame_info)
+        return image
+
+    @staticmethod
+    def _entry_source(filepath: str, entry: _CacheEntry) -> Union[str, io.BytesIO]:
+        if entry.source is not None:
+            try:
+                return io.BytesIO(entry.source.result())
+            except OSError:
+                pass  # let the decoder report the problem with the file
+
+        return filepath
+
+    def _load_entry(self, filepath: str, entry: _CacheEntry):
+        if entry.loaded:
+            self.hits += 1
+            return
+
+        self.misses += 1
+
+        with _Pillow.open(self._entry_source(filepath, entry)) as temp:
+            temp.load()
+            self._store_frame(entry, temp if temp.mode in _ARENA_MODES else temp.copy())
+
+    @staticmethod
+    def reduce_for_analysis(image: _PillowImage, max_size: int) -> _PillowImage:
+        """
+        Shrink an image by the largest integer factor that keeps its longer side at least max_size.
+        :param image:
+        :param max_size:
+        :return: a new image, or the image itself if it is small enough already
+        """
+        factor = max(image.size) // max_size
+        if factor <= 1:
+            return image
+
+        reduction_mode = _REDUCTION_MODES.get(image.mode)
+        if reduction_mode is None:
+            return image.reduce(factor)
+
+        with image.convert(reduction_mode) as converted_image:
+            return converted_image.reduce(factor)
+
+    @staticmethod
+    def decodes_reduced(source: BinaryIO) -> bool:
+        """
+        Whether decode_for_analysis can decode a file at reduced resolution without decoding the full frame,
+        which is the case for JPEG files. Only the first bytes are read; the stream is rewound.
+        :param source:
+        :return:
+        """
+        position = source.tell()
+        try:
+            return source.read(len(_JPEG_MAGIC)) == _JPEG_MAGIC
+        finally:
+            source.seek(position)
+
+    @staticmethod
+    def decode_for_analysis(source, max_size: int) -> _PillowImage:
+        """
+        Decode an image at reduced resolution, with its longer side at least max_size. JPEG files are scaled
+        down in the DCT domain while decoding and never decoded at full resolution; anything else is decoded
+        fully and shrunk right away.
+        :param source: file path or file object
+        :param max_size:
+        :return:
+        """
+        with _Pillow.open(source) as temp:
+            if temp.format == "JPEG":
+                temp.draft(None, (max_size, max_size))
+
+            temp.load()
+            analysis_image = GlobalImageDataCache.reduce_for_analysis(temp, max_size)
+            return analysis_image if analysis_image is not temp else temp.copy()
+
+    def _reduce_frame(self, entry: _CacheEntry, max_size: int) -> _PillowImage:
+        if entry.pillow_image is None:
+            entry.pillow_image = self._frame_to_pillow(entry)
+
+        analysis_image = self.reduce_for_analysis(entry.pillow_image, max_size)
+        if analysis_image is entry.pillow_image:
+            analysis_image = analysis_image.copy()  # the frame behind it may be evicted
+
+        return analysis_image
+
+    def get_analysis_image(self, filepath: str, max_size: int) -> _PillowImage:
+        """
+        Reduced resolution view of an image for tasks that only measure it. Derived from the decoded frame
+        when there is one. JPEG files are otherwise decoded at reduced resolution without the full frame;
+        other files are decoded into the cache first, so tasks that need the full frame later find it there.
+        :param filepath:
+        :param max_size: minimum length of the longer side
+        :return:
+        """
+        with self._locked_entry(filepath) as entry:
+            analysis_image = entry.analysis_images.get(max_size)
+            if analysis_image is not None:
+                self.hits += 1
+                return analysis_image
+
+            if entry.loaded:
+                analysis_image = self._reduce_frame(entry, max_size)
+
+            else:
+                source = self._entry_source(filepath, entry)
+
+                with source if isinstance(source, io.BytesIO) else open(source, "rb") as stream:
+                    decodes_reduced = self.decodes_reduced(stream)
+
+                    if decodes_reduced:
+                        self.misses += 1
+                        analysis_image = self.decode_for_analysis(stream, max_size)
+
+                if not decodes_reduced:
+                    # the full frame has to be decoded anyway; keep it for the tasks that need it
+                    self._load_entry(filepath, entry)
+                    analysis_image = self._reduce_frame(entry, max_size)
+
+            entry.analysis_images[max_size] = analysis_image
+            return analysis_image
+
+    def set_source(self, filepath: str, source: Future):
+        """Decode the file from bytes being read elsewhere instead of opening it when first needed."""
+        with self._locked_entry(filepath) as entry:
+            entry.source = source
+
+    def get_pillow_image(self, filepath: str) -> _PillowImage:
+        with self._locked_entry(filepath) as entry:
+            self._load_entry(filepath, entry)
+
             if entry.pillow_image is None:
-                if not entry.has_slot:
-                    self._semaphore.acquire()
-                    entry.has_slot = True
-                temp = _Pillow.open(filepath)
-                entry.pillow_image = temp.copy()
-                temp.close()
+                entry.pillow_image = self._frame_to_pillow(entry)
+
             return entry.pillow_image
 
+    def get_frame(self, filepath: str) -> Optional[tuple[_numpy.ndarray, str]]:
+        """
+        Decoded pixels of an image as they are cached, without deriving a Pillow or cv2 image from them:
+        (pixels, mode); None for modes that are not cached as frames.
+        The entry should be pinned for as long as the pixels are being read.
+        :param filepath:
+        :return:
+        """
+        with self._locked_entry(filepath) as entry:
+            self._load_entry(filepath, entry)
+
+            if entry.frame is None:
+                return None
+
+            return entry.frame.array, entry.frame_mode
+
+    def get_shared_frame(self, filepath: str) -> Optional[tuple[str, int, int, str, tuple[int, int]]]:
+        """
+        Location of a cached frame inside the shared memory arena, so other processes can read the pixels
+        without a copy: (shared memory name, offset, length, mode, size); None if the frame is not in the arena.
+        The entry should be pinned for as long as the frame is being read.
+        :param filepath:
+        :return:
+        """
+        with self._locked_entry(filepath, create=False) as entry:
+            if entry is None or entry.frame is None or not entry.frame.in_arena:
+                return None
+
+            height, width = entry.frame.array.shape[:2]
+            length = entry.frame.array.nbytes
+            return self._arena.name, entry.frame.offset, length, entry.frame_mode, (width, height)
+
     def _pil_to_cv(self, image: _PillowImage) -> _numpy.ndarray:
         mode = image.mode
         if mode == '1':
@@ -80,50 +534,122 @@ class GlobalImageDataCache:
             raise ValueError(f'unhandled image color mode: {mode}')
         return new_image
 
+    def _frame_to_cv(self, entry: _CacheEntry) -> _ArenaBlock:
+        frame = entry.frame
+        mode = entry.frame_mode
+
+        if mode == "L":
+            return frame
+
+        block = self._allocate(frame.array.shape)
+        conversion = _cv2.COLOR_RGB2BGR if mode == "RGB" else _cv2.COLOR_RGBA2BGRA
+
+        # noinspection PyUnresolvedReferences
+        _cv2.cvtColor(frame.array, conversion, dst=block.array)
+        return block
+
+    def _frame_to_gray(self, entry: _CacheEntry) -> _ArenaBlock:
+        frame = entry.frame
+        mode = entry.frame_mode
+
+        if mode == "L":
+            return frame
+
+        block = self._allocate(frame.array.shape[:2])
+        conversion = _cv2.COLOR_RGB2GRAY if mode == "RGB" else _cv2.COLOR_RGBA2GRAY
+
+        # noinspection PyUnresolvedReferences
+        _cv2.cvtColor(frame.array, conversion, dst=block.array)
+        return block
+
+    def _ensure_cv2_image(self, entry: _CacheEntry) -> _ArenaBlock:
+        if entry.cv2_image is None:
+            if entry.frame is not None:
+                entry.cv2_image = self._frame_to_cv(entry)
+            else:
+                cv2_image = self._pil_to_cv(entry.pillow_image)
+                entry.cv2_image = _ArenaBlock(-1, cv2_image.nbytes, cv2_image)
+
+        return entry.cv2_image
+
     def get_cv2_image(self, filepath: str) -> _numpy.ndarray:
-        pil_image = self.get_pillow_image(filepath)
-        lock = self._get_lock(filepath)
-        with lock:
-            entry = self._entries[filepath]
-            if entry.cv2_image is None:
-                entry.cv2_image = self._pil_to_cv(pil_image)
-            return entry.cv2_image
+        with self._locked_entry(filepath) as entry:
+            self._load_entry(filepath, entry)
+            return self._ensure_cv2_image(entry).array
 
     def get_cv2_grayscale_image(self, filepath: str) -> _numpy.ndarray:
-        cv_image = self.get_cv2_image(filepath)
-        lock = self._get_lock(filepath)
-        with lock:
-            entry = self._entries[filepath]
+        with self._locked_entry(filepath) as entry:
+            self._load_entry(filepath, entry)
+
             if entry.cv2_gray_image is None:
-                entry.cv2_gray_image = _cv2.cvtColor(cv_image, _cv2.COLOR_BGR2GRAY)
-            return entry.cv2_gray_image
+                if entry.frame is not None:
+                    entry.cv2_gray_image = self._frame_to_gray(entry)
+                else:
+                    # noinspection PyUnresolvedReferences
+                    gray_image = _cv2.cvtColor(self._ensure_cv2_image(entry).array, _cv2.COLOR_BGR2GRAY)
+                    entry.cv2_gray_image = _ArenaBlock(-1, gray_image.nbytes, gray_image)
+
+            return entry.cv2_gray_image.array
 
     def update_pillow_image(self, filepath: str, new_image: _PillowImage):
-        lock = self._get_lock(filepath)
-        with lock:
-            entry = self._entries.get(filepath)
-            if entry is None:
-                entry = _CacheEntry()
-                self._entries[filepath] = entry
-            if not entry.has_slot:
-                self._semaphore.acquire()
-                entry.has_slot = True
-            entry.pillow_image = new_image
-            entry.cv2_image = None
-            entry.cv2_gray_image = None
+        with self._locked_entry(filepath) as entry:
+            self._release_blocks(entry, keep_pillow_image=new_image)
+            self._store_frame(entry, new_image)
+            entry.modified = True
+
+    def _release_derived(self, entry: _CacheEntry) -> bool:
+        """Drop data that can be rebuilt from the frame; returns whether any arena memory was freed."""
+        if entry.frame is None:
+            return False
+
+        entry.pillow_image = None
+
+        released = False
+        for block in (entry.cv2_gray_image, entry.cv2_image):
+            if block is not None and block is not entry.frame:  # L frames are their own planes
+                self._arena.free(block)
+                released = released or block.in_arena
+
+        entry.cv2_image = None
+        entry.cv2_gray_image = None
+        return released
+
+    def _release_blocks(self, entry: _CacheEntry, keep_pillow_image: Optional[_PillowImage] = None):
+        if entry.pillow_image is not None and entry.pillow_image is not keep_pillow_image:
+            try:
+                entry.pillow_image.close()
+            except Exception:
+                pass
+
+        entry.pillow_image = None
+
+        for analysis_image in entry.analysis_images.values():
+            analysis_image.close()
+
+        entry.analysis_images.clear()
+
+        # derived planes of L frames are the frame itself
+        for block in {id(b): b for b in (entry.cv2_gray_image, entry.cv2_image, entry.frame) if b}.values():
+            self._arena.free(block)
+
+        entry.frame = None
+        entry.frame_mode = None
+        entry.frame_info = None
+        entry.cv2_image = None
+        entry.cv2_gray_image = None
+        entry.modified = False
 
     def release_image_data(self, filepath: str):
-        lock = self._get_lock(filepath)
-        with lock:
-            entry = self._entries.get(filepath)
-            if entry and entry.has_slot:
-                if entry.pillow_image is not None:
-                    try:
-                        entry.pillow_image.close()
-                    except Exception:
-                        pass
-                entry.pillow_image = None
-                entry.cv2_image = None
-                entry.cv2_gray_image = None
-                entry.has_slot = False
-                self._semaphore.release()
+        with self._locked_entry(filepath, create=False) as entry:
+            if entry is None:
+                return
+
+            self._release_blocks(entry)
+
+            entry.removed = True
+            with self._entries_lock:
+                if self._entries.get(filepath) is entry:
+                    del self._entries[filepath]
+
+    def close(self):
+        self._arena.close()
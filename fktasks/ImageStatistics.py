@@ -0,0 +1,175 @@
+from dataclasses import dataclass
+
+import cv2 as _cv2
+import PIL.Image as _Pillow
+import numpy as _numpy
+from PIL.Image import Image as _PillowImage
+
+_GRAYSCALE_CONVERSIONS = {
+    3: _cv2.COLOR_RGB2GRAY,
+    4: _cv2.COLOR_RGBA2GRAY
+}
+
+# modes whose pixels can be read without a conversion
+_DIRECT_MODES = ("L", "RGB", "RGBA")
+
+# bands that hold the red, green and blue of a mode, the same band three times for grayscale modes
+_COLOR_BANDS = {
+    "1": [0, 0, 0],
+    "L": [0, 0, 0],
+    "LA": [0, 0, 0],
+    "RGB": [0, 1, 2],
+    "RGBA": [0, 1, 2],
+    "RGBX": [0, 1, 2]
+}
+
+_PALETTE_MODES = ("P", "PA")
+
+
+@dataclass(frozen=True)
+class ImageStatistics:
+    """
+    Statistics several filters base their decisions on, gathered in a single pass over the pixels.
+    """
+    # mean of the red, green and blue channels; grayscale images repeat their mean three times
+    channel_means: tuple[float, float, float]
+
+    # 256 bin histogram of the grayscale image
+    histogram: _numpy.ndarray
+
+    # variance of the 3x3 Laplacian of the grayscale image, as cv2.Laplacian(gray, CV_64F).var()
+    laplacian_variance: float
+
+    @classmethod
+    def from_pixels(cls, pixels: _numpy.ndarray, strip_rows: int = 256) -> "ImageStatistics":
+        """
+        Walk the image in horizontal strips, converting each strip to grayscale once and reading every
+        statistic from it while it is hot in cache. Nothing of image size is allocated; the Laplacian of a
+        strip is taken together with one row of its neighbours, so strip borders do not change the result.
+        :param pixels: uint8 array of shape (height, width) for grayscale, (height, width, 3) for RGB or
+            (height, width, 4) for RGBA
+        :param strip_rows: number of rows processed at a time
+        :return:
+        """
+        height, width = pixels.shape[:2]
+        channels = pixels.shape[2] if pixels.ndim == 3 else 1
+
+        channel_sums = [0] * min(channels, 3)
+        histogram = _numpy.zeros(256, dtype=_numpy.int64)
+        laplacian_sum = 0
+        laplacian_square_sum = 0
+
+        for strip_start in range(0, height, strip_rows):
+            strip_end = min(strip_start + strip_rows, height)
+
+            # one row above and below, where there is one, for the Laplacian
+            halo_start = max(strip_start - 1, 0)
+            halo_end = min(strip_end + 1, height)
+
+            halo_strip = pixels[halo_start:halo_end]
+            if channels == 1:
+                gray_halo_strip = halo_strip
+            else:
+                # noinspection PyUnresolvedReferences
+                gray_halo_strip = _cv2.cvtColor(halo_strip, _GRAYSCALE_CONVERSIONS[channels])
+
+            first_row = strip_start - halo_start
+            strip = halo_strip[first_row:first_row + strip_end - strip_start]
+            gray_strip = gray_halo_strip[first_row:first_row + strip_end - strip_start]
+
+            # cv2 reductions accumulate in doubles, exact for strips of uint8 or int16 values
+            # noinspection PyUnresolvedReferences
+            strip_sums = _cv2.sumElems(strip)
+            for channel in range(len(channel_sums)):
+                channel_sums[channel] += int(strip_sums[channel])
+
+            # noinspection PyUnresolvedReferences
+            histogram += _cv2.calcHist([gray_strip], [0], None, [256], [0, 256]).ravel().astype(_numpy.int64)
+
+            # ksize 1 is the 3x3 kernel [0 1 0; 1 -4 1; 0 1 0]; its results fit int16
+            # noinspection PyUnresolvedReferences
+            laplacian = _cv2.Laplacian(gray_halo_strip, _cv2.CV_16S)[first_row:first_row + strip_end - strip_start]
+
+            # noinspection PyUnresolvedReferences
+            laplacian_sum += int(_cv2.sumElems(laplacian)[0])
+            # the squared norm comes back through a square root; a strip's sum is far below 2 ** 52, so
+            # rounding restores the exact integer
+            # noinspection PyUnresolvedReferences
+            laplacian_square_sum += round(_cv2.norm(laplacian, _cv2.NORM_L2SQR))
+
+        pixel_count = height * width
+        if channels == 1:
+            channel_means = (channel_sums[0] / pixel_count,) * 3
+        else:
+            channel_means = tuple(channel_sum / pixel_count for channel_sum in channel_sums)
+
+        # exact in integers up to the final division
+        laplacian_variance = (
+            (pixel_count * laplacian_square_sum - laplacian_sum * laplacian_sum) / (pixel_count * pixel_count)
+        )
+
+        return cls(
+            channel_means=channel_means,
+            histogram=histogram,
+            laplacian_variance=float(laplacian_variance)
+        )
+
+    @classmethod
+    def from_image(cls, image: _PillowImage) -> "ImageStatistics":
+        """
+        Statistics of a Pillow image; L, RGB and RGBA images are read as they are, other modes are converted
+        the way cv2 images are made from them.
+        :param image:
+        :return:
+        """
+        if image.mode in _DIRECT_MODES:
+            return cls.from_pixels(_numpy.asarray(image))
+
+        if image.mode == "1":
+            converted_image = image.convert("L")
+        elif image.mode in ("LA", "La", "PA", "Pa"):
+            converted_image = image.convert("RGBA")
+        else:
+            converted_image = image.convert("RGB")
+
+        try:
+            return cls.from_pixels(_numpy.asarray(converted_image))
+        finally:
+            converted_image.close()
+
+    @staticmethod
+    def channel_means_of(image: _PillowImage, stride: int = 1) -> tuple[float, float, float]:
+        """
+        Mean red, green and blue of a Pillow image, the same as those of image.convert("RGB"), without making
+        that copy: band histograms are read straight from Pillow and palette images are averaged over their
+        palette. Alpha is ignored, as the conversion drops it.
+        :param image:
+        :param stride: only measure every stride-th pixel of every stride-th row
+        :return:
+        """
+        if stride > 1:
+            width, height = image.size
+            size = (-(-width // stride), -(-height // stride))
+
+            # nearest neighbour resampling picks pixels on a regular grid without copying the rest
+            with image.resize(size, _Pillow.Resampling.NEAREST) as sampled_image:
+                return ImageStatistics.channel_means_of(sampled_image)
+
+        mode = image.mode
+
+        if mode in _PALETTE_MODES:
+            palette = _numpy.zeros((256, 3), dtype=_numpy.float64)
+            image_palette = _numpy.asarray(image.getpalette("RGB") or [], dtype=_numpy.float64).reshape(-1, 3)
+            palette[:len(image_palette)] = image_palette[:256]
+
+            counts = _numpy.asarray(image.histogram()[:256], dtype=_numpy.float64)
+            return tuple(float(mean) for mean in counts @ palette / counts.sum())
+
+        bands = _COLOR_BANDS.get(mode)
+        if bands is None:
+            # premultiplied alpha, high bit depths and other colour spaces go through the conversion
+            with image.convert("RGB") as converted_image:
+                return ImageStatistics.channel_means_of(converted_image)
+
+        histograms = _numpy.asarray(image.histogram(), dtype=_numpy.float64).reshape(-1, 256)[bands]
+        return tuple(float(mean) for mean in histograms @ _numpy.arange(256) / histograms[0].sum())
@@ -0,0 +1,97 @@
+import threading as _threading
+import time as _time
+from concurrent.futures import Future as _Future
+from typing import Callable as _Callable
+
+
+class MicroBatcher:
+    """
+    Collects items submitted by many worker threads and hands them to a single batch function, once
+    `max_batch_size` items are waiting or the oldest item has waited `max_wait_ms`. Each caller blocks
+    until the result for its own item is available.
+    """
+
+    def __init__(
+            self,
+            batch_fn: _Callable[[list[any]], list[any]],
+            max_batch_size: int = 16,
+            max_wait_ms: float = 50
+    ):
+        self._batch_fn = batch_fn
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait = max(0.0, max_wait_ms / 1000)
+
+        self._pending: list[tuple[any, _Future, float]] = []
+        self._condition = _threading.Condition()
+        self._shutdown = False
+
+        self._batch_count = 0
+        self._item_count = 0
+
+        self._thread = _threading.Thread(target=self._thread_fn, daemon=True)
+        self._thread.start()
+
+    @property
+    def average_batch_size(self) -> float:
+        return self._item_count / self._batch_count if self._batch_count else 0
+
+    def submit(self, item: any) -> any:
+        future = _Future()
+
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Batcher shutdown.")
+
+            self._pending.append((item, future, _time.monotonic()))
+            self._condition.notify_all()
+
+        return future.result()
+
+    def _next_batch(self) -> list[tuple[any, _Future, float]]:
+        with self._condition:
+            while not self._shutdown:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+
+                if len(self._pending) >= self._max_batch_size:
+                    break
+
+                remaining = self._pending[0][2] + self._max_wait - _time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self._condition.wait(remaining)
+
+            batch = self._pending[:self._max_batch_size]
+            del self._pending[:self._max_batch_size]
+
+            return batch
+
+    def _thread_fn(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                if self._shutdown:
+                    return
+
+                continue
+
+            items = [item for item, _, _ in batch]
+
+            try:
+                results = self._batch_fn(items)
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+
+            self._batch_count += 1
+            self._item_count += len(batch)
+
+    def shutdown(self):
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
@@ -0,0 +1,103 @@
+import threading as _threading
+from typing import Optional as _Optional
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return (hash_a ^ hash_b).bit_count()
+
+
+class _BKNode:
+    __slots__ = ("hash", "values", "children")
+
+    def __init__(self, image_hash: int):
+        self.hash = image_hash
+        self.values: list[any] = []
+        self.children: dict[int, "_BKNode"] = {}
+
+
+class PerceptualHashIndex:
+    """
+    BK-tree over perceptual hashes for Hamming radius queries. Children of a node are keyed by their
+    distance to it, so by the triangle inequality a query only descends into children whose key lies
+    within the radius of the query's own distance to the node; most of the tree is never visited.
+    Removing a value leaves its node in place as part of the tree structure. Safe to use from several
+    threads.
+    """
+
+    def __init__(self):
+        self._root: _Optional[_BKNode] = None
+        self._lock = _threading.RLock()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def lock(self) -> _threading.RLock:
+        """Hold while combining several calls that must see a consistent index, e.g. query then add."""
+        return self._lock
+
+    def add(self, image_hash: int, value: any):
+        with self._lock:
+            self._count += 1
+
+            if self._root is None:
+                self._root = _BKNode(image_hash)
+                self._root.values.append(value)
+                return
+
+            node = self._root
+            while True:
+                distance = hamming_distance(image_hash, node.hash)
+                if distance == 0:
+                    node.values.append(value)
+                    return
+
+                child = node.children.get(distance)
+                if child is None:
+                    child = _BKNode(image_hash)
+                    child.values.append(value)
+                    node.children[distance] = child
+                    return
+
+                node = child
+
+    def query(self, image_hash: int, radius: int) -> list[tuple[int, any, int]]:
+        """
+        All values stored within the given Hamming distance of a hash.
+        :param image_hash:
+        :param radius: maximum number of differing bits
+        :return: (hash, value, distance) of every match
+        """
+        matches: list[tuple[int, any, int]] = []
+
+        with self._lock:
+            if self._root is None:
+                return matches
+
+            nodes = [self._root]
+            while nodes:
+                node = nodes.pop()
+                distance = hamming_distance(image_hash, node.hash)
+
+                if distance <= radius:
+                    matches.extend((node.hash, value, distance) for value in node.values)
+
+                for child_distance, child in node.children.items():
+                    if distance - radius <= child_distance <= distance + radius:
+                        nodes.append(child)
+
+        return matches
+
+    def remove(self, image_hash: int, value: any) -> bool:
+        with self._lock:
+            node = self._root
+            while node is not None and node.hash != image_hash:
+                node = node.children.get(hamming_distance(image_hash, node.hash))
+
+            if node is None or value not in node.values:
+                return False
+
+            node.values.remove(value)
+            self._count -= 1
+            return True
@@ -0,0 +1,68 @@
+import numpy as _numpy
+import PIL.Image as _Pillow
+from PIL.Image import Image as _PillowImage
+
+
+class PerceptualHasher:
+    """
+    Computes DCT perceptual hashes (pHash) and difference hashes (dHash) for many images at once. Hashes are
+    computed from grayscale thumbnails stacked into one array, with a single matrix product for the DCT of the
+    whole batch. Results are bit for bit those of imagehash.phash and imagehash.dhash, packed into integers
+    with the first bit as the most significant one, the order of imagehash's hex strings.
+    """
+
+    _ZERO_TOLERANCE = 1e-6
+
+    def __init__(self, hash_size: int = 8, highfreq_factor: int = 4):
+        self.hash_size = hash_size
+        self.phash_thumbnail_size = (hash_size * highfreq_factor, hash_size * highfreq_factor)
+        self.dhash_thumbnail_size = (hash_size + 1, hash_size)
+
+        # rows of the unnormalised DCT-II matrix for the lowest frequencies; scaling does not move the median
+        image_size = hash_size * highfreq_factor
+        frequencies = _numpy.arange(hash_size)[:, None]
+        samples = _numpy.arange(image_size)[None, :]
+        self._dct_matrix = _numpy.cos(_numpy.pi * frequencies * (2 * samples + 1) / (2 * image_size))
+
+    @staticmethod
+    def thumbnail(image: _PillowImage, size: tuple[int, int]) -> _numpy.ndarray:
+        """
+        Grayscale thumbnail of an image as a uint8 array, downscaled the way imagehash does it.
+        :param image:
+        :param size: (width, height)
+        :return:
+        """
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGB")
+
+        with image.convert("L") as grayscale_image, grayscale_image.resize(size, _Pillow.LANCZOS) as thumbnail:
+            return _numpy.asarray(thumbnail, dtype=_numpy.uint8)
+
+    def _pack(self, bits: _numpy.ndarray) -> _numpy.ndarray:
+        packed = _numpy.packbits(bits.reshape(len(bits), -1), axis=1)
+        return packed.view(">u8").reshape(-1).astype(_numpy.uint64)
+
+    def phash(self, thumbnails: _numpy.ndarray) -> _numpy.ndarray:
+        """
+        :param thumbnails: (N, height, width) stack of phash_thumbnail_size grayscale thumbnails
+        :return: N hashes as uint64
+        """
+        pixels = thumbnails.astype(_numpy.float64)
+
+        # lowest frequencies of the 2D DCT of every thumbnail: D @ X @ D.T, broadcast over the batch
+        low_frequencies = self._dct_matrix @ pixels @ self._dct_matrix.T
+
+        # coefficients of flat rows or columns come out of an FFT as exact zeros but out of a matrix product
+        # as rounding noise, which would flip their bits whenever the median is zero as well
+        low_frequencies[_numpy.abs(low_frequencies) < self._ZERO_TOLERANCE] = 0
+
+        medians = _numpy.median(low_frequencies.reshape(len(low_frequencies), -1), axis=1)
+        return self._pack(low_frequencies > medians[:, None, None])
+
+    def dhash(self, thumbnails: _numpy.ndarray) -> _numpy.ndarray:
+        """
+        :param thumbnails: (N, height, width) stack of dhash_thumbnail_size grayscale thumbnails
+        :return: N hashes as uint64
+        """
+        pixels = thumbnails.astype(_numpy.int16)
+        return self._pack(pixels[:, :, 1:] > pixels[:, :, :-1])
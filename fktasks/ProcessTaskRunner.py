@@ -0,0 +1,277 @@
+import collections as _collections
+import multiprocessing as _multiprocessing
+import multiprocessing.util as _multiprocessing_util
+import queue as _queue
+from concurrent.futures import Future as _Future, ProcessPoolExecutor as _ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory as _SharedMemory
+from typing import Optional
+
+import PIL.Image as _Pillow
+from PIL.Image import Image as _PillowImage
+
+from fktasks.FkTask import FkImage as _FkImage, FkTask as _FkTask
+
+
+@dataclass
+class _SharedImageBuffer:
+    """Raw pixel data of an image placed in a shared memory block, so it can cross process boundaries."""
+    name: str
+    mode: str
+    size: tuple[int, int]
+    length: int
+    info: dict
+    offset: int = 0
+
+    @classmethod
+    def create(cls, image: _PillowImage) -> tuple["_SharedImageBuffer", _SharedMemory]:
+        pixel_data = image.tobytes("raw", image.mode)
+
+        shared_memory = _SharedMemory(create=True, size=max(1, len(pixel_data)))
+        shared_memory.buf[:len(pixel_data)] = pixel_data
+
+        info = {k: v for k, v in image.info.items() if isinstance(v, (str, bytes, int, float, tuple))}
+        descriptor = cls(shared_memory.name, image.mode, image.size, len(pixel_data), info)
+
+        return descriptor, shared_memory
+
+    def load(self, unlink: bool = False) -> _PillowImage:
+        shared_memory = _SharedMemory(name=self.name)
+        try:
+            image = _Pillow.frombuffer(
+                self.mode, self.size, shared_memory.buf[self.offset:self.offset + self.length], "raw", self.mode, 0, 1
+            ).copy()  # detach from the shared block before it is closed
+            image.info.update(self.info)
+            return image
+
+        finally:
+            shared_memory.close()
+            if unlink:
+                shared_memory.unlink()
+
+
+@dataclass
+class _SharedDataBuffer:
+    """Encoded file contents placed in a shared memory block, for images without a file the worker can read."""
+    name: str
+    length: int
+
+    @classmethod
+    def create(cls, data: bytes) -> tuple["_SharedDataBuffer", _SharedMemory]:
+        shared_memory = _SharedMemory(create=True, size=max(1, len(data)))
+        shared_memory.buf[:len(data)] = data
+
+        return cls(shared_memory.name, len(data)), shared_memory
+
+    def load(self) -> bytes:
+        shared_memory = _SharedMemory(name=self.name)
+        try:
+            return bytes(shared_memory.buf[:self.length])
+        finally:
+            shared_memory.close()
+
+
+class _SharedDataFuture(_Future):
+    """Contents of a shared data buffer, only copied into the worker once a task reads them."""
+
+    def __init__(self, data_buffer: _SharedDataBuffer):
+        super().__init__()
+        self._data_buffer = data_buffer
+
+    def result(self, timeout=None) -> bytes:
+        if not self.done():
+            self.set_result(self._data_buffer.load())
+
+        return super().result(timeout)
+
+
+@dataclass
+class _ProcessJob:
+    filepath: str
+    caption_text: Optional[str]
+    image_buffer: Optional[_SharedImageBuffer]
+    modified: bool = False
+    data_buffer: Optional[_SharedDataBuffer] = None
+
+
+@dataclass
+class _ProcessResult:
+    accepted: bool
+    caption_text: Optional[str]
+    image_buffer: Optional[_SharedImageBuffer]
+    scores: dict[str, float]
+
+    # observations of the last batch of images, None in between
+    observations: any = None
+
+
+# images a worker processes before sending back what the task observed; the rest follows when it exits
+_OBSERVATION_BATCH_SIZE = 256
+
+_worker_task: Optional[_FkTask] = None
+_worker_observation_queue: Optional[_multiprocessing.Queue] = None
+_worker_unreported_images = 0
+
+# Result blocks created by this worker; on Windows a block disappears with its last handle, so keep a
+# handful open until the parent process has had time to attach to them.
+_worker_result_blocks: _collections.deque = _collections.deque(maxlen=64)
+
+
+def _report_observations():
+    _worker_observation_queue.put(_worker_task.drain_observations())
+
+
+def _initialize_worker(task: _FkTask, observation_queue: _multiprocessing.Queue):
+    global _worker_task, _worker_observation_queue
+    _worker_task = task
+    _worker_observation_queue = observation_queue
+
+    # runs as the worker process exits, before the queue flushes what was put into it
+    _multiprocessing_util.Finalize(None, _report_observations, exitpriority=10)
+
+
+def _process_in_worker(job: _ProcessJob) -> _ProcessResult:
+    image = None
+    if job.image_buffer is not None:
+        image = job.image_buffer.load()
+
+    fk_image = _FkImage(job.filepath, image=image, caption_text=job.caption_text)
+
+    # noinspection PyProtectedMember
+    fk_image._modified_image = job.modified
+
+    if job.data_buffer is not None:
+        # noinspection PyProtectedMember
+        fk_image._in_memory = True
+        # noinspection PyProtectedMember
+        fk_image._data_future = _SharedDataFuture(job.data_buffer)
+
+    accepted = _worker_task.process(fk_image)
+
+    global _worker_unreported_images
+    _worker_unreported_images += 1
+
+    observations = None
+    if _worker_unreported_images >= _OBSERVATION_BATCH_SIZE:
+        observations = _worker_task.drain_observations()
+        _worker_unreported_images = 0
+
+    result_buffer = None
+    # noinspection PyProtectedMember
+    if accepted and fk_image._modified_image and fk_image._image is not image:
+        # noinspection PyProtectedMember
+        result_buffer, shared_memory = _SharedImageBuffer.create(fk_image._image)
+        _worker_result_blocks.append(shared_memory)
+
+    # noinspection PyProtectedMember
+    result = _ProcessResult(
+        accepted=bool(accepted),
+        caption_text=fk_image._caption_text if accepted else None,
+        image_buffer=result_buffer,
+        scores=fk_image.scores,
+        observations=observations
+    )
+
+    fk_image.destroy()
+    return result
+
+
+class ProcessTaskRunner:
+    """
+    Runs a task in a pool of worker processes instead of the calling thread, side-stepping the GIL for
+    pure Python work. Images travel by path; modified pixel data is handed over through shared memory, as are
+    the decoded frame and the encoded contents of images without a file of their own. What the task observes
+    in a worker comes back in batches and once more when the worker exits, on shutdown.
+    """
+
+    def __init__(self, task: _FkTask, max_workers: int):
+        self._task = task
+
+        mp_context = _multiprocessing.get_context("spawn")
+
+        # what workers observed since their last batch, sent once each as they exit
+        self._observation_queue = mp_context.Queue()
+
+        self._executor = _ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=mp_context,
+            initializer=_initialize_worker,
+            initargs=(task, self._observation_queue)
+        )
+
+    @staticmethod
+    def _arena_frame(image: _FkImage) -> Optional[_SharedImageBuffer]:
+        """The frame of an image in the cache arena, which the worker reads in place; None if not decoded there."""
+        # noinspection PyProtectedMember
+        shared_frame = image._global_cache.get_shared_frame(image.filepath) if image._global_cache else None
+        if not shared_frame:
+            return None
+
+        name, offset, length, mode, size = shared_frame
+        return _SharedImageBuffer(name, mode, size, length, {}, offset)
+
+    def process(self, image: _FkImage) -> bool:
+        image_buffer = None
+        data_buffer = None
+        shared_memory_blocks: list[_SharedMemory] = []
+
+        try:
+            # noinspection PyProtectedMember
+            if image._modified_image:
+                image_buffer = self._arena_frame(image)
+                if image_buffer is None:
+                    image_buffer, shared_memory = _SharedImageBuffer.create(image.image)
+                    shared_memory_blocks.append(shared_memory)
+
+            # noinspection PyProtectedMember
+            if image._in_memory:
+                # no file the worker could read: pass the frame if decoded already, and the contents for
+                # anything else, through shared memory rather than pickling whole files
+                if image_buffer is None:
+                    image_buffer = self._arena_frame(image)
+
+                # noinspection PyProtectedMember
+                data_buffer, shared_memory = _SharedDataBuffer.create(image._data_future.result())
+                shared_memory_blocks.append(shared_memory)
+
+            # the worker cannot look up captions of images without a file of their own, resolve it here
+            # noinspection PyProtectedMember
+            job = _ProcessJob(image.filepath, image.caption_text, image_buffer, image._modified_image, data_buffer)
+            result: _ProcessResult = self._executor.submit(_process_in_worker, job).result()
+
+        finally:
+            for shared_memory in shared_memory_blocks:
+                shared_memory.close()
+                shared_memory.unlink()
+
+        if result.observations is not None:
+            self._task.merge_observations(result.observations)
+        image.scores.update(result.scores)
+
+        if result.caption_text is not None:
+            image.caption_text = result.caption_text
+
+        if result.image_buffer is not None:
+            image.image = result.image_buffer.load(unlink=True)
+
+        return result.accepted
+
+    def shutdown(self):
+        # noinspection PyProtectedMember
+        processes = list((self._executor._processes or {}).values())
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+        # read while the workers exit, a worker cannot finish before what it reports fits in the pipe
+        while True:
+            try:
+                observations = self._observation_queue.get(timeout=0.1)
+            except _queue.Empty:
+                if any(process.is_alive() for process in processes):
+                    continue
+
+                break
+
+            if observations is not None:
+                self._task.merge_observations(observations)
+
+        self._observation_queue.close()
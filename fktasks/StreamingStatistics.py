@@ -0,0 +1,190 @@
+import math as _math
+import threading as _threading
+
+import numpy as _numpy
+
+
+class StreamingStatistics:
+    """
+    Running statistics of a stream of values in constant memory: an exact count, mean, variance, minimum and
+    maximum (Welford), and a fixed-bin histogram for approximate percentiles. Bins are spaced linearly, or
+    logarithmically for values spanning orders of magnitude; values outside the range are counted below the
+    first or above the last bin. Safe to update from several threads; instances of the same layout can be
+    merged, e.g. the statistics gathered in worker processes.
+    """
+
+    def __init__(self, lower: float, upper: float, bin_count: int = 2048, log_scale: bool = False):
+        """
+        :param lower: lower edge of the first bin; must be positive for log scale bins
+        :param upper: upper edge of the last bin
+        :param bin_count:
+        :param log_scale: space bins logarithmically
+        """
+        if log_scale and lower <= 0:
+            raise ValueError("log scale bins need a positive lower edge")
+
+        if upper <= lower:
+            raise ValueError("upper edge must be above the lower edge")
+
+        self._lower = lower
+        self._upper = upper
+        self._bin_count = bin_count
+        self._log_scale = log_scale
+
+        self._scaled_lower = _math.log(lower) if log_scale else lower
+        self._bin_scale = bin_count / ((_math.log(upper) if log_scale else upper) - self._scaled_lower)
+
+        self._lock = _threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # bin 0 counts values below the range, the last one values above it
+        self._counts = _numpy.zeros(self._bin_count + 2, dtype=_numpy.int64)
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._minimum = _math.inf
+        self._maximum = -_math.inf
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = _threading.Lock()
+
+    def _bin(self, value: float) -> int:
+        if value < self._lower:
+            return 0
+
+        if value >= self._upper:
+            return self._bin_count + 1
+
+        scaled_value = _math.log(value) if self._log_scale else value
+        return min(int((scaled_value - self._scaled_lower) * self._bin_scale), self._bin_count - 1) + 1
+
+    def _edge(self, index: int) -> float:
+        scaled_edge = self._scaled_lower + index / self._bin_scale
+        return _math.exp(scaled_edge) if self._log_scale else scaled_edge
+
+    def add(self, value: float):
+        value = float(value)
+        if _math.isnan(value):
+            return
+
+        index = self._bin(value)
+
+        with self._lock:
+            self._counts[index] += 1
+
+            self._count += 1
+            delta = value - self._mean
+            self._mean += delta / self._count
+            self._m2 += delta * (value - self._mean)
+
+            self._minimum = min(self._minimum, value)
+            self._maximum = max(self._maximum, value)
+
+    def merge(self, other: "StreamingStatistics"):
+        """
+        Add the values of other statistics with the same bins to these.
+        :param other:
+        :return:
+        """
+        if (other._lower, other._upper, other._bin_count, other._log_scale) != \
+                (self._lower, self._upper, self._bin_count, self._log_scale):
+            raise ValueError("cannot merge statistics with different bins")
+
+        with other._lock:
+            counts = other._counts.copy()
+            count, mean, m2 = other._count, other._mean, other._m2
+            minimum, maximum = other._minimum, other._maximum
+
+        if not count:
+            return
+
+        with self._lock:
+            self._counts += counts
+
+            # Chan et al.: combine means and sums of squared deviations of both parts
+            total_count = self._count + count
+            delta = mean - self._mean
+            self._mean += delta * count / total_count
+            self._m2 += m2 + delta * delta * self._count * count / total_count
+            self._count = total_count
+
+            self._minimum = min(self._minimum, minimum)
+            self._maximum = max(self._maximum, maximum)
+
+    def drain(self) -> "StreamingStatistics":
+        """
+        Move everything recorded so far into new statistics and start over.
+        :return:
+        """
+        drained = StreamingStatistics(self._lower, self._upper, self._bin_count, self._log_scale)
+
+        with self._lock:
+            drained._counts, drained._count, drained._mean, drained._m2 = \
+                self._counts, self._count, self._mean, self._m2
+            drained._minimum, drained._maximum = self._minimum, self._maximum
+
+            self._reset()
+
+        return drained
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def mean(self) -> float:
+        return self._mean if self._count else _math.nan
+
+    @property
+    def variance(self) -> float:
+        return self._m2 / self._count if self._count else _math.nan
+
+    @property
+    def standard_deviation(self) -> float:
+        return _math.sqrt(self.variance)
+
+    @property
+    def minimum(self) -> float:
+        return self._minimum if self._count else _math.nan
+
+    @property
+    def maximum(self) -> float:
+        return self._maximum if self._count else _math.nan
+
+    def percentile(self, q: float) -> float:
+        """
+        Approximate percentile, interpolated linearly inside the bin it falls into; exact to the width of a bin.
+        :param q: percentage, 0 - 100
+        :return: nan without values
+        """
+        with self._lock:
+            if not self._count:
+                return _math.nan
+
+            counts = self._counts.copy()
+            count, minimum, maximum = self._count, self._minimum, self._maximum
+
+        # rank as numpy.percentile puts it, between the first (0) and the last value (count - 1)
+        rank = q / 100 * (count - 1)
+        if rank <= 0:
+            return minimum
+
+        if rank >= count - 1:
+            return maximum
+
+        cumulative_counts = _numpy.cumsum(counts)
+        index = int(_numpy.searchsorted(cumulative_counts, rank, side="right"))
+
+        lower_edge = minimum if index == 0 else max(self._edge(index - 1), minimum)
+        upper_edge = maximum if index == self._bin_count + 1 else min(self._edge(index), maximum)
+
+        below = int(cumulative_counts[index - 1]) if index > 0 else 0
+        fraction = (rank - below + 0.5) / counts[index]
+
+        return float(lower_edge + (upper_edge - lower_edge) * min(max(fraction, 0.0), 1.0))
@@ -6,14 +6,24 @@ from fktasks.FkTask import (
     FkTask,
     FkTaskIntensiveness,
 )
+from fktasks.DecisionLedger import DecisionLedger
+from fktasks.FkImageMetadata import FkImageMetadata
 from fktasks.GlobalImageDataCache import GlobalImageDataCache
+from fktasks.ImageStatistics import ImageStatistics
+from fktasks.PerceptualHashIndex import PerceptualHashIndex
+from fktasks.StreamingStatistics import StreamingStatistics
 
 __all__ = [
+    "DecisionLedger",
     "FkTask",
     "FkImage",
+    "FkImageMetadata",
     "FkReportableTask",
     "FkTaskIntensiveness",
     "GlobalImageDataCache",
+    "ImageStatistics",
+    "PerceptualHashIndex",
+    "StreamingStatistics",
     "FkPipeline",
 ]
 
@@ -21,6 +31,9 @@ __all__ = [
 def __getattr__(name: str):
     if name == "FkPipeline":
         from .FkPipeline import FkPipeline
+
+        # importing the submodule binds it to the package attribute of the same name; rebind the class
+        globals()["FkPipeline"] = FkPipeline
         return FkPipeline
     raise AttributeError(f"module {__name__} has no attribute {name}")
 
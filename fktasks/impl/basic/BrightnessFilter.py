@@ -1,23 +1,22 @@
 import argparse as _argparse
 import math as _math
 
-import PIL.ImageStat as _PILImageStat
 import nicegui.element
-import numpy as _numpy
 from nicegui import ui
 
 import fkui.components
-import utils
-from fktasks import FkImage as _FkImage, FkTaskIntensiveness as _FkTaskIntensiveness
+from fktasks import FkImage as _FkImage, FkTaskIntensiveness as _FkTaskIntensiveness, \
+    ImageStatistics as _ImageStatistics, StreamingStatistics as _StreamingStatistics
 from fktasks.FkTask import FkReportableTask as _FkReportableTask
 
 
 class BrightnessFilter(_FkReportableTask):
 
-    def __init__(self, min_brightness_threshold: float = -1, max_brightness_threshold: float = -1):
+    def __init__(self, min_brightness_threshold: float = -1, max_brightness_threshold: float = -1, stride: int = 1):
         self._min_brightness_threshold = min_brightness_threshold
         self._max_brightness_threshold = max_brightness_threshold
-        self._brightnesses = []
+        self._stride = stride
+        self._brightnesses = _StreamingStatistics(0, 1)
 
     def register_args(self, arg_parser: _argparse.ArgumentParser):
         arg_parser.add_argument(
@@ -40,22 +39,27 @@ class BrightnessFilter(_FkReportableTask):
                  "default: -1 [disabled])"
         )
 
+        arg_parser.add_argument(
+            "--brightness-stride",
+            default=1,
+            type=int,
+            help="measure brightness on every n-th pixel of every n-th row only (default: 1 [every pixel])"
+        )
+
     def parse_args(self, args: _argparse.Namespace) -> bool:
         self._min_brightness_threshold = args.brightness_min_threshold
         self._max_brightness_threshold = args.brightness_max_threshold
+        self._stride = max(args.brightness_stride, 1)
 
         return 0 < self._min_brightness_threshold < self._max_brightness_threshold and self._max_brightness_threshold > 0
 
     def process(self, image: _FkImage) -> bool:
-        temp_image = image.image.convert("RGB")
-        image_stat = _PILImageStat.Stat(temp_image)
-
-        r, g, b = image_stat.mean
+        r, g, b = _ImageStatistics.channel_means_of(image.analysis_image(self.analysis_resolution), self._stride)
 
         perceived_brightness = _math.sqrt((0.241 * (r ** 2)) + (0.691 * (g ** 2)) + (0.068 * (b ** 2))) / 255
-        temp_image.close()
 
-        self._brightnesses.append(perceived_brightness)
+        self._brightnesses.add(perceived_brightness)
+        image.scores[self.name] = perceived_brightness
 
         if 0 < self._min_brightness_threshold > perceived_brightness:
             return False
@@ -65,13 +69,32 @@ class BrightnessFilter(_FkReportableTask):
 
         return True
 
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {
+            "min": self._min_brightness_threshold,
+            "max": self._max_brightness_threshold,
+            "stride": self._stride,
+            "analysis_resolution": self.analysis_resolution
+        }
+
+    @property
+    def analysis_resolution(self) -> int:
+        # the mean colour of an image barely changes when it is scaled down
+        return 256
+
+    def drain_observations(self) -> _StreamingStatistics:
+        return self._brightnesses.drain()
+
+    def merge_observations(self, observations: _StreamingStatistics):
+        self._brightnesses.merge(observations)
+
     def report(self) -> list[tuple[str, any]]:
         return [
             ("Filter Minimum Threshold", self._min_brightness_threshold),
             ("Filter Maximum Threshold", self._max_brightness_threshold),
             None,
-            ("Average Brightness", utils.safe_fn(lambda: _numpy.mean(self._brightnesses), -1)),
-            ("90th Percentile", utils.safe_fn(lambda: _numpy.percentile(self._brightnesses, 90), -1))
+            *self.score_report("Brightness", self._brightnesses)
         ]
 
     @property
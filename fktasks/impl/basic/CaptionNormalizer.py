@@ -5,29 +5,41 @@ from fktasks import FkTask as _FkTask, FkImage as _FkImage, FkTaskIntensiveness
 
 
 class CaptionNormalizer(_FkTask):
-    # noinspection GrazieInspection
-    _TEXT_REPLACEMENT = {
-        r"\:(\s+)?\d+(\.\d+)?": " ",  # remove weights ':1' and ':1.0', etc
-        r"\\\((\s+)?": "_---",  # replace escaped brackets (
-        r"(\s+)?\\\)": "---_",  # replace escaped brackets )
-        r"\\\[(\s+)?": "___-",  # replace escaped brackets [
-        r"(\s+)?\\\]": "-___",  # replace escaped brackets ]
-        r"[\(\)\[\]]": " ",  # remove left over brackets
-        "<.+?>": " ",  # remove loras - maybe find a better way to handle loras?
-        r"\\": "",  # remove slashes left over from escaped
-        r"\:": ", ",  # replace left colons as commas, can't trained merged tags
-        r"\|": ", ",  # replace pipes with commas, can't train dynamic or merged tags
-        r"\*": " ",  # remove asterisks
-        r"\.(?!\w)": ", ",  # remove periods but preserve things like y.o or 1.8
-        "[;'\"+]": ", ",  # remove extraneous punctuation
-        "[{}]": " ",  # remove brackets
-        r"\s+": " ",  # remove extra whitespace
-        "_---": "\\(",  # reverse escaped brackets (
-        "---_": "\\)",  # reverse escaped brackets )
-        "___-": "\\[",  # reverse escaped brackets [
-        "-___": "\\]",  # reverse escaped brackets ]
+    _WEIGHTS = _re.compile(r"\:(\s+)?\d+(\.\d+)?")  # weights ':1' and ':1.0', etc
+
+    # escaped brackets become placeholders that survive the punctuation passes, together with the whitespace
+    # inside them: after an opening bracket and before a closing one
+    _ESCAPED_BRACKETS = _re.compile(r"\\([(\[])\s*|\\([)\]])")
+    _ESCAPED_BRACKET_PLACEHOLDERS = {
+        "(": "_---",
+        ")": "---_",
+        "[": "___-",
+        "]": "-___"
     }
 
+    _LORAS = _re.compile("<.+?>")  # maybe find a better way to handle loras?
+
+    # literal replacements; none of them produces a character a later one replaces
+    # noinspection GrazieInspection
+    _PUNCTUATION_REPLACEMENTS = [
+        ("(", " "), (")", " "), ("[", " "), ("]", " "),  # left over brackets
+        ("\\", ""),  # slashes left over from escapes
+        (":", ", "),  # left over colons, can't train merged tags
+        ("|", ", "),  # pipes, can't train dynamic or merged tags
+        ("*", " "),
+        (";", ", "), ("'", ", "), ("\"", ", "), ("+", ", "),
+        ("{", " "), ("}", " ")
+    ]
+
+    _PERIODS = _re.compile(r"\.(?!\w)")  # preserve things like y.o or 1.8
+
+    _PLACEHOLDER_REVERSALS = [
+        ("_---", "\\("),
+        ("---_", "\\)"),
+        ("___-", "\\["),
+        ("-___", "\\]")
+    ]
+
     @classmethod
     def register_args(cls, arg_parser: _argparse.ArgumentParser):
         arg_parser.add_argument(
@@ -41,26 +53,62 @@ class CaptionNormalizer(_FkTask):
     def parse_args(self, args: _argparse.Namespace):
         return args.normalize_captions
 
-    def process(self, image: _FkImage) -> bool:
-        caption_text = image.caption_text
+    @staticmethod
+    def _replace_escaped_brackets(caption_text: str) -> str:
+        pieces: list[str] = []
+        position = 0
 
-        if caption_text:
-            caption_text = caption_text.lower()
-            for s, r in CaptionNormalizer._TEXT_REPLACEMENT.items():
-                caption_text = _re.sub(s, r, caption_text)
+        for match in CaptionNormalizer._ESCAPED_BRACKETS.finditer(caption_text):
+            opening_bracket, closing_bracket = match.groups()
+
+            piece = caption_text[position:match.start()]
+            if closing_bracket:
+                piece = piece.rstrip()
+
+            pieces.append(piece)
+            pieces.append(CaptionNormalizer._ESCAPED_BRACKET_PLACEHOLDERS[opening_bracket or closing_bracket])
+            position = match.end()
+
+        pieces.append(caption_text[position:])
+        return "".join(pieces)
+
+    @staticmethod
+    def normalize(caption_text: str) -> str:
+        """
+        Normalized caption text: lowercase, without weights, loras and punctuation, tags deduplicated.
+        :param caption_text:
+        :return:
+        """
+        caption_text = CaptionNormalizer._WEIGHTS.sub(" ", caption_text.lower())
+
+        if "\\" in caption_text:
+            caption_text = CaptionNormalizer._replace_escaped_brackets(caption_text)
 
-            normalized_tags: list[str] = []
-            caption_tags: list[str] = caption_text.split(',')
+        if "<" in caption_text:
+            caption_text = CaptionNormalizer._LORAS.sub(" ", caption_text)
 
-            for caption_tag in caption_tags:
-                caption_tag = caption_tag.strip()
+        for character, replacement in CaptionNormalizer._PUNCTUATION_REPLACEMENTS:
+            if character in caption_text:
+                caption_text = caption_text.replace(character, replacement)
 
-                if caption_tag not in normalized_tags:
-                    normalized_tags.append(caption_tag)
+        caption_text = CaptionNormalizer._PERIODS.sub(", ", caption_text)
 
-            if normalized_tags:
-                caption_text = ", ".join(normalized_tags).strip()
-                image.caption_text = caption_text
+        # collapse whitespace; leading and trailing whitespace is stripped from every tag below anyway
+        caption_text = " ".join(caption_text.split())
+
+        for placeholder, escaped_bracket in CaptionNormalizer._PLACEHOLDER_REVERSALS:
+            if placeholder in caption_text:
+                caption_text = caption_text.replace(placeholder, escaped_bracket)
+
+        # dictionaries keep insertion order, the first occurrence of every tag stays in place
+        normalized_tags = dict.fromkeys(caption_tag.strip() for caption_tag in caption_text.split(","))
+        return ", ".join(normalized_tags).strip()
+
+    def process(self, image: _FkImage) -> bool:
+        caption_text = image.caption_text
+
+        if caption_text:
+            image.caption_text = CaptionNormalizer.normalize(caption_text)
 
         return True
 
@@ -68,6 +116,14 @@ class CaptionNormalizer(_FkTask):
     def priority(self) -> int:
         return 200
 
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {}
+
+    @property
+    def pure(self) -> bool:
+        return False
+
     @property
     def intensiveness(self) -> _FkTaskIntensiveness:
         return _FkTaskIntensiveness.LOW
@@ -90,8 +90,9 @@ class ImageFilter(_FkReportableTask):
         )
 
     def process(self, image: _FkImage) -> bool:
-        width, height = image.image.size
-        mode = image.image.mode
+        metadata = image.metadata
+        width, height = metadata.size
+        mode = metadata.mode
 
         if self.modes and mode not in self.modes:
             if mode not in self._invalid_modes:
@@ -124,6 +125,24 @@ class ImageFilter(_FkReportableTask):
 
         return True
 
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {
+            "minimum_dimensions": self.minimum_dimensions,
+            "maximum_dimensions": self.maximum_dimensions,
+            "square_images": self.square_images,
+            "modes": self.modes
+        }
+
+    def drain_observations(self) -> list[str]:
+        observations, self._invalid_modes = self._invalid_modes, []
+        return observations
+
+    def merge_observations(self, observations: list[str]):
+        for mode in observations:
+            if mode not in self._invalid_modes:
+                self._invalid_modes.append(mode)
+
     def report(self) -> list[tuple[str, any]]:
         report_items: list[_Optional[tuple[str, any]]] = [
             ("Require square images", self.square_images)
@@ -152,6 +171,10 @@ class ImageFilter(_FkReportableTask):
     def priority(self) -> int:
         return 500
 
+    @property
+    def pure(self) -> bool:
+        return not self.square_images  # square images may be resized
+
     @property
     def intensiveness(self) -> _FkTaskIntensiveness:
         return _FkTaskIntensiveness.LOW
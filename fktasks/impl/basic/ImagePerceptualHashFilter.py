@@ -1,20 +1,43 @@
 import argparse as _argparse
 
-import imagehash as _imagehash
+import numpy as _numpy
 
 from fktasks import FkImage as _FkImage
 from fktasks.FkTask import FkTask as _FkTask
+from fktasks.MicroBatcher import MicroBatcher as _MicroBatcher
+from fktasks.PerceptualHashIndex import hamming_distance as _hamming_distance
+from fktasks.PerceptualHasher import PerceptualHasher as _PerceptualHasher
 
 
 class ImagePerceptualHashFilter(_FkTask):
     _BLACKLIST_PHASHES = [
         # ALL BLACK 512x512
-        "0000000000000000",
+        0x0000000000000000,
 
         # ALL WHITE 512x512
-        "8000000000000000"
+        0x8000000000000000
     ]
 
+    def __init__(self, batch_size: int = 16, batch_wait_ms: float = 2):
+        self._hasher = _PerceptualHasher()
+        self._batcher = None
+        self._batch_size = batch_size
+        self._batch_wait_ms = batch_wait_ms
+
+    def __getstate__(self):
+        # worker processes hash the one image they are given, batching only spans threads of this process
+        state = self.__dict__.copy()
+        state["_batcher"] = None
+        return state
+
+    def initialize(self):
+        if self._batch_size > 1:
+            self._batcher = _MicroBatcher(self._hash_batch, self._batch_size, self._batch_wait_ms)
+
+    def shutdown(self):
+        if self._batcher is not None:
+            self._batcher.shutdown()
+
     def register_args(self, arg_parser: _argparse.ArgumentParser):
         arg_parser.add_argument(
             "--phash",
@@ -24,23 +47,48 @@ class ImagePerceptualHashFilter(_FkTask):
             help="generate a phase of an image and remove images that are similar or close mostly white or mostly black. "
                  "(default: False)"
         )
-        
+
+        arg_parser.add_argument(
+            "--phash-batch-size",
+            default=16,
+            type=int,
+            help="maximum number of images hashed together in one batch; 1 hashes every image on its own "
+                 "(default: 16)"
+        )
 
     def parse_args(self, args: _argparse.Namespace) -> bool:
+        self._batch_size = max(1, args.phash_batch_size)
         return args.phash
 
+    def _hash_batch(self, thumbnails: list[_numpy.ndarray]) -> list[int]:
+        return [int(image_phash) for image_phash in self._hasher.phash(_numpy.stack(thumbnails))]
+
     def process(self, image: _FkImage) -> bool:
-        working_image = image.image.convert("RGB")
-        image_phash = _imagehash.phash(working_image, 8)
+        if self._batcher is not None:
+            # the thumbnail is made on the calling worker thread, only the DCT is batched
+            thumbnail = image.thumbnail(self._hasher.phash_thumbnail_size, self.analysis_resolution)
+            image.perceptual_hash = self._batcher.submit(thumbnail)
 
-        working_image.close()
+        image_phash = image.perceptual_hash
 
         for blacklist_hash in ImagePerceptualHashFilter._BLACKLIST_PHASHES:
-            if _imagehash.hex_to_hash(blacklist_hash) - image_phash <= 12:
+            if _hamming_distance(blacklist_hash, image_phash) <= 12:
                 return False
 
         return True
 
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {"analysis_resolution": self.analysis_resolution}
+
+    @property
+    def analysis_resolution(self) -> int:
+        return _FkImage.PERCEPTUAL_HASH_RESOLUTION
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
     @property
     def priority(self) -> int:
         return 700
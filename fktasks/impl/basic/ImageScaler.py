@@ -29,6 +29,14 @@ class ImageScaler(_FkTask):
     def priority(self) -> int:
         return 600
 
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {"max_size": self._max_size}
+
+    @property
+    def pure(self) -> bool:
+        return False
+
     @property
     def intensiveness(self) -> _FkTaskIntensiveness:
         return _FkTaskIntensiveness.LOW
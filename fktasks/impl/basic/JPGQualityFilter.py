@@ -1,14 +1,10 @@
 import argparse as _argparse
 
 import nicegui.element
-import numpy as _numpy
-from PIL.Image import Image as _PillowImage
-from PIL.JpegImagePlugin import JpegImageFile as _PillowJPG
 from nicegui import ui
 
-import utils
 from fktasks import FkReportableTask as _FkReportableTask, FkImage as _FkImage, \
-    FkTaskIntensiveness as _FkTaskIntensiveness
+    FkTaskIntensiveness as _FkTaskIntensiveness, StreamingStatistics as _StreamingStatistics
 
 
 class JPGQualityFilter(_FkReportableTask):
@@ -73,7 +69,7 @@ class JPGQualityFilter(_FkReportableTask):
 
     def __init__(self, jpg_quality_threshold: int = -1):
         self._jpg_quality_threshold = jpg_quality_threshold
-        self._qualities = []
+        self._qualities = _StreamingStatistics(-0.5, 100.5, bin_count=101)
 
     def register_args(self, arg_parser: _argparse.ArgumentParser):
         arg_parser.add_argument(
@@ -89,26 +85,35 @@ class JPGQualityFilter(_FkReportableTask):
         return self._jpg_quality_threshold >= 0
 
     def process(self, image: _FkImage) -> bool:
-        if isinstance(image.image, _PillowJPG):
-            # apparently image extensions don't mean shit, PIL will
-            # open w.e even named wrong, so check instance type instead
+        # apparently image extensions don't mean shit, PIL will
+        # open w.e even named wrong, so the file contents decide
+        quantization = image.jpeg_quantization
+        if quantization is None:
+            return True
 
-            jpeg_quality = JPGQualityFilter._get_jpg_quality(image.image)
-            if jpeg_quality >= 0:
-                self._qualities.append(jpeg_quality)
-                return jpeg_quality >= self._jpg_quality_threshold
+        jpeg_quality = JPGQualityFilter._get_jpg_quality(quantization)
+        if jpeg_quality >= 0:
+            self._qualities.add(jpeg_quality)
+            image.scores[self.name] = jpeg_quality
+            return jpeg_quality >= self._jpg_quality_threshold
 
-            return True  # unknown quality
+        return True  # unknown quality
 
-        else:
-            return True
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {"threshold": self._jpg_quality_threshold}
+
+    def drain_observations(self) -> _StreamingStatistics:
+        return self._qualities.drain()
+
+    def merge_observations(self, observations: _StreamingStatistics):
+        self._qualities.merge(observations)
 
     def report(self) -> list[tuple[str, any]]:
         return [
             ("Filter Threshold", self._jpg_quality_threshold),
             None,
-            ("Average Quality", utils.safe_fn(lambda: int(_numpy.mean(self._qualities)), -1)),
-            ("90th Percentile", utils.safe_fn(lambda: _numpy.percentile(self._qualities, 90), -1))
+            *self.score_report("Quality", self._qualities)
         ]
 
     @property
@@ -117,7 +122,7 @@ class JPGQualityFilter(_FkReportableTask):
 
     @property
     def intensiveness(self) -> _FkTaskIntensiveness:
-        return _FkTaskIntensiveness.MEDIUM
+        return _FkTaskIntensiveness.LOW
 
     @classmethod
     def webui_config(cls, *args, **kwargs) -> tuple[nicegui.element.Element, list[nicegui.element.Element]]:
@@ -142,7 +147,7 @@ class JPGQualityFilter(_FkReportableTask):
         pass
 
     @classmethod
-    def _get_jpg_quality(cls, image: _PillowImage) -> int:
+    def _get_jpg_quality(cls, qdict: dict[int, list[int]]) -> int:
         """
         Stolen from gist
         https://gist.github.com/eddy-geek/c0f01dc5401dc50a49a0a821cdc9b3e8#file-jpg_quality_pil_magick-py
@@ -151,21 +156,15 @@ class JPGQualityFilter(_FkReportableTask):
         https://github.com/ImageMagick/ImageMagick/blob/7.1.0-57/coders/jpeg.c#L782
         Usage:
         ```
-        pim = Img.open(...)
-        quality = get_jpg_quality(pim)
+        quality = get_jpg_quality(FkImageMetadata.read_jpeg_quantization(jpeg_file))
         ```
         See also https://stackoverflow.com/questions/4354543/
+
+        :param qdict: quantization tables by id, in natural order
         """
 
         qsum = 0
 
-        # noinspection PyBroadException
-        try:
-            # noinspection PyUnresolvedReferences
-            qdict = image.quantization
-        except Exception:
-            return -2
-
         for i, qtable in qdict.items():
             qsum += sum(qtable)
 
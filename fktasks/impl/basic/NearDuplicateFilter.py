@@ -0,0 +1,142 @@
+import argparse as _argparse
+
+import nicegui.element
+import nicegui.elements.mixins.value_element
+from nicegui import ui
+
+from fktasks import FkImage as _FkImage, FkTaskIntensiveness as _FkTaskIntensiveness
+from fktasks.FkTask import FkReportableTask as _FkReportableTask
+from fktasks.PerceptualHashIndex import PerceptualHashIndex as _PerceptualHashIndex
+
+
+class NearDuplicateFilter(_FkReportableTask):
+    """
+    Keeps one image out of every group of near-duplicates in the dataset, the one with the highest source
+    resolution. Images are compared by the Hamming distance of their perceptual hashes, looked up in a BK-tree
+    of every image accepted so far. When a better copy of an accepted image arrives later, the earlier one is
+    retracted from the output.
+    """
+
+    def __init__(self, max_distance: int = -1):
+        self._max_distance = max_distance
+        self._index = _PerceptualHashIndex()
+
+        self._duplicate_count = 0
+        self._replaced_count = 0
+
+    def register_args(self, arg_parser: _argparse.ArgumentParser):
+        arg_parser.add_argument(
+            "--near-duplicates",
+            default=False,
+            action="store_true",
+            required=False,
+            help="keep only the highest resolution image out of every group of near-duplicate images, "
+                 "compared by perceptual hash (default: False)"
+        )
+
+        arg_parser.add_argument(
+            "--near-duplicate-distance",
+            default=6,
+            type=int,
+            help="maximum number of differing perceptual hash bits (out of 64) for two images to be "
+                 "near-duplicates (default: 6)"
+        )
+
+    def parse_args(self, args: _argparse.Namespace) -> bool:
+        self._max_distance = args.near_duplicate_distance
+        return args.near_duplicates and self._max_distance >= 0
+
+    def process(self, image: _FkImage) -> bool:
+        image_phash = image.perceptual_hash
+
+        source_metadata = image.source_metadata
+        quality = source_metadata.width * source_metadata.height
+
+        with self._index.lock:
+            matches = self._index.query(image_phash, self._max_distance)
+
+            if matches and quality <= max(match_quality for _, (_, match_quality), _ in matches):
+                self._duplicate_count += 1
+                return False
+
+            retracted_all = True
+            for match_phash, match, _ in matches:
+                match_filepath, _ = match
+
+                if self.retract(match_filepath):
+                    self._index.remove(match_phash, match)
+                    self._replaced_count += 1
+                else:
+                    retracted_all = False
+
+            if not retracted_all:  # the output cannot drop images it holds; keep the copy that is already there
+                self._duplicate_count += 1
+                return False
+
+            self._index.add(image_phash, (image.filepath, quality))
+
+        return True
+
+    def report(self) -> list[tuple[str, any]]:
+        return [
+            ("Maximum Hash Distance", self._max_distance),
+            None,
+            ("Near-Duplicates Discarded", self._duplicate_count),
+            ("Replaced By Higher Resolution Copy", self._replaced_count),
+            ("Unique Images", len(self._index))
+        ]
+
+    @property
+    def analysis_resolution(self) -> int:
+        return _FkImage.PERCEPTUAL_HASH_RESOLUTION
+
+    @property
+    def pure(self) -> bool:
+        return False
+
+    @property
+    def process_safe(self) -> bool:
+        return False
+
+    @property
+    def retracts_images(self) -> bool:
+        return True
+
+    @property
+    def priority(self) -> int:
+        # after every other filter, so only images that are otherwise kept enter the index
+        return 1_000_000
+
+    @property
+    def intensiveness(self) -> _FkTaskIntensiveness:
+        return _FkTaskIntensiveness.LOW
+
+    @classmethod
+    def webui_name(cls) -> str:
+        return "Near-Duplicate Filter"
+
+    @classmethod
+    def webui_config(cls, *args, **kwargs) -> tuple[nicegui.element.Element, list[nicegui.element.Element]]:
+        with ui.element("div").classes("w-full") as element:
+            ui.label("Maximum Hash Distance")
+            max_distance = ui.slider(
+                min=0,
+                max=64,
+                value=6,
+                step=1
+            ).props("label")
+
+        return element, [max_distance]
+
+    @classmethod
+    def webui_validate(cls, max_distance: nicegui.elements.mixins.value_element.ValueElement) -> list[bool]:
+        return [True if 0 <= max_distance.value <= 64 else "Distance must be between 0 and 64 bits"]
+
+    @classmethod
+    def webui_info(cls, max_distance: int):
+        with ui.element("div") as element:
+            with ui.grid(columns=2).style("gap:0 0.2rem; grid-template-columns:min-content min-content;"):
+                ui.label("Maximum Hash Distance:").classes("text-bold")
+                ui.label(str(max_distance)).style("font-family:monospace")
+
+        return element
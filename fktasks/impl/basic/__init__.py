@@ -7,6 +7,7 @@ from .ImageFilter import ImageFilter
 from .ImagePerceptualHashFilter import ImagePerceptualHashFilter
 from .ImageScaler import ImageScaler
 from .JPGQualityFilter import JPGQualityFilter
+from .NearDuplicateFilter import NearDuplicateFilter
 
 __all__ = [
     "BrightnessFilter",
@@ -16,5 +17,6 @@ __all__ = [
     "ImagePerceptualHashFilter",
     "ImageScaler",
     "JPGQualityFilter",
+    "NearDuplicateFilter",
 ]
 
@@ -1,21 +1,22 @@
 import argparse as _argparse
+from typing import Optional as _Optional
 
-import cv2 as _cv2
+import PIL.Image as _Pillow
 import nicegui.element
-import numpy as _numpy
 from nicegui import ui
 
 import fkui.components
-import utils
 from fktasks import FkReportableTask as _FkReportableTask, FkImage as _FkImage, \
-    FkTaskIntensiveness as _FkTaskIntensiveness
+    FkTaskIntensiveness as _FkTaskIntensiveness, ImageStatistics as _ImageStatistics, \
+    StreamingStatistics as _StreamingStatistics
 
 
 class BlurFilter(_FkReportableTask):
 
-    def __init__(self, blur_threshold: int = -1):
+    def __init__(self, blur_threshold: int = -1, analysis_size: int = -1):
         self._blur_threshold = blur_threshold
-        self._blur_scores: list[float] = []
+        self._analysis_size = analysis_size
+        self._blur_scores = _StreamingStatistics(0.01, 100_000, log_scale=True)
 
     def register_args(self, arg_parser: _argparse.ArgumentParser):
         arg_parser.add_argument(
@@ -26,15 +27,49 @@ class BlurFilter(_FkReportableTask):
                  "(0 - infinite; 0 = most blurry; default: -1 [disabled])"
         )
 
+        arg_parser.add_argument(
+            "--blur-analysis-size",
+            default=-1,
+            type=int,
+            help="measure blur on images scaled down to this length of the longer side, so scores are "
+                 "comparable across image sizes; smaller images are measured as they are "
+                 "(default: -1 [full resolution])"
+        )
+
     def parse_args(self, args: _argparse.Namespace) -> bool:
         self._blur_threshold = args.blur_threshold
+        self._analysis_size = args.blur_analysis_size
         return self._blur_threshold >= 0
 
-    # noinspection PyUnresolvedReferences
+    def _blur_score(self, image: _FkImage) -> float:
+        analysis_resolution = self.analysis_resolution
+        if analysis_resolution is None:
+            return image.statistics().laplacian_variance
+
+        # the analysis view is only reduced by whole factors; bring it down to the exact size
+        analysis_image = image.analysis_image(analysis_resolution)
+        width, height = analysis_image.size
+        if max(width, height) <= analysis_resolution:
+            return image.statistics(analysis_resolution).laplacian_variance
+
+        scale = analysis_resolution / max(width, height)
+        size = (max(round(width * scale), 1), max(round(height * scale), 1))
+
+        if analysis_image.mode in ("L", "RGB", "RGBA"):
+            resized_image = analysis_image.resize(size, _Pillow.Resampling.BOX)
+        else:
+            # palette and bilevel images would only be resized by picking pixels
+            with analysis_image.convert("RGB") as temp_image:
+                resized_image = temp_image.resize(size, _Pillow.Resampling.BOX)
+
+        with resized_image:
+            return _ImageStatistics.from_image(resized_image).laplacian_variance
+
     def process(self, image: _FkImage) -> bool:
-        blur_score = _cv2.Laplacian(image.cv2_grayscale_image, _cv2.CV_64F).var()
+        blur_score = self._blur_score(image)
 
-        self._blur_scores.append(blur_score)
+        self._blur_scores.add(blur_score)
+        image.scores[self.name] = blur_score
         return blur_score >= self._blur_threshold
 
     @property
@@ -45,12 +80,26 @@ class BlurFilter(_FkReportableTask):
     def intensiveness(self) -> _FkTaskIntensiveness:
         return _FkTaskIntensiveness.HIGH
 
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {"threshold": self._blur_threshold, "analysis_resolution": self.analysis_resolution}
+
+    @property
+    def analysis_resolution(self) -> _Optional[int]:
+        return self._analysis_size if self._analysis_size > 0 else None
+
+    def drain_observations(self) -> _StreamingStatistics:
+        return self._blur_scores.drain()
+
+    def merge_observations(self, observations: _StreamingStatistics):
+        self._blur_scores.merge(observations)
+
     def report(self) -> list[tuple[str, any]]:
         return [
             ("Filter Threshold", self._blur_threshold),
+            ("Analysis Size", self.analysis_resolution or "Full Resolution"),
             None,
-            ("Average Blur", utils.safe_fn(lambda: _numpy.mean(self._blur_scores), -1)),
-            ("90th Percentile", utils.safe_fn(lambda: _numpy.percentile(self._blur_scores, 90), -1))
+            *self.score_report("Blur", self._blur_scores)
         ]
 
     @classmethod
@@ -1,21 +1,19 @@
 import argparse as _argparse
 
-import cv2 as _cv2
 import nicegui.element
 import numpy as _numpy
 from nicegui import ui
 
 import fkui.components
-import utils
 from fktasks import FkReportableTask as _FkReportableTask, FkImage as _FkImage, \
-    FkTaskIntensiveness as _FkTaskIntensiveness
+    FkTaskIntensiveness as _FkTaskIntensiveness, StreamingStatistics as _StreamingStatistics
 
 
 class EntropyFilter(_FkReportableTask):
 
     def __init__(self, entropy_threshold: float = -1):
         self._entropy_threshold = entropy_threshold
-        self._entropy_scores = []
+        self._entropy_scores = _StreamingStatistics(0, 8)
 
     def register_args(self, arg_parser: _argparse.ArgumentParser):
         arg_parser.add_argument(
@@ -30,19 +28,17 @@ class EntropyFilter(_FkReportableTask):
         self._entropy_threshold = args.entropy_threshold
         return self._entropy_threshold > 0
 
-    # noinspection PyUnresolvedReferences
     def process(self, image: _FkImage) -> bool:
-        grayscale_image = image.cv2_grayscale_image
-
-        hist = _cv2.calcHist([grayscale_image], [0], None, [256], [0, 256])
-        hist = hist.ravel() / hist.sum()
+        hist = image.statistics().histogram
+        hist = hist / hist.sum()
         logs = _numpy.nan_to_num(_numpy.log2(hist + _numpy.finfo(float).eps))
         entropy = -1 * (hist * logs).sum()
 
         del hist
         del logs
 
-        self._entropy_scores.append(entropy)
+        self._entropy_scores.add(entropy)
+        image.scores[self.name] = entropy
         return entropy >= self._entropy_threshold
 
     @property
@@ -53,12 +49,21 @@ class EntropyFilter(_FkReportableTask):
     def intensiveness(self) -> _FkTaskIntensiveness:
         return _FkTaskIntensiveness.HIGH
 
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {"threshold": self._entropy_threshold}
+
+    def drain_observations(self) -> _StreamingStatistics:
+        return self._entropy_scores.drain()
+
+    def merge_observations(self, observations: _StreamingStatistics):
+        self._entropy_scores.merge(observations)
+
     def report(self) -> list[tuple[str, any]]:
         return [
             ("Filter Threshold", self._entropy_threshold),
             None,
-            ("Average Entropy", utils.safe_fn(lambda: _numpy.mean(self._entropy_scores), -1)),
-            ("90th Percentile", utils.safe_fn(lambda: _numpy.percentile(self._entropy_scores, 90), -1))
+            *self.score_report("Entropy", self._entropy_scores)
         ]
 
     @classmethod
@@ -8,7 +8,9 @@ import torch.nn as _torch_nn
 
 import utils
 from fktasks import FkReportableTask as _FkReportableTask, FkImage as _FkImage, \
-    FkTaskIntensiveness as _FkTaskIntensiveness
+    FkTaskIntensiveness as _FkTaskIntensiveness, StreamingStatistics as _StreamingStatistics
+from fktasks.EmbeddingStore import EmbeddingStore as _EmbeddingStore
+from fktasks.MicroBatcher import MicroBatcher as _MicroBatcher
 
 
 class _AestheticPredictor(_torch_nn.Module):
@@ -32,10 +34,15 @@ class _AestheticPredictor(_torch_nn.Module):
 
 class CHADScoreFilter(_FkReportableTask):
 
-    def __init__(self, score_threshold: float = -1):
+    def __init__(self, score_threshold: float = -1, batch_size: int = 16, batch_wait_ms: float = 50):
+        self._batcher = None
+        self._batch_size = batch_size
+        self._batch_wait_ms = batch_wait_ms
+        self._embedding_cache_dirpath = None
+        self._embedding_store = None
         self._clip_preprocess = None
         self._clip_model = None
-        self._chad_scores = None
+        self._chad_scores = _StreamingStatistics(0, 10)
         self._chad_predictor = None
         self._pt_state = None
         self._device = None
@@ -59,8 +66,6 @@ class CHADScoreFilter(_FkReportableTask):
         self._chad_predictor.to(self._device)
         self._chad_predictor.eval()
 
-        self._chad_scores = []
-
         vit_model_name = "ViT-L-14"
         if not _os.path.exists(f"models/{vit_model_name}.pt"):
             print("Downloading ViT-L/14")
@@ -72,6 +77,19 @@ class CHADScoreFilter(_FkReportableTask):
         self._clip_model = clip_model
         self._clip_preprocess = clip_preprocess
 
+        if self._embedding_cache_dirpath:
+            self._embedding_store = _EmbeddingStore(self._embedding_cache_dirpath, "openai-ViT-L-14", 768)
+            print(f"Chad scorer embedding cache: {len(self._embedding_store)} embeddings")
+
+        self._batcher = _MicroBatcher(self._score_batch, self._batch_size, self._batch_wait_ms)
+
+    def shutdown(self):
+        if self._batcher is not None:
+            self._batcher.shutdown()
+
+        if self._embedding_store is not None:
+            self._embedding_store.close()
+
     def register_args(self, arg_parser: _argparse.ArgumentParser):
         arg_parser.add_argument(
             "--chad-score",
@@ -81,39 +99,82 @@ class CHADScoreFilter(_FkReportableTask):
                  "(0 - 8; 0 = least aesthetic; 8 = most aesthetic; default: -1 [disabled])"
         )
 
+        arg_parser.add_argument(
+            "--chad-batch-size",
+            default=16,
+            type=int,
+            help="number of images scored together in one model invocation (default: 16)"
+        )
+
+        arg_parser.add_argument(
+            "--chad-batch-wait-ms",
+            default=50,
+            type=float,
+            help="maximum time to wait for a scoring batch to fill up, in milliseconds (default: 50)"
+        )
+
+        arg_parser.add_argument(
+            "--chad-embedding-cache",
+            default="models/embeddings",
+            type=str,
+            help="directory that stores CLIP embeddings by image content, so reruns skip the CLIP model "
+                 "(empty string disables the cache; default: models/embeddings)"
+        )
+
     def parse_args(self, args: _argparse.Namespace) -> bool:
         self.score_threshold = args.chad_score
+        self._batch_size = max(1, args.chad_batch_size)
+        self._batch_wait_ms = args.chad_batch_wait_ms
+        self._embedding_cache_dirpath = args.chad_embedding_cache
         return self.score_threshold >= 0
 
     def process(self, image: _FkImage) -> bool:
-        chad_image = self._clip_preprocess(image.image).unsqueeze(0).to(self._device)
+        digest = None
+        embedding = None
+
+        # the content hash describes the file on disk, modified pixels have to go through the model
+        # noinspection PyProtectedMember
+        if self._embedding_store is not None and not image._modified_image:
+            digest = bytes.fromhex(image.content_hash)
+            embedding = self._embedding_store.get(digest)
+
+        if embedding is not None:
+            score, _ = self._batcher.submit((None, embedding))
+        else:
+            # preprocessing runs on the calling worker thread, only the model invocation is batched
+            chad_image = self._clip_preprocess(image.image)
+            score, embedding = self._batcher.submit((chad_image, None))
+
+            if digest is not None:
+                self._embedding_store.put(digest, embedding)
+
+        self._chad_scores.add(score)
+        image.scores[self.name] = score
+        return score >= self.score_threshold
 
-        with _torch.inference_mode():
-            image_features1 = self._clip_model.encode_image(chad_image)
-            image_features = image_features1 / image_features1.norm(dim=-1, keepdim=True)
+    def _score_batch(self, items: list[tuple[_torch.Tensor, _numpy.ndarray]]) -> list[tuple[float, _numpy.ndarray]]:
+        encode_indices = [i for i, (chad_image, _) in enumerate(items) if chad_image is not None]
 
-        del image_features1
+        with _torch.inference_mode():
+            image_features = _torch.empty((len(items), 768), dtype=_torch.float16, device=self._device)
 
-        image_features = image_features.cpu().detach().numpy()
-        t_features = _torch.from_numpy(image_features).to(self._device).float()
+            if encode_indices:
+                batch = _torch.stack([items[i][0] for i in encode_indices]).to(self._device)
 
-        score_iter = self._chad_predictor(t_features)
-        _torch.cuda.synchronize()
+                encoded_features = self._clip_model.encode_image(batch)
+                encoded_features = encoded_features / encoded_features.norm(dim=-1, keepdim=True)
 
-        score = score_iter.item()
+                image_features[encode_indices] = encoded_features.half()
 
-        # score_iter = None
-        # image_features = None
-        # t_features = None
-        # chad_image = None
+            cached_indices = [i for i, (chad_image, _) in enumerate(items) if chad_image is None]
+            if cached_indices:
+                cached_features = _numpy.stack([items[i][1] for i in cached_indices])
+                image_features[cached_indices] = _torch.from_numpy(cached_features).to(self._device)
 
-        del score_iter
-        del chad_image
-        del image_features
-        del t_features
+            scores = self._chad_predictor(image_features.float())
 
-        self._chad_scores.append(score)
-        return score >= self.score_threshold
+        embeddings = image_features.cpu().numpy()
+        return list(zip(scores.squeeze(-1).tolist(), embeddings))
 
     @property
     def priority(self) -> int:
@@ -123,12 +184,25 @@ class CHADScoreFilter(_FkReportableTask):
     def intensiveness(self) -> _FkTaskIntensiveness:
         return _FkTaskIntensiveness.GPU
 
+    @property
+    def process_safe(self) -> bool:
+        return False
+
+    @property
+    def parameters(self) -> dict[str, any]:
+        return {"threshold": self.score_threshold, "model": "openai-ViT-L-14"}
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
     def report(self) -> list[tuple[str, any]]:
         return [
             ("Filter Threshold", self.score_threshold),
             None,
-            ("Average CHAD Score", utils.safe_fn(lambda: _numpy.mean(self._chad_scores), -1)),
-            ("90th Percentile", utils.safe_fn(lambda: _numpy.percentile(self._chad_scores, 90), -1))
+            *self.score_report("CHAD Score", self._chad_scores),
+            ("Average Batch Size", utils.safe_fn(lambda: self._batcher.average_batch_size, -1)),
+            ("Cached Embeddings Used", utils.safe_fn(lambda: self._embedding_store.hits, 0))
         ]
 
     @classmethod
@@ -2,7 +2,7 @@ import argparse
 import json
 import os
 import sys
-import time
+import threading
 import inspect
 
 import fkio
@@ -45,7 +45,8 @@ if __name__ == '__main__':
 
     arg_parser.add_argument(
         "src",
-        help="dataset input folder"
+        nargs="+",
+        help="dataset input folders"
     )
 
     arg_parser.add_argument(
@@ -67,6 +68,47 @@ if __name__ == '__main__':
              "(default: .txt)"
     )
 
+    arg_parser.add_argument(
+        "--input-shards",
+        action="store_true",
+        default=False,
+        help="read the input folders as WebDataset tar shards (shard files or folders of shards) "
+             "instead of image folders (default: False)"
+    )
+
+    arg_parser.add_argument(
+        "--shard-readers",
+        default=4,
+        type=int,
+        help="number of input shards read at the same time (default: 4)"
+    )
+
+    arg_parser.add_argument(
+        "--output-shard-size",
+        default=0,
+        type=int,
+        help="write the dataset output folder as WebDataset tar shards of at most this many megabytes "
+             "(default: 0 [write image files])"
+    )
+
+    arg_parser.add_argument(
+        "--copy-strategy",
+        default="copy",
+        choices=utils.COPY_STRATEGIES,
+        help="how images saved unchanged are copied to the dataset output folder; hardlink shares the file "
+             "with the input (edits to one show in the other), reflink shares its blocks until either is "
+             "changed, copy_file_range copies inside the kernel; unsupported strategies fall back to the "
+             "next one (default: copy)"
+    )
+
+    arg_parser.add_argument(
+        "--deduplicate",
+        action="store_true",
+        default=False,
+        help="skip saving images whose file contents were already saved to the dataset output folder, "
+             "in this or an earlier run (default: False)"
+    )
+
     arg_parser.add_argument(
         "--resource-usage",
         default="low",
@@ -74,6 +116,92 @@ if __name__ == '__main__':
         help="configure pipeline to use more or less resources (default: low)"
     )
 
+    arg_parser.add_argument(
+        "--cache-size",
+        default=1024,
+        type=int,
+        help="size in megabytes of the shared memory arena holding decoded images (default: 1024)"
+    )
+
+    arg_parser.add_argument(
+        "--scan-index",
+        default=None,
+        type=str,
+        help="scan index file for the input folder; when given, only images that are new or changed "
+             "since the previous run with the same index are processed (default: None [disabled])"
+    )
+
+    arg_parser.add_argument(
+        "--ledger",
+        default=None,
+        type=str,
+        help="decision ledger database; every task decision is recorded in it and runs with the same task "
+             "configuration reuse recorded decisions instead of recomputing them (default: None [disabled])"
+    )
+
+    arg_parser.add_argument(
+        "--scan-workers",
+        default=8,
+        type=int,
+        help="number of threads listing input folders in parallel; 1 lists them in order (default: 8)"
+    )
+
+    arg_parser.add_argument(
+        "--io-concurrency",
+        default=64,
+        type=int,
+        help="maximum number of file reads and writes in flight at once; raise it for network storage "
+             "(default: 64)"
+    )
+
+    arg_parser.add_argument(
+        "--prefetch-size",
+        default=256,
+        type=int,
+        help="size in megabytes of the file contents read ahead of the tasks that need them; files beyond "
+             "it are read when first needed (default: 256)"
+    )
+
+    arg_parser.add_argument(
+        "--process-pool",
+        default=None,
+        type=str,
+        help="run tasks of the given intensiveness levels in worker processes instead of threads; "
+             "levels can be provided in a comma-separated list "
+             "(example: low,medium,high; default: None [disabled])"
+    )
+
+    arg_parser.add_argument(
+        "--adaptive-task-order",
+        action="store_true",
+        default=False,
+        help="measure task latency and rejection rate during a warm-up window and reorder tasks "
+             "so cheap, selective filters run first (default: False)"
+    )
+
+    arg_parser.add_argument(
+        "--adaptive-warmup-images",
+        default=500,
+        type=int,
+        help="number of images in each adaptive task ordering warm-up window (default: 500)"
+    )
+
+    arg_parser.add_argument(
+        "--gpu-multipass",
+        action="store_true",
+        default=False,
+        help="run GPU tasks in their own pipeline stages that score images while CPU filtering is "
+             "still in progress (default: False)"
+    )
+
+    arg_parser.add_argument(
+        "--multipass-buffer-size",
+        default=1024,
+        type=int,
+        help="number of images that can wait between two multi-pass stages before the earlier stage "
+             "is slowed down (default: 1024)"
+    )
+
     working_directory = os.path.dirname(os.path.realpath(__file__))
     tasks_directory = os.path.join(working_directory, "fktasks", "impl")
     _, tasks_classes = utils.load_modules_and_classes_from_directory(tasks_directory)
@@ -120,15 +248,36 @@ if __name__ == '__main__':
     print(json.dumps(vars(args), sort_keys=True, indent=2))
     print()
 
-    input_dirpath = args.src
+    input_dirpaths = args.src
     output_dirpath = args.dst
     image_ext = args.output_image_ext
     resource_pool_selection = args.resource_usage or "low"
     resource_pool = resource_pools[resource_pool_selection]
-    gpu_multipass = False
+    gpu_multipass = args.gpu_multipass
+    multipass_buffer_size = args.multipass_buffer_size
+    adaptive_ordering = args.adaptive_task_order
+    warmup_images = args.adaptive_warmup_images
+    cache_bytes = args.cache_size * 1024 * 1024
+    io_concurrency = args.io_concurrency
+    prefetch_bytes = args.prefetch_size * 1024 * 1024
+    ledger = fktasks.DecisionLedger(args.ledger) if args.ledger else None
+
+    process_intensiveness: list[fktasks.FkTaskIntensiveness] = []
+    if args.process_pool:
+        process_intensiveness = [
+            fktasks.FkTaskIntensiveness[level.strip().upper().replace("-", "_")]
+            for level in args.process_pool.split(",")
+        ]
+
+    if args.input_shards:
+        input_src = fkio.FkWebDatasetSource(input_dirpaths, args.shard_readers)
+    else:
+        input_src = fkio.FkDirectorySource(input_dirpaths, True, args.scan_index, args.scan_workers)
 
-    input_src = fkio.FkDirectorySource(input_dirpath, True)
-    output_dst = fkio.FkDirectoryDestination(output_dirpath)
+    if args.output_shard_size > 0:
+        output_dst = fkio.FkWebDatasetDestination(output_dirpath, args.output_shard_size * 1024 * 1024)
+    else:
+        output_dst = fkio.FkDirectoryDestination(output_dirpath, args.copy_strategy, args.deduplicate)
 
     runtime_tasks: list[fktasks.FkTask] = []
     for task_inst in tasks_instances:
@@ -141,49 +290,98 @@ if __name__ == '__main__':
     if gpu_multipass:
         cpu_tasks = []
         gpu_tasks = []
+        retracting_tasks = []
 
         for task in runtime_tasks:
             if task.intensiveness == fktasks.FkTaskIntensiveness.GPU:
                 gpu_tasks.append(task)
 
+            elif task.retracts_images:
+                retracting_tasks.append(task)
+
             else:
                 cpu_tasks.append(task)
 
-        buffer = fkio.FkPathBuffer()
-        cpu_pipeline = fktasks.FkPipeline(input_src, buffer, image_ext)
+        # images can only be retracted from the final output, so those tasks run in the last stage
+        if not gpu_tasks:
+            cpu_tasks.extend(retracting_tasks)
+
+        # every stage holds its own image cache, share the configured size between them
+        stage_cache_bytes = cache_bytes // (1 + len(gpu_tasks))
+
+        if not gpu_tasks:
+            print("No GPU tasks enabled, running a single pass...")
+
+        # without a GPU stage to read it, a buffer would only fill up; save straight to the output then
+        buffer = fkio.FkPathBuffer("cpu", multipass_buffer_size) if gpu_tasks else output_dst
+        cpu_pipeline = fktasks.FkPipeline(
+            input_src, buffer, image_ext,
+            cache_bytes=stage_cache_bytes,
+            io_concurrency=io_concurrency,
+            prefetch_bytes=prefetch_bytes,
+            ledger=ledger,
+            adaptive_ordering=adaptive_ordering,
+            warmup_images=warmup_images
+        )
         for cpu_task in cpu_tasks:
             intensiveness = cpu_task.intensiveness
-            max_workers = resource_pool[intensiveness]
+            max_workers = max(resource_pool[intensiveness], cpu_task.batch_size)
 
-            cpu_pipeline.add_task(cpu_task, max_workers)
+            cpu_pipeline.add_task(cpu_task, max_workers, use_processes=intensiveness in process_intensiveness)
 
         pipelines.append(cpu_pipeline)
 
         next_buffer = buffer
+        upstream_pipeline = cpu_pipeline
         for i, gpu_task in enumerate(gpu_tasks, start=1):
-            out_buffer = fkio.FkPathBuffer() if i < len(gpu_tasks) else output_dst
-            gpu_pipeline = fktasks.FkPipeline(next_buffer, out_buffer, image_ext)
+            out_buffer = fkio.FkPathBuffer(gpu_task.name, multipass_buffer_size) if i < len(gpu_tasks) else output_dst
+            gpu_pipeline = fktasks.FkPipeline(
+                next_buffer, out_buffer, image_ext,
+                cache_bytes=stage_cache_bytes,
+                io_concurrency=io_concurrency,
+                prefetch_bytes=prefetch_bytes,
+                ledger=ledger,
+                upstream=upstream_pipeline
+            )
 
             intensiveness = gpu_task.intensiveness
-            max_workers = resource_pool[intensiveness]
+            max_workers = max(resource_pool[intensiveness], gpu_task.batch_size)
 
             gpu_pipeline.add_task(gpu_task, max_workers)
             next_buffer = out_buffer
+            upstream_pipeline = gpu_pipeline
+
+            if out_buffer is output_dst:
+                for retracting_task in retracting_tasks:
+                    gpu_pipeline.add_task(retracting_task, resource_pool[retracting_task.intensiveness])
 
             pipelines.append(gpu_pipeline)
 
         print(f"Completed multi-pass setup... {len(pipelines)} pipelines created...")
 
     else:
-        pipeline = fktasks.FkPipeline(input_src, output_dst, image_ext)
+        pipeline = fktasks.FkPipeline(
+            input_src, output_dst, image_ext,
+            cache_bytes=cache_bytes,
+            io_concurrency=io_concurrency,
+            prefetch_bytes=prefetch_bytes,
+            ledger=ledger,
+            adaptive_ordering=adaptive_ordering,
+            warmup_images=warmup_images
+        )
         for task in runtime_tasks:
             intensiveness = task.intensiveness
-            max_workers = resource_pool[intensiveness]
+            max_workers = max(resource_pool[intensiveness], task.batch_size)
 
-            pipeline.add_task(task)
+            pipeline.add_task(task, max_workers, use_processes=intensiveness in process_intensiveness)
 
         pipelines.append(pipeline)
 
+    def run_pipeline(image_pipeline: fktasks.FkPipeline):
+        image_pipeline.start()
+        image_pipeline.wait()
+        image_pipeline.shutdown()
+
     for image_pipeline in pipelines:
         print("Setting up pipeline...")
         print()
@@ -194,24 +392,51 @@ if __name__ == '__main__':
 
         print()
 
-        try:
-            print("Starting pipeline...")
-            image_pipeline.start()
+    # stages connected by buffers run side by side, each one consuming images as the previous one saves them
+    pipeline_threads = [
+        threading.Thread(target=run_pipeline, args=(image_pipeline,), daemon=True)
+        for image_pipeline in pipelines
+    ]
+
+    try:
+        print("Starting pipeline...")
+        for pipeline_thread in pipeline_threads:
+            pipeline_thread.start()
+
+        print()
+        print("Waiting for workers to complete...")
+        for pipeline_thread in pipeline_threads:
+            while pipeline_thread.is_alive():
+                pipeline_thread.join(timeout=1)
+
+        print("Pipeline complete...")
 
-            print()
-            print("Waiting for workers to complete...")
-            while image_pipeline.active:
-                time.sleep(1)
+    except KeyboardInterrupt:
+        print("Pipeline interrupted...")
 
-            print("Pipeline complete...")
+        # pipeline threads do not see the interrupt; stop them in order, so every stage can still hand what
+        # it holds to the next one, which releases process pools and shared memory too
+        for image_pipeline in pipelines:
             image_pipeline.shutdown()
-            image_pipeline.report()
 
-        except KeyboardInterrupt:
-            print("Pipeline interrupted...")
+        for pipeline_thread in pipeline_threads:
+            while pipeline_thread.is_alive():
+                pipeline_thread.join(timeout=1)
+
+        for image_pipeline in pipelines:
             image_pipeline.report()
-            sys.exit()
+
+        if ledger is not None:
+            ledger.close()
+
+        sys.exit()
+
+    for image_pipeline in pipelines:
+        image_pipeline.report()
 
         print()
         print("-" * 42)
         print()
+
+    if ledger is not None:
+        ledger.close()
@@ -0,0 +1,34 @@
+import json
+import os
+import unittest
+
+from fktasks.impl.basic import CaptionNormalizer
+
+_GOLDEN_PATH = os.path.join(os.path.dirname(__file__), "data", "caption_normalizer_golden.jsonl")
+
+
+class CaptionNormalizerTest(unittest.TestCase):
+    """
+    Golden captions, normalized by the original regex implementation: escapes, weights, loras, punctuation,
+    placeholder look-alikes and unicode whitespace, plus a long caption with repeated tags.
+    """
+
+    def test_golden_captions(self):
+        with open(_GOLDEN_PATH, "r", encoding="utf-8") as golden_file:
+            cases = [json.loads(line) for line in golden_file]
+
+        self.assertTrue(cases)
+
+        for case in cases:
+            with self.subTest(caption=case["caption"]):
+                self.assertEqual(CaptionNormalizer.normalize(case["caption"]), case["normalized"])
+
+    def test_idempotent(self):
+        caption_text = "(masterpiece:1.2), \\(artist\\), <lora:detail:0.6>, Tag, tag, y.o girl."
+        normalized = CaptionNormalizer.normalize(caption_text)
+
+        self.assertEqual(CaptionNormalizer.normalize(normalized), normalized)
+
+
+if __name__ == "__main__":
+    unittest.main()
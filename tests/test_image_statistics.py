@@ -0,0 +1,56 @@
+import unittest
+
+import numpy
+import PIL.Image
+import PIL.ImageStat
+
+from fktasks import ImageStatistics
+
+# every mode BrightnessFilter may see, grayscale, palette, alpha, high bit depth and other colour spaces
+_MODES = ["RGB", "L", "RGBA", "P", "PA", "1", "LA", "RGBa", "RGBX", "CMYK", "YCbCr", "HSV", "I", "I;16", "F"]
+
+
+def _reference_means(image: PIL.Image.Image) -> tuple[float, ...]:
+    with image.convert("RGB") as converted_image:
+        return tuple(PIL.ImageStat.Stat(converted_image).mean)
+
+
+def _image_of_mode(pixels: numpy.ndarray, mode: str) -> PIL.Image.Image:
+    image = PIL.Image.fromarray(pixels, "RGBA")
+
+    if mode == "P":
+        return image.convert("RGB").quantize(97)
+
+    if mode == "HSV":
+        return image.convert("RGB").convert("HSV")
+
+    return image.convert(mode)
+
+
+class ChannelMeansTest(unittest.TestCase):
+    def test_matches_rgb_conversion(self):
+        rng = numpy.random.default_rng(0)
+
+        for mode in _MODES:
+            for height, width in [(1, 1), (7, 13), (240, 317)]:
+                pixels = rng.integers(0, 256, (height, width, 4), dtype=numpy.uint8)
+
+                with self.subTest(mode=mode, size=(width, height)), _image_of_mode(pixels, mode) as image:
+                    numpy.testing.assert_allclose(
+                        ImageStatistics.channel_means_of(image), _reference_means(image), rtol=0, atol=1e-9
+                    )
+
+    def test_stride_samples_grid(self):
+        rng = numpy.random.default_rng(1)
+        pixels = rng.integers(0, 256, (120, 90, 4), dtype=numpy.uint8)
+
+        with PIL.Image.fromarray(pixels, "RGBA") as image:
+            # every third pixel of every third row, the way nearest neighbour resampling picks them
+            with image.resize((30, 40), PIL.Image.Resampling.NEAREST) as sampled_image:
+                expected = _reference_means(sampled_image)
+
+            numpy.testing.assert_allclose(ImageStatistics.channel_means_of(image, 3), expected, rtol=0, atol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
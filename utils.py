@@ -1,3 +1,4 @@
+import errno as _errno
 import importlib as _importlib
 import inspect as _inspect
 import os as _os
@@ -5,7 +6,7 @@ import shutil as _shutil
 import sys as _sys
 import urllib.request as _urllib_request
 import warnings
-from typing import Callable as _Callable
+from typing import Callable as _Callable, Optional as _Optional
 
 import PIL.Image as _Pillow
 from PIL.Image import Image as _PillowImage
@@ -25,6 +26,19 @@ KNOWN_CAPTION_TEXT_EXTENSIONS = [
     ".caption"
 ]
 
+# strategies for copying files unchanged, from cheapest to most expensive; each falls back to the next
+COPY_STRATEGIES = [
+    "hardlink",
+    "reflink",
+    "copy_file_range",
+    "copy"
+]
+
+_FICLONE = 0x40049409
+
+# (device, strategy) pairs a strategy failed on for a reason other than the file itself
+_unsupported_copy_strategies: set[tuple[int, str]] = set()
+
 
 def format_timestamp(seconds):
     minutes = seconds // 60
@@ -41,6 +55,86 @@ def safe_fn(fn: _Callable, default_value: any = None) -> any:
         return default_value
 
 
+def read_caption_text(image_filepath: str) -> _Optional[str]:
+    """Caption text stored next to an image, trying every known caption extension; None without a caption."""
+    image_filepath_base = _os.path.splitext(image_filepath)[0]
+
+    caption_text = None
+    for caption_text_ext in KNOWN_CAPTION_TEXT_EXTENSIONS:
+        # a failed open costs a single lookup, checking for existence first costs two on a hit
+        try:
+            with open(image_filepath_base + caption_text_ext, "r", encoding="utf-8", errors="ignore") as caption_file:
+                caption_text = caption_file.read().strip()
+        except OSError:
+            continue
+
+    return caption_text
+
+
+def _reflink_file(src: str, dst: str):
+    import fcntl  # POSIX only; ImportError makes the caller fall back
+
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+
+
+def _copy_file_range(src: str, dst: str):
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        remaining = _os.fstat(src_file.fileno()).st_size
+        while remaining > 0:
+            copied = _os.copy_file_range(src_file.fileno(), dst_file.fileno(), remaining)
+            if copied == 0:
+                # some filesystems report end of file early; the copy would be truncated
+                raise OSError(_errno.EIO, f"copy_file_range stopped {remaining} bytes short", src)
+
+            remaining -= copied
+
+
+def copy_file(src: str, dst: str, strategy: str = "copy") -> str:
+    """
+    Copy a file without reading it into Python, starting with the given strategy and falling back to
+    cheaper-to-support ones: a hard link shares the file, a reflink shares its blocks until either copy
+    is written to, copy_file_range copies inside the kernel. Strategies that fail for a device are not
+    tried again for it.
+    :param src:
+    :param dst:
+    :param strategy: one of COPY_STRATEGIES
+    :return: the strategy that made the copy
+    """
+    device = _os.stat(src).st_dev
+
+    for fallback_strategy in COPY_STRATEGIES[COPY_STRATEGIES.index(strategy):]:
+        if fallback_strategy == "copy":
+            break
+
+        if (device, fallback_strategy) in _unsupported_copy_strategies:
+            continue
+
+        try:
+            if fallback_strategy == "hardlink":
+                if _os.path.lexists(dst):
+                    _os.remove(dst)
+
+                _os.link(src, dst)
+
+            elif fallback_strategy == "reflink":
+                _reflink_file(src, dst)
+
+            else:
+                _copy_file_range(src, dst)
+
+            return fallback_strategy
+
+        except (ImportError, AttributeError, OSError) as e:
+            if isinstance(e, OSError) and e.errno in (_errno.ENOENT, _errno.EACCES, _errno.ENOSPC):
+                raise
+
+            _unsupported_copy_strategies.add((device, fallback_strategy))
+
+    _shutil.copyfile(src, dst)
+    return "copy"
+
+
 def resize_image_aspect(image: _PillowImage, max_size: int) -> _PillowImage:
     width, height = image.size
 